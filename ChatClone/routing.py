@@ -1,9 +1,25 @@
+from django.conf import settings
 from django.urls import path
 
-from core.consumers import ChatConsumer, GeneralConsumer, PrivateConsumer
+from core.consumers import ChatConsumer, GeneralConsumer, PrivateConsumer, AsyncChatConsumer, \
+    AsyncGeneralConsumer, AsyncPrivateConsumer, MultiplexConsumer
+
+consumers = {
+    "chats": {"sync": ChatConsumer, "async": AsyncChatConsumer},
+    "general": {"sync": GeneralConsumer, "async": AsyncGeneralConsumer},
+    "private": {"sync": PrivateConsumer, "async": AsyncPrivateConsumer},
+}
+
+
+def consumer_for(route: str):
+    mode = getattr(settings, "WEBSOCKET_CONSUMERS", {}).get(route, "sync")
+    return consumers[route][mode].as_asgi()
+
 
 websocket_urlpatterns = [
-    path("ws/<token>/chats/<chat_id>/", ChatConsumer.as_asgi()),
-    path("ws/<token>/general/", GeneralConsumer.as_asgi()),
-    path("ws/<token>/private/", PrivateConsumer.as_asgi())
+    path("ws/<token>/chats/<chat_id>/", consumer_for("chats")),
+    path("ws/<token>/general/", consumer_for("general")),
+    path("ws/<token>/private/", consumer_for("private")),
+    # one socket for general, private and every subscribed room
+    path("ws/<token>/", MultiplexConsumer.as_asgi()),
 ]
@@ -12,7 +12,7 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 import os
 from pathlib import Path
 
-from decouple import config
+from decouple import config, Csv
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -91,7 +91,7 @@ ASGI_APPLICATION = "ChatClone.asgi.application"
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'NAME': config("DATABASE_NAME", default=str(BASE_DIR / 'db.sqlite3')),
     }
 }
 
@@ -150,6 +150,15 @@ REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": [
         "rest_framework.authentication.TokenAuthentication",
     ],
+    "DEFAULT_RENDERER_CLASSES": [
+        "core.codecs.FastJSONRenderer",
+        "rest_framework.renderers.BrowsableAPIRenderer",
+    ],
+    "DEFAULT_PARSER_CLASSES": [
+        "core.codecs.FastJSONParser",
+        "rest_framework.parsers.FormParser",
+        "rest_framework.parsers.MultiPartParser",
+    ],
     "DEFAULT_PAGINATION_CLASS": "core.helpers.CustomPagination",
     "PAGE_SIZE": 20,
     "DEFAULT_PERMISSION_CLASSES": ("rest_framework.permissions.IsAuthenticated",)
@@ -164,6 +173,32 @@ CHANNEL_LAYERS = {
     },
 }
 
+# per process memory cache, or a redis cache shared by every process when CACHE_REDIS_URL is set
+CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "chatclone"}}
+if config("CACHE_REDIS_URL", default=""):
+    CACHES["default"] = {"BACKEND": "django.core.cache.backends.redis.RedisCache",
+                         "LOCATION": config("CACHE_REDIS_URL")}
+
+# the newest SIZE serialized messages of every room are kept in the CACHE alias for TTL seconds,
+# they serve the newest cursor page of the message list. The web processes and the celery worker all update
+# them, so they are only kept when the cache is shared, CACHE None turns them off
+RECENT_MESSAGES_CACHE = {
+    "SIZE": config("RECENT_MESSAGES_CACHE_SIZE", default=50, cast=int),
+    "TTL": config("RECENT_MESSAGES_CACHE_TTL", default=3600, cast=int),
+    "CACHE": "default" if config("CACHE_REDIS_URL", default="") else None,
+}
+
+# "auto" indexes messages with sqlite FTS5 or a postgres tsvector index depending on the database,
+# or the dotted path of a core.search.SearchBackend; POSTGRES_CONFIG is the text search configuration
+MESSAGE_SEARCH = {
+    "BACKEND": config("MESSAGE_SEARCH_BACKEND", default="auto"),
+    "POSTGRES_CONFIG": config("MESSAGE_SEARCH_POSTGRES_CONFIG", default="english"),
+}
+
+# "memory" keeps the groups inside the process, only for a single server such as the one load_websockets runs
+if config("CHANNEL_LAYER", default="redis") == "memory":
+    CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+
 CHANNEL_LAYERS["default"]["MIDDLEWARE"] = [
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
@@ -171,6 +206,53 @@ CHANNEL_LAYERS["default"]["MIDDLEWARE"] = [
     "channels.middleware.http.HttpConsumerMiddleware",
     "channels.middleware.auth.AuthMiddlewareStack",
 ]
+
+# send websocket events after the transaction commits, batched on a background worker
+WEBSOCKET_PUBLISH_DEFERRED = config("WEBSOCKET_PUBLISH_DEFERRED", default=False, cast=bool)
+
+# also send the old per message NEW MESSAGE VIEWER events next to the aggregated MESSAGES VIEWED event
+READ_RECEIPT_PER_MESSAGE_EVENTS = config("READ_RECEIPT_PER_MESSAGE_EVENTS", default=False, cast=bool)
+
+# in-process cache of the token and room membership lookups done on websocket connect
+WEBSOCKET_AUTH_CACHE = {
+    "TTL": config("WEBSOCKET_AUTH_CACHE_TTL", default=60, cast=int),
+    "MAX_SIZE": config("WEBSOCKET_AUTH_CACHE_SIZE", default=10000, cast=int),
+}
+
+# consumer implementation ("sync" or "async") served on each websocket route
+WEBSOCKET_CONSUMERS = {
+    "chats": config("WEBSOCKET_CHATS_CONSUMER", default="sync"),
+    "general": config("WEBSOCKET_GENERAL_CONSUMER", default="sync"),
+    "private": config("WEBSOCKET_PRIVATE_CONSUMER", default="sync"),
+}
+
+# json library used for api responses, request bodies and websocket frames: "orjson", "ujson", "json"
+# or "auto" for orjson when it is installed, they all produce the same datetimes and decimals
+JSON_CODEC = config("JSON_CODEC", default="auto")
+
+# sockets on the batched protocols get the events of a window as one array frame, sent early once
+# it holds MAX_EVENTS events or MAX_BYTES bytes
+WEBSOCKET_BATCH = {
+    "WINDOW_MS": config("WEBSOCKET_BATCH_WINDOW_MS", default=30, cast=int),
+    "MAX_EVENTS": config("WEBSOCKET_BATCH_MAX_EVENTS", default=100, cast=int),
+    "MAX_BYTES": config("WEBSOCKET_BATCH_MAX_BYTES", default=64 * 1024, cast=int),
+}
+
+# inbound websocket frames larger than this are dropped instead of being fanned out
+WEBSOCKET_MAX_FRAME_BYTES = config("WEBSOCKET_MAX_FRAME_BYTES", default=64 * 1024, cast=int)
+
+# frames waiting for a slow client are bounded per socket, when MAX_FRAMES or MAX_BYTES are queued the POLICY
+# "drop_oldest", "drop_noncritical" (frames holding only NONCRITICAL_EVENTS) or "close" (with CLOSE_CODE) applies.
+# Only a server that waits on the client's socket fills the queue, uvicorn --ws websockets does and daphne doesn't
+WEBSOCKET_SEND_QUEUE = {
+    "MAX_FRAMES": config("WEBSOCKET_SEND_QUEUE_MAX_FRAMES", default=256, cast=int),
+    "MAX_BYTES": config("WEBSOCKET_SEND_QUEUE_MAX_BYTES", default=1024 * 1024, cast=int),
+    "POLICY": config("WEBSOCKET_SEND_QUEUE_POLICY", default="drop_noncritical"),
+    "CLOSE_CODE": config("WEBSOCKET_SEND_QUEUE_CLOSE_CODE", default=4008, cast=int),
+    "NONCRITICAL_EVENTS": config("WEBSOCKET_SEND_QUEUE_NONCRITICAL_EVENTS", cast=Csv(),
+                                 default="NEW MESSAGE VIEWER,MESSAGES VIEWED,LOGGED IN,TYPING"),
+}
+
 CORS_ALLOWED_ORIGINS = [
     "http://localhost:3000",
     "http://localhost:8000",
@@ -186,6 +268,27 @@ CORS_ORIGIN_WHITELIST = [
 
 CORS_ALLOW_CREDENTIALS = True
 
+CELERY_BROKER_URL = config("CELERY_BROKER_URL", default="redis://localhost:6379/0")
+# run tasks inline instead of on a worker, for tests and local runs without a broker
+CELERY_TASK_ALWAYS_EAGER = config("CELERY_TASK_ALWAYS_EAGER", default=False, cast=bool)
+
+# resumable uploads of large attachments
+UPLOAD_CHUNK_SIZE = config("UPLOAD_CHUNK_SIZE", default=5 * 1024 * 1024, cast=int)
+UPLOAD_MAX_SIZE = config("UPLOAD_MAX_SIZE", default=2 * 1024 * 1024 * 1024, cast=int)
+UPLOAD_SESSION_TTL_HOURS = config("UPLOAD_SESSION_TTL_HOURS", default=24, cast=int)
+# hours a room history export can be downloaded for before delete_expired_uploads removes it
+ROOM_EXPORT_TTL_HOURS = config("ROOM_EXPORT_TTL_HOURS", default=24, cast=int)
+
+# path prefix the front proxy serves MEDIA_ROOT under internally (e.g. /protected/), when set attachment
+# downloads are handed to the proxy through ATTACHMENT_ACCEL_HEADER instead of being streamed by django
+ATTACHMENT_ACCEL_REDIRECT = config("ATTACHMENT_ACCEL_REDIRECT", default="")
+ATTACHMENT_ACCEL_HEADER = config("ATTACHMENT_ACCEL_HEADER", default="X-Accel-Redirect")
+
+# longest side in pixels of the picture derivatives generated by core.thumbnails
+THUMBNAIL_SIZES = {"small": 96, "medium": 480, "large": 1280}
+# disk space the derivatives may use before the least recently used ones are deleted
+DERIVATIVE_CACHE_MAX_BYTES = config("DERIVATIVE_CACHE_MAX_BYTES", default=512 * 1024 * 1024, cast=int)
+
 DEFAULT_FILE_STORAGE = "django.core.files.storage.FileSystemStorage"
 MEDIA_URL = "/media/"
 MEDIA_ROOT = os.path.join("media")
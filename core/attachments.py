@@ -0,0 +1,260 @@
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+import uuid
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from PIL import Image, UnidentifiedImageError
+
+from core.models import Blob
+from core.storage import attachment_storage
+
+STAGING_DIRECTORY = "staging"
+SNIFF_BYTES = 64
+BLOCK_SIZE = 64 * 1024
+
+
+def sniff_file_type(head: bytes) -> str:
+	"""
+	Works out the attachment type from the leading bytes of the file instead of the client supplied content type
+	:param head: first bytes of the file
+	:return: picture, audio, video or document
+	"""
+	if head.startswith((b"\xff\xd8\xff", b"\x89PNG\r\n\x1a\n", b"GIF87a", b"GIF89a")):
+		return "picture"
+	if head.startswith(b"RIFF") and head[8:12] == b"WEBP":
+		return "picture"
+	if head.startswith((b"ID3", b"OggS", b"fLaC")) or head[:2] in (b"\xff\xfb", b"\xff\xf3", b"\xff\xf2"):
+		return "audio"
+	if head.startswith(b"RIFF") and head[8:12] == b"WAVE":
+		return "audio"
+	if head[4:8] == b"ftyp":
+		return "audio" if head[8:11] == b"M4A" else "video"
+	if head.startswith(b"\x1a\x45\xdf\xa3"):
+		return "video"
+	return "document"
+
+
+def stage_upload(upload) -> str:
+	"""
+	Streams an uploaded file into the deduplicated attachment storage, so it outlives the request.
+	A file that is already stored is only hashed
+	:param upload: UploadedFile
+	:return: name of the staged blob
+	"""
+	extension = os.path.splitext(upload.name)[1].lower()
+	return attachment_storage.save(f"{STAGING_DIRECTORY}/{uuid.uuid4().hex}{extension}", upload)
+
+
+def ingest_attachment(attachment) -> bool:
+	"""
+	Points the storage field of a staged attachment at its blob after checking what the file really is
+	:param attachment: pending ChatAttachment
+	:return: whether the attachment is ready
+	"""
+	staged = attachment.staged_file
+	try:
+		with attachment_storage.open(staged, "rb") as staged_file:
+			file_type = sniff_file_type(staged_file.read(SNIFF_BYTES))
+			staged_file.seek(0)
+			if file_type == "picture" and not is_valid_image(staged_file):
+				file_type = "document"
+	except (OSError, ValueError) as e:
+		logging.critical(e, exc_info=True)
+		attachment.status = attachment.FAILED
+		attachment.save(update_fields=["status"])
+		return False
+	# the blob is already in its final place, nothing is copied
+	getattr(attachment, file_type).name = staged
+	attachment.status = attachment.READY
+	attachment.staged_file = ""
+	with transaction.atomic():
+		attachment.save()
+		Blob.acquire(staged)
+	return True
+
+
+def is_valid_image(file) -> bool:
+	try:
+		with Image.open(file) as image:
+			image.verify()
+		return True
+	except (UnidentifiedImageError, OSError, SyntaxError):
+		return False
+
+
+class HashingReader:
+	"""
+	Reads at most length bytes from a stream while hashing them
+	"""
+	def __init__(self, stream, length: int):
+		self.stream = stream
+		self.remaining = length
+		self.size = 0
+		self.sha256 = hashlib.sha256()
+
+	def read(self, size=-1):
+		if size is None or size < 0 or size > self.remaining:
+			size = self.remaining
+		data = self.stream.read(size) if size else b""
+		self.remaining -= len(data)
+		self.size += len(data)
+		self.sha256.update(data)
+		return data
+
+
+class ConcatenatedChunks(File):
+	"""
+	File whose content is the chunks of an upload session read one block at a time,
+	so assembling an upload never holds more than a block in memory
+	"""
+	def __init__(self, session):
+		super().__init__(None, name=session.file_name)
+		self.session = session
+
+	@property
+	def size(self):
+		return self.session.total_size
+
+	def chunks(self, chunk_size=None):
+		for index in range(self.session.chunk_count):
+			with default_storage.open(self.session.chunk_path(index), "rb") as chunk:
+				while True:
+					data = chunk.read(chunk_size or BLOCK_SIZE)
+					if not data:
+						break
+					yield data
+
+	def __iter__(self):
+		return self.chunks()
+
+	def close(self):
+		pass
+
+
+def save_chunk(session, index: int, stream, length: int, sha256: str) -> bool:
+	"""
+	Streams one chunk of an upload session into the storage under a name of its own, it only replaces a chunk
+	received before once its size and sha256 match, so a broken resend never costs the good copy
+	:return: whether the chunk matched and was kept
+	"""
+	path = session.chunk_path(index)
+	reader = HashingReader(stream, length)
+	partial = default_storage.save(f"{path}.{uuid.uuid4().hex}.part", File(reader, name=path))
+	if reader.size != length or reader.sha256.hexdigest() != sha256:
+		default_storage.delete(partial)
+		return False
+	replace_file(partial, path)
+	return True
+
+
+def replace_file(source: str, target: str, storage=default_storage):
+	try:
+		os.replace(storage.path(source), storage.path(target))
+	except NotImplementedError:
+		# storages without local paths can't rename, the verified copy is written over the old one
+		storage.delete(target)
+		with storage.open(source, "rb") as file:
+			storage.save(target, file)
+		storage.delete(source)
+
+
+def assemble_upload(session) -> str:
+	"""
+	Streams the chunks of a complete upload session into the deduplicated attachment storage
+	:return: name of the staged blob
+	"""
+	extension = os.path.splitext(session.file_name)[1].lower()
+	return attachment_storage.save(f"{STAGING_DIRECTORY}/{uuid.uuid4().hex}{extension}", ConcatenatedChunks(session))
+
+
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def parse_range(header: str, size: int):
+	"""
+	Parses a single range Range header
+	:return: (start, end) inclusive, None when the whole file should be sent or False when it can't be satisfied
+	"""
+	match = RANGE_PATTERN.match(header.strip()) if header else None
+	if not match or match.group(1) == match.group(2) == "":
+		return None
+	start, end = match.groups()
+	if start == "":
+		length = int(end)
+		if not length:
+			return False
+		return max(0, size - length), size - 1
+	start = int(start)
+	if end and int(end) < start:
+		# a last byte before the first is invalid, such ranges are ignored
+		return None
+	if start >= size:
+		return False
+	return start, min(int(end), size - 1) if end else size - 1
+
+
+def read_range(file, start: int, length: int):
+	try:
+		file.seek(start)
+		while length > 0:
+			data = file.read(min(BLOCK_SIZE, length))
+			if not data:
+				break
+			length -= len(data)
+			yield data
+	finally:
+		file.close()
+
+
+def serve_file(request, name: str, storage=default_storage, cache_control: str = "private, max-age=86400"):
+	"""
+	Serves a stored file with a strong ETag, Last-Modified, conditional GET and single byte ranges.
+	When ATTACHMENT_ACCEL_REDIRECT is set the front proxy is told to send the file instead
+	"""
+	size = storage.size(name)
+	modified = storage.get_modified_time(name)
+	# stored files are never rewritten in place, so the name, size and mtime identify the content
+	etag = quote_etag(hashlib.sha1(f"{name}:{size}:{modified.timestamp()}".encode()).hexdigest())
+	last_modified = int(modified.timestamp())
+	response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+	if response is None:
+		response = build_file_response(request, storage, name, size, etag)
+	response["ETag"] = etag
+	response["Last-Modified"] = http_date(last_modified)
+	response["Accept-Ranges"] = "bytes"
+	response["Cache-Control"] = cache_control
+	return response
+
+
+def build_file_response(request, storage, name: str, size: int, etag: str):
+	content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+	if settings.ATTACHMENT_ACCEL_REDIRECT:
+		response = HttpResponse(content_type=content_type)
+		response[settings.ATTACHMENT_ACCEL_HEADER] = f"{settings.ATTACHMENT_ACCEL_REDIRECT.rstrip('/')}/{name}"
+		return response
+	byte_range = None
+	if request.META.get("HTTP_IF_RANGE", etag) == etag:
+		byte_range = parse_range(request.META.get("HTTP_RANGE", ""), size)
+	if byte_range is False:
+		response = HttpResponse(status=416)
+		response["Content-Range"] = f"bytes */{size}"
+		return response
+	file = storage.open(name, "rb")
+	if byte_range is None:
+		# FileResponse hands real files to the server's wsgi.file_wrapper, which uses sendfile
+		return FileResponse(file, content_type=content_type)
+	start, end = byte_range
+	response = StreamingHttpResponse(read_range(file, start, end - start + 1), status=206,
+	                                 content_type=content_type)
+	response["Content-Length"] = str(end - start + 1)
+	response["Content-Range"] = f"bytes {start}-{end}/{size}"
+	return response
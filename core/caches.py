@@ -0,0 +1,314 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+MISSING = object()
+
+
+class TTLCache:
+	"""
+	Thread safe in-process LRU cache whose entries also expire after a fixed time to live
+	"""
+	def __init__(self, max_size: int = 10000, ttl: float = 60):
+		self.max_size = max_size
+		self.ttl = ttl
+		self.hits = 0
+		self.misses = 0
+		self._data = OrderedDict()
+		self._lock = threading.Lock()
+
+	def get(self, key, default=MISSING):
+		with self._lock:
+			entry = self._data.get(key)
+			if entry is None or entry[0] < time.monotonic():
+				if entry is not None:
+					del self._data[key]
+				self.misses += 1
+				return default
+			self._data.move_to_end(key)
+			self.hits += 1
+			return entry[1]
+
+	def set(self, key, value):
+		with self._lock:
+			self._data[key] = (time.monotonic() + self.ttl, value)
+			self._data.move_to_end(key)
+			while len(self._data) > self.max_size:
+				self._data.popitem(last=False)
+
+	def get_or_set(self, key, func, keep=None):
+		"""
+			Returns the cached value or the one func loads, which is only cached when keep(value) is true
+		"""
+		value = self.get(key)
+		if value is MISSING:
+			value = func()
+			if keep is None or keep(value):
+				self.set(key, value)
+		return value
+
+	def delete(self, key):
+		with self._lock:
+			self._data.pop(key, None)
+
+	def delete_matching(self, predicate):
+		with self._lock:
+			for key in [key for key, entry in self._data.items() if predicate(key, entry[1])]:
+				del self._data[key]
+
+	def clear(self):
+		with self._lock:
+			self._data.clear()
+			self.hits = 0
+			self.misses = 0
+
+	def stats(self) -> dict:
+		requests = self.hits + self.misses
+		return dict(size=len(self._data), hits=self.hits, misses=self.misses,
+		            hit_rate=round(self.hits / requests, 4) if requests else None)
+
+
+class WebsocketAuthCache:
+	"""
+	Caches what the consumers look up on every connect: token -> (user id, username),
+	(room id, user id) -> membership and room id -> room name.
+	Entries are invalidated by the signals in core.signals, the ttl bounds how stale other processes can be.
+	Misses (unknown tokens and rooms, non members) are not cached, a grant in another process shows at once
+	"""
+	def __init__(self):
+		options = getattr(settings, "WEBSOCKET_AUTH_CACHE", {})
+		max_size = options.get("MAX_SIZE", 10000)
+		ttl = options.get("TTL", 60)
+		self.tokens = TTLCache(max_size, ttl)
+		self.memberships = TTLCache(max_size, ttl)
+		self.rooms = TTLCache(max_size, ttl)
+
+	def get_user(self, token: str):
+		"""
+			Returns the (id, username) of the token owner or None
+		:param token: token key
+		:return:
+		"""
+		from rest_framework.authtoken.models import Token
+
+		def load():
+			return Token.objects.filter(key__exact=token).values_list("user_id", "user__username").first()
+		return self.tokens.get_or_set(token, load, keep=lambda user: user is not None)
+
+	def is_member(self, room_id, user_id) -> bool:
+		from core.models import ChatRoom
+
+		def load():
+			return ChatRoom.members.through.objects.filter(chatroom_id=room_id, user_id=user_id).exists()
+		return self.memberships.get_or_set((int(room_id), int(user_id)), load, keep=bool)
+
+	def get_room_name(self, room_id):
+		from core.models import ChatRoom
+
+		def load():
+			return ChatRoom.objects.filter(id=room_id).values_list("name", flat=True).first()
+		return self.rooms.get_or_set(int(room_id), load, keep=lambda name: name is not None)
+
+	def invalidate_token(self, token: str):
+		self.tokens.delete(token)
+
+	def invalidate_user(self, user_id):
+		self.tokens.delete_matching(lambda key, value: value is not None and value[0] == user_id)
+		self.memberships.delete_matching(lambda key, value: key[1] == user_id)
+
+	def invalidate_membership(self, room_id, user_id):
+		self.memberships.delete((int(room_id), int(user_id)))
+
+	def invalidate_room(self, room_id):
+		self.rooms.delete(int(room_id))
+		self.memberships.delete_matching(lambda key, value: key[0] == room_id)
+
+	def clear(self):
+		self.tokens.clear()
+		self.memberships.clear()
+		self.rooms.clear()
+
+	def stats(self) -> dict:
+		return dict(tokens=self.tokens.stats(), memberships=self.memberships.stats(), rooms=self.rooms.stats())
+
+
+auth_cache = WebsocketAuthCache()
+
+
+def plain(data):
+	"""
+	Copies serializer output into plain dicts and lists, the ReturnDict and ReturnList it is made of
+	would pickle their serializer along
+	"""
+	if isinstance(data, dict):
+		return {key: plain(value) for key, value in data.items()}
+	if isinstance(data, list):
+		return [plain(value) for value in data]
+	return data
+
+
+class RecentMessageCache:
+	"""
+	Ring of the newest RECENT_MESSAGES_CACHE["SIZE"] serialized messages of every room, kept on the django cache
+	so processes sharing a redis cache share it. It serves the newest cursor page of the message list, the fields
+	that depend on the reader or on other readers (viewed, viewers_count) and the host of the urls are overlaid
+	by the view. Attachments turn ready in the celery worker, so the ring is off unless RECENT_MESSAGES_CACHE
+	names a cache every process shares.
+	Each room's ring lives under a version token: appends, attachment changes and deletes update the ring in place
+	under a short lock, anything that can't (no ring, lock taken) replaces the token so a ring filled from the
+	database in the meantime is never read
+	"""
+	LOCK_TIMEOUT = 5
+
+	def __init__(self):
+		self.hits = 0
+		self.misses = 0
+		self._lock = threading.Lock()
+
+	@property
+	def options(self) -> dict:
+		return getattr(settings, "RECENT_MESSAGES_CACHE", {})
+
+	@property
+	def size(self) -> int:
+		return self.options.get("SIZE", 50)
+
+	@property
+	def ttl(self) -> int:
+		return self.options.get("TTL", 3600)
+
+	@property
+	def enabled(self) -> bool:
+		return self.options.get("CACHE") is not None
+
+	@property
+	def cache(self):
+		return caches[self.options["CACHE"]]
+
+	def version(self, room_id) -> str:
+		return self.cache.get_or_set(f"recent_messages:{room_id}:version", uuid.uuid4().hex, None)
+
+	@staticmethod
+	def key(room_id, version: str) -> str:
+		return f"recent_messages:{room_id}:{version}"
+
+	def get(self, room_id) -> dict:
+		"""
+		Returns the ring of a room, loading it from the database on a miss
+		:return: dict(count=messages in the room, messages=[[time sent, id, cursor, data]] oldest first)
+		"""
+		version = self.version(room_id)
+		ring = self.cache.get(self.key(room_id, version))
+		with self._lock:
+			if ring is None:
+				self.misses += 1
+			else:
+				self.hits += 1
+		if ring is None:
+			ring = self.load(room_id)
+			# add, so a ring an append got to first is not overwritten
+			self.cache.add(self.key(room_id, version), ring, self.ttl)
+		return ring
+
+	def load(self, room_id) -> dict:
+		from core.models import ChatMessage
+		messages = ChatMessage.objects.filter(chat_id=room_id).select_related("sender").\
+			prefetch_related("chatattachment_set").order_by("-time_sent", "-id")[:self.size]
+		return dict(count=ChatMessage.objects.filter(chat_id=room_id).count(),
+		            messages=self.serialize(reversed(messages)))
+
+	@staticmethod
+	def serialize(messages) -> list:
+		"""
+		Serializes without a request, so file urls are kept relative to the host
+		"""
+		from core.helpers import KeysetPagination
+		from core.services import ChatMessageListSerializer
+		return [[message.time_sent.isoformat(), message.id, KeysetPagination.encode_cursor(message),
+		         plain(ChatMessageListSerializer(message).data)] for message in messages]
+
+	def update(self, room_id, change):
+		"""
+		Applies change(ring) to the ring of a room under its lock, or drops the ring when it isn't cached
+		or the lock is taken. The ring is only written back when change returns True
+		"""
+		if not self.enabled:
+			return
+		lock = f"recent_messages:{room_id}:lock"
+		if not self.cache.add(lock, 1, self.LOCK_TIMEOUT):
+			return self.invalidate(room_id)
+		try:
+			key = self.key(room_id, self.version(room_id))
+			ring = self.cache.get(key)
+			if ring is None:
+				return self.invalidate(room_id)
+			if change(ring):
+				self.cache.set(key, ring, self.ttl)
+		finally:
+			self.cache.delete(lock)
+
+	def push(self, message, data: dict = None):
+		"""
+		Adds a message that was just created, data is its ChatMessageListSerializer output when already at hand
+		"""
+		if not self.enabled:
+			return
+		if data is None:
+			item = self.serialize([message])[0]
+		else:
+			from core.helpers import KeysetPagination
+			item = [message.time_sent.isoformat(), message.id, KeysetPagination.encode_cursor(message), plain(data)]
+
+		def append(ring):
+			ring["count"] += 1
+			messages = ring["messages"]
+			# concurrent creates can commit out of order, the ring stays sorted like the keyset
+			index = len(messages)
+			while index and messages[index - 1][:2] > item[:2]:
+				index -= 1
+			messages.insert(index, item)
+			del messages[:-self.size]
+			return True
+		self.update(message.chat_id, append)
+
+	def refresh_attachment(self, room_id, message_id, attachment_id, attachment=None):
+		"""
+		Replaces an attachment in the serialized message that holds it, or takes it out when attachment is None
+		"""
+		from core.services import ChatAttachments
+
+		def replace(ring):
+			item = next((item for item in ring["messages"] if item[1] == message_id), None)
+			if item is None:
+				return False
+			attachments = [serialized for serialized in item[3]["attachments"] if serialized["id"] != attachment_id]
+			if attachment is not None:
+				attachments.append(plain(ChatAttachments(attachment).data))
+				attachments.sort(key=lambda serialized: serialized["id"])
+			item[3]["attachments"] = attachments
+			return True
+		self.update(room_id, replace)
+
+	def remove(self, room_id, message_id):
+		def delete(ring):
+			ring["count"] = max(0, ring["count"] - 1)
+			ring["messages"] = [item for item in ring["messages"] if item[1] != message_id]
+			return True
+		self.update(room_id, delete)
+
+	def invalidate(self, room_id):
+		if not self.enabled:
+			return
+		self.cache.set(f"recent_messages:{room_id}:version", uuid.uuid4().hex, None)
+
+	def stats(self) -> dict:
+		requests = self.hits + self.misses
+		return dict(hits=self.hits, misses=self.misses,
+		            hit_rate=round(self.hits / requests, 4) if requests else None)
+
+
+recent_messages = RecentMessageCache()
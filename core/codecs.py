@@ -0,0 +1,205 @@
+import json
+import re
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from rest_framework import renderers, parsers
+from rest_framework.exceptions import ParseError
+from rest_framework.utils.encoders import JSONEncoder as DRFJSONEncoder
+
+try:
+	import orjson
+except ImportError:
+	orjson = None
+
+try:
+	import ujson
+except ImportError:
+	ujson = None
+
+try:
+	import msgpack
+except ImportError:
+	msgpack = None
+
+# Sec-WebSocket-Protocol value of the binary protocol, the same event envelope as MessagePack frames
+MSGPACK_SUBPROTOCOL = "chatclone.msgpack"
+# protocols whose frames are arrays of the events buffered during WEBSOCKET_BATCH["WINDOW_MS"]
+JSON_BATCHED_SUBPROTOCOL = "chatclone.json.batched"
+MSGPACK_BATCHED_SUBPROTOCOL = "chatclone.msgpack.batched"
+
+# orjson and ujson write floats under 1e-4 or from 1e16 differently from json (1e-6 against 1e-06)
+DIVERGENT_NUMBER = re.compile(r"[:,\[]-?(?:\d+(?:\.\d+)?[eE]|0\.0000|\d{17,}\.)")
+
+
+def escape_line_terminators(text: str) -> str:
+	# the same escaping DRF's JSONRenderer does, so the output stays a strict javascript subset
+	return text.replace("\u2028", "\\u2028").replace("\u2029", "\\u2029")
+
+
+class StdlibCodec:
+	"""
+	Compact json with the given encoder class, byte for byte what DRF's JSONRenderer produces for DRFJSONEncoder
+	"""
+	name = "json"
+
+	@staticmethod
+	def dumps(obj, encoder=DRFJSONEncoder) -> str:
+		return escape_line_terminators(json.dumps(obj, cls=encoder, ensure_ascii=False, allow_nan=False,
+		                                          separators=(",", ":")))
+
+	@classmethod
+	def dumps_bytes(cls, obj, encoder=DRFJSONEncoder) -> bytes:
+		return cls.dumps(obj, encoder).encode()
+
+	@staticmethod
+	def loads(data):
+		return json.loads(data, parse_constant=reject_constant)
+
+
+class OrjsonCodec(StdlibCodec):
+	"""
+	orjson with datetimes and every type it doesn't know handed to the encoder class, so they come out exactly
+	as they do through the stdlib codec. Plain floats under 1e-4 or from 1e16 are written in orjson's own
+	exponent form, decimals that would be are left to the stdlib codec
+	"""
+	name = "orjson"
+
+	@classmethod
+	def dumps(cls, obj, encoder=DRFJSONEncoder) -> str:
+		return cls.dumps_bytes(obj, encoder).decode()
+
+	@staticmethod
+	def dumps_bytes(obj, encoder=DRFJSONEncoder) -> bytes:
+		try:
+			content = orjson.dumps(obj, default=encoder_default(encoder),
+			                       option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS)
+		except orjson.JSONEncodeError:
+			# a divergent decimal, an integer over 64 bits or a real error the stdlib codec will raise
+			return StdlibCodec.dumps_bytes(obj, encoder)
+		if b"\xe2\x80\xa8" in content or b"\xe2\x80\xa9" in content:
+			content = escape_line_terminators(content.decode()).encode()
+		return content
+
+	@staticmethod
+	def loads(data):
+		return orjson.loads(data)
+
+
+class UjsonCodec(StdlibCodec):
+	"""
+	ujson encodes Decimal natively as a number, which only matches DRF's encoder, other encoder classes go through
+	the stdlib codec. It can't be told apart from a float, so output with a divergent number is encoded again
+	by the stdlib codec, text that merely looks like one only costs that re-encode
+	"""
+	name = "ujson"
+
+	@classmethod
+	def dumps(cls, obj, encoder=DRFJSONEncoder) -> str:
+		if encoder is not DRFJSONEncoder:
+			return StdlibCodec.dumps(obj, encoder)
+		try:
+			content = ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False, reject_bytes=False,
+			                      default=encoder_default(encoder))
+		except OverflowError:
+			return StdlibCodec.dumps(obj, encoder)
+		if DIVERGENT_NUMBER.search(content):
+			return StdlibCodec.dumps(obj, encoder)
+		return escape_line_terminators(content)
+
+	@staticmethod
+	def loads(data):
+		return ujson.loads(data)
+
+
+def reject_constant(constant):
+	raise ValueError(f"Invalid JSON constant {constant}")
+
+
+@lru_cache(maxsize=None)
+def encoder_default(encoder):
+	"""
+	The default method of an encoder class for the accelerated codecs, a decimal that becomes
+	a divergent float raises so the document is encoded by the stdlib codec
+	"""
+	default = encoder().default
+
+	def accelerated_default(obj):
+		value = default(obj)
+		if isinstance(value, float) and DIVERGENT_NUMBER.match(f",{value!r}"):
+			raise TypeError(f"{value!r} is written differently by the stdlib codec")
+		return value
+	return accelerated_default
+
+
+CODECS = {codec.name: codec for codec in (OrjsonCodec, UjsonCodec, StdlibCodec)}
+AVAILABLE = {"orjson": orjson is not None, "ujson": ujson is not None, "json": True}
+
+
+def get_codec(name: str = None):
+	"""
+	Returns the codec named by the JSON_CODEC setting. "auto" picks orjson when it is importable and the stdlib
+	otherwise, ujson has to be asked for since checking its output makes it encode slower than the stdlib
+	"""
+	name = name or settings.JSON_CODEC
+	if name == "auto":
+		name = "orjson" if AVAILABLE["orjson"] else "json"
+	if not AVAILABLE.get(name):
+		raise ValueError(f"JSON codec {name} is not available")
+	return CODECS[name]
+
+
+def dumps(obj, encoder=DjangoJSONEncoder) -> str:
+	"""
+	Encodes a websocket frame with the configured codec
+	"""
+	return get_codec().dumps(obj, encoder)
+
+
+def loads(data):
+	return get_codec().loads(data)
+
+
+@lru_cache(maxsize=256)
+def json_to_msgpack(text: str) -> bytes:
+	"""
+	Transcodes a group event for a MessagePack socket, cached since every socket
+	of the group in this process gets the same text
+	"""
+	return msgpack.packb(get_codec().loads(text))
+
+
+def msgpack_to_python(data: bytes):
+	return msgpack.unpackb(data)
+
+
+def msgpack_array(items) -> bytes:
+	"""
+	Joins already packed items into a MessagePack array without unpacking them
+	"""
+	return msgpack.Packer().pack_array_header(len(items)) + b"".join(items)
+
+
+class FastJSONRenderer(renderers.JSONRenderer):
+	"""
+	JSONRenderer that encodes with the configured codec, indented output still goes through DRF
+	"""
+	def render(self, data, accepted_media_type=None, renderer_context=None):
+		if data is None:
+			return b""
+		renderer_context = renderer_context or {}
+		if self.get_indent(accepted_media_type, renderer_context) or self.encoder_class is not DRFJSONEncoder \
+				or not self.compact or self.ensure_ascii or not self.strict:
+			return super().render(data, accepted_media_type, renderer_context)
+		return get_codec().dumps_bytes(data, self.encoder_class)
+
+
+class FastJSONParser(parsers.JSONParser):
+	renderer_class = FastJSONRenderer
+
+	def parse(self, stream, media_type=None, parser_context=None):
+		try:
+			return get_codec().loads(stream.read())
+		except ValueError as exc:
+			raise ParseError(f"JSON parse error - {exc}")
@@ -1,19 +1,204 @@
-import json
+import asyncio
 import logging
 import os
 
 import django
+from django.conf import settings
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "ChatClone.settings")
 django.setup()
 from asgiref.sync import async_to_sync  # noqa
-from channels.generic.websocket import WebsocketConsumer  # noqa
-from rest_framework.authtoken.models import Token  # noqa
+from channels.db import database_sync_to_async  # noqa
+from channels.generic.websocket import WebsocketConsumer, AsyncWebsocketConsumer  # noqa
 
+from core import codecs  # noqa
+from core.caches import auth_cache  # noqa
 from core.models import User, ChatRoom  # noqa
+from core.send_queues import SendQueue  # noqa
 
 
-class ChatConsumer(WebsocketConsumer):
+def get_token_user(token: str) -> User or None:
+	"""
+	Resolves a token to an unsaved User carrying just the id and username, through the auth cache
+	"""
+	cached = auth_cache.get_user(token)
+	if not cached:
+		return None
+	user_id, username = cached
+	return User(id=user_id, username=username)
+
+
+def check_envelope(text: str, user_id) -> str or None:
+	"""
+	Checks an inbound frame is a {"event": str, "data": ..., "sender": optional} object, decoding it once
+	and never re-encoding it, so group members get the exact text the client sent
+	:param text: the frame
+	:param user_id: id of the connected user, a sender field must match it
+	:return: the frame to forward, None when it is rejected
+	"""
+	if not text or len(text) > settings.WEBSOCKET_MAX_FRAME_BYTES or text.lstrip()[:1] != "{":
+		return None
+	try:
+		envelope = codecs.loads(text)
+	except ValueError:
+		return None
+	return text if valid_envelope(envelope, user_id) else None
+
+
+def check_binary_envelope(data: bytes, user_id) -> str or None:
+	"""
+	Checks a MessagePack frame holds a valid envelope
+	:return: the envelope as json text for the group, None when it is rejected
+	"""
+	if not data or len(data) > settings.WEBSOCKET_MAX_FRAME_BYTES or not codecs.msgpack:
+		return None
+	try:
+		envelope = codecs.msgpack_to_python(data)
+	except (ValueError, TypeError):
+		return None
+	if not isinstance(envelope, dict) or not valid_envelope(envelope, user_id):
+		return None
+	try:
+		return codecs.dumps(envelope)
+	except (ValueError, TypeError):
+		# bin and ext values have no json form
+		return None
+
+
+def valid_envelope(envelope: dict, user_id) -> bool:
+	if not isinstance(envelope.get("event"), str) or "data" not in envelope:
+		return False
+	return envelope.get("sender") in (None, user_id, str(user_id))
+
+
+def reject_frame(user):
+	logging.warning(f"dropped an invalid websocket frame from {user}")
+
+
+class EnvelopeProtocol:
+	"""
+	Frames the event envelope as json text, or as MessagePack binary frames when the client asks for
+	MSGPACK_SUBPROTOCOL through Sec-WebSocket-Protocol. On the batched protocols the events of a
+	WEBSOCKET_BATCH window are sent together as one array frame. Everything sent goes through
+	a SendQueue bounded by WEBSOCKET_SEND_QUEUE
+	"""
+	binary = False
+	batched = False
+
+	async def __call__(self, scope, receive, send):
+		self.send_queue = SendQueue(send)
+		try:
+			await super().__call__(scope, receive, self.send_queue.put)
+		finally:
+			self.send_queue.stop()
+
+	def select_subprotocol(self) -> str or None:
+		supported = {codecs.JSON_BATCHED_SUBPROTOCOL}
+		if codecs.msgpack:
+			supported.update((codecs.MSGPACK_SUBPROTOCOL, codecs.MSGPACK_BATCHED_SUBPROTOCOL))
+		for subprotocol in self.scope.get("subprotocols", ()):
+			if subprotocol in supported:
+				self.binary = subprotocol.startswith(codecs.MSGPACK_SUBPROTOCOL)
+				self.batched = subprotocol.endswith(".batched")
+				self.batch = []
+				self.batch_bytes = 0
+				self.flush_armed = False
+				return subprotocol
+		return None
+
+	def inbound_frame(self, data) -> str or None:
+		"""
+		:return: the json text to send to the group, None when the frame is rejected
+		"""
+		if data.get("bytes") is not None:
+			text = check_binary_envelope(data["bytes"], self.user.id)
+		else:
+			text = check_envelope(data.get("text"), self.user.id)
+		if text is None:
+			reject_frame(self.user)
+		return text
+
+	def outbound_frame(self, event) -> dict:
+		if self.binary:
+			return {"bytes_data": codecs.json_to_msgpack(event["data"])}
+		return {"text_data": event["data"]}
+
+	def buffer_event(self, event) -> dict or None:
+		"""
+		Adds a group event to the batch
+		:return: the array frame to send now when the batch is full
+		"""
+		frame = codecs.json_to_msgpack(event["data"]) if self.binary else event["data"]
+		self.batch.append(frame)
+		self.batch_bytes += len(frame)
+		options = settings.WEBSOCKET_BATCH
+		if len(self.batch) >= options["MAX_EVENTS"] or self.batch_bytes >= options["MAX_BYTES"]:
+			return self.take_batch()
+		return None
+
+	def take_batch(self) -> dict or None:
+		batch = self.batch
+		if not batch:
+			return None
+		self.batch = []
+		self.batch_bytes = 0
+		if self.binary:
+			return {"bytes_data": codecs.msgpack_array(batch)}
+		# the events are json already, so the array is joined instead of encoded
+		return {"text_data": f"[{','.join(batch)}]"}
+
+	async def arm_flush(self):
+		"""
+		Has the window end come back through the channel layer as a flush_frames message,
+		so the batch is only ever touched by the consumer's own handlers
+		"""
+		self.flush_armed = True
+		loop = asyncio.get_running_loop()
+		loop.call_later(settings.WEBSOCKET_BATCH["WINDOW_MS"] / 1000, lambda: loop.create_task(
+			self.channel_layer.send(self.channel_name, {"type": "flush_frames"})))
+
+
+class EnvelopeSender:
+	"""
+	The group event handlers of the sync consumers, an event is sent as soon as it arrives or added to the batch
+	"""
+	def notify(self, event):
+		if not self.batched:
+			return self.send(**self.outbound_frame(event))
+		frame = self.buffer_event(event)
+		if frame:
+			self.send(**frame)
+		elif not self.flush_armed:
+			async_to_sync(self.arm_flush)()
+
+	def flush_frames(self, event):
+		self.flush_armed = False
+		frame = self.take_batch()
+		if frame:
+			self.send(**frame)
+
+
+class AsyncEnvelopeSender:
+	"""
+	Async version of EnvelopeSender
+	"""
+	async def notify(self, event):
+		if not self.batched:
+			return await self.send(**self.outbound_frame(event))
+		frame = self.buffer_event(event)
+		if frame:
+			await self.send(**frame)
+		elif not self.flush_armed:
+			await self.arm_flush()
+
+	async def flush_frames(self, event):
+		self.flush_armed = False
+		frame = self.take_batch()
+		if frame:
+			await self.send(**frame)
+
+
+class ChatConsumer(EnvelopeProtocol, EnvelopeSender, WebsocketConsumer):
 	"""
 	This namespace handles all connections to individual chat rooms
 	"""
@@ -26,39 +211,35 @@ class ChatConsumer(WebsocketConsumer):
 	def is_authenticated(scope) -> User or None:
 		token = scope["url_route"]["kwargs"]["token"]
 		chat_id = scope['url_route']["kwargs"]["chat_id"]
-		token_obj = Token.objects.filter(key__exact=token).first()
-		if not token_obj:
+		user = get_token_user(token)
+		if not user or not str(chat_id).isdigit():
 			return None
-		user = token_obj.user
-		chat = ChatRoom.objects.filter(id=chat_id).first()
-		if not chat.members.filter(id=user.id).exists():
+		if not auth_cache.is_member(chat_id, user.id):
 			return None
+		chat = ChatRoom(id=int(chat_id), name=auth_cache.get_room_name(chat_id))
 		return chat, user
 
 	def connect(self):
-		self.chat, self.user = self.is_authenticated(self.scope)
-		if not self.user:
+		authenticated = self.is_authenticated(self.scope)
+		if not authenticated:
 			logging.critical("Authentication Refused")
 			self.close()
 			return
+		self.chat, self.user = authenticated
 		async_to_sync(self.channel_layer.group_add)(str(self.chat), self.channel_name)
-		self.accept()
+		self.accept(self.select_subprotocol())
 		self.send(f"{self.user.username} just connected to {self.chat.name}")
 
 	def websocket_receive(self, data):
-		data = json.loads(data["text"])
+		text = self.inbound_frame(data)
+		if text is None:
+			return
 		async_to_sync(self.channel_layer.group_send)(
-			str(self.chat), {"type": "notify", "data": json.dumps(data)}
+			str(self.chat), {"type": "notify", "data": text, "group": str(self.chat)}
 		)
 
-	def notify(self, event):
-		self.send(text_data=event["data"])
-
-	def disconnect(self, code):
-		super().disconnect(code)
 
-
-class GeneralConsumer(WebsocketConsumer):
+class GeneralConsumer(EnvelopeProtocol, EnvelopeSender, WebsocketConsumer):
 	"""
 	This name space handles all connections to the general channel which everyone has access to
 	"""
@@ -69,10 +250,7 @@ class GeneralConsumer(WebsocketConsumer):
 	@staticmethod
 	def is_authenticated(scope) -> User or None:
 		token = scope["url_route"]["kwargs"]["token"]
-		token_obj = Token.objects.filter(key__exact=token).first()
-		if not token_obj:
-			return None
-		return token_obj.user
+		return get_token_user(token)
 
 	def connect(self):
 		self.user = self.is_authenticated(self.scope)
@@ -80,23 +258,19 @@ class GeneralConsumer(WebsocketConsumer):
 			logging.critical("Authentication Refused")
 			return
 		async_to_sync(self.channel_layer.group_add)("general", self.channel_name)
-		self.accept()
+		self.accept(self.select_subprotocol())
 		self.send(f"{self.user.username} just connected to general channel")
 
 	def websocket_receive(self, data):
-		data = json.loads(data["text"])
+		text = self.inbound_frame(data)
+		if text is None:
+			return
 		async_to_sync(self.channel_layer.group_send)(
-			"general", {"type": "notify", "data": json.dumps(data)}
+			"general", {"type": "notify", "data": text, "group": "general"}
 		)
 
-	def notify(self, event):
-		self.send(text_data=event["data"])
 
-	def disconnect(self, code):
-		super().disconnect(code)
-
-
-class PrivateConsumer(WebsocketConsumer):
+class PrivateConsumer(EnvelopeProtocol, EnvelopeSender, WebsocketConsumer):
 	"""
 	This namespace handles all connections to personal channels, messages sent only to users themselves
 	"""
@@ -108,10 +282,7 @@ class PrivateConsumer(WebsocketConsumer):
 	@staticmethod
 	def is_authenticated(scope) -> User or None:
 		token = scope["url_route"]["kwargs"]["token"]
-		token_obj = Token.objects.filter(key__exact=token).first()
-		if not token_obj:
-			return None
-		return token_obj.user
+		return get_token_user(token)
 
 	def connect(self):
 		self.user = self.is_authenticated(self.scope)
@@ -120,17 +291,195 @@ class PrivateConsumer(WebsocketConsumer):
 			self.close()
 			return
 		async_to_sync(self.channel_layer.group_add)(str(self.user), self.channel_name)
-		self.accept()
+		self.accept(self.select_subprotocol())
 		self.send(f"{self.user.username} just connected to private channel")
 
 	def websocket_receive(self, data):
-		data = json.loads(data["text"])
+		text = self.inbound_frame(data)
+		if text is None:
+			return
 		async_to_sync(self.channel_layer.group_send)(
-			str(self.user), {"type": "notify", "data": json.dumps(data)}
+			str(self.user), {"type": "notify", "data": text, "group": str(self.user)}
 		)
 
-	def notify(self, event):
-		self.send(text_data=event["data"])
 
-	def disconnect(self, code):
-		super().disconnect(code)
+class AsyncChatConsumer(EnvelopeProtocol, AsyncEnvelopeSender, AsyncWebsocketConsumer):
+	"""
+	Async version of ChatConsumer, connections are served on the event loop instead of the threadpool
+	"""
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.user = None
+		self.chat = None
+
+	async def connect(self):
+		authenticated = await database_sync_to_async(ChatConsumer.is_authenticated)(self.scope)
+		if not authenticated:
+			logging.critical("Authentication Refused")
+			await self.close()
+			return
+		self.chat, self.user = authenticated
+		await self.channel_layer.group_add(str(self.chat), self.channel_name)
+		await self.accept(self.select_subprotocol())
+		await self.send(f"{self.user.username} just connected to {self.chat.name}")
+
+	async def websocket_receive(self, data):
+		text = self.inbound_frame(data)
+		if text is None:
+			return
+		await self.channel_layer.group_send(
+			str(self.chat), {"type": "notify", "data": text, "group": str(self.chat)}
+		)
+
+
+class AsyncGeneralConsumer(EnvelopeProtocol, AsyncEnvelopeSender, AsyncWebsocketConsumer):
+	"""
+	Async version of GeneralConsumer
+	"""
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.user = None
+
+	async def connect(self):
+		self.user = await database_sync_to_async(GeneralConsumer.is_authenticated)(self.scope)
+		if not self.user:
+			logging.critical("Authentication Refused")
+			await self.close()
+			return
+		await self.channel_layer.group_add("general", self.channel_name)
+		await self.accept(self.select_subprotocol())
+		await self.send(f"{self.user.username} just connected to general channel")
+
+	async def websocket_receive(self, data):
+		text = self.inbound_frame(data)
+		if text is None:
+			return
+		await self.channel_layer.group_send(
+			"general", {"type": "notify", "data": text, "group": "general"}
+		)
+
+
+class AsyncPrivateConsumer(EnvelopeProtocol, AsyncEnvelopeSender, AsyncWebsocketConsumer):
+	"""
+	Async version of PrivateConsumer
+	"""
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.user = None
+
+	async def connect(self):
+		self.user = await database_sync_to_async(PrivateConsumer.is_authenticated)(self.scope)
+		if not self.user:
+			logging.critical("Authentication Refused")
+			await self.close()
+			return
+		await self.channel_layer.group_add(str(self.user), self.channel_name)
+		await self.accept(self.select_subprotocol())
+		await self.send(f"{self.user.username} just connected to private channel")
+
+	async def websocket_receive(self, data):
+		text = self.inbound_frame(data)
+		if text is None:
+			return
+		await self.channel_layer.group_send(
+			str(self.user), {"type": "notify", "data": text, "group": str(self.user)}
+		)
+
+
+class MultiplexConsumer(EnvelopeProtocol, AsyncEnvelopeSender, AsyncWebsocketConsumer):
+	"""
+	One socket per client in place of the general, private and per room sockets. The user is authenticated once
+	and joined to general and private, rooms are added and removed with {"action": "subscribe", "chat": id}
+	and {"action": "unsubscribe", "chat": id}. Events arrive tagged with their channel as
+	{"channel": "chats/<id>", "payload": event} and {"channel": ..., "payload": envelope} frames publish to one
+	"""
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.user = None
+		# group name -> channel tag of everything the socket is subscribed to
+		self.subscriptions = {}
+
+	async def connect(self):
+		self.user = await database_sync_to_async(GeneralConsumer.is_authenticated)(self.scope)
+		if not self.user:
+			logging.critical("Authentication Refused")
+			await self.close()
+			return
+		for group, channel in (("general", "general"), (str(self.user), "private")):
+			await self.channel_layer.group_add(group, self.channel_name)
+			self.subscriptions[group] = channel
+		await self.accept(self.select_subprotocol())
+		await self.send(f"{self.user.username} just connected")
+
+	async def websocket_receive(self, data):
+		message = self.decode_frame(data)
+		if message is None:
+			return reject_frame(self.user)
+		if message.get("action") in ("subscribe", "unsubscribe"):
+			return await self.change_subscription(message["action"], message.get("chat"))
+		group = self.group_of(message.get("channel"))
+		payload = message.get("payload")
+		if group is None or not isinstance(payload, dict) or not valid_envelope(payload, self.user.id):
+			return reject_frame(self.user)
+		try:
+			text = codecs.dumps(payload)
+		except (ValueError, TypeError):
+			return reject_frame(self.user)
+		await self.channel_layer.group_send(group, {"type": "notify", "data": text, "group": group})
+
+	@staticmethod
+	def decode_frame(data) -> dict or None:
+		frame = data.get("bytes") if data.get("bytes") is not None else data.get("text")
+		if not frame or len(frame) > settings.WEBSOCKET_MAX_FRAME_BYTES:
+			return None
+		try:
+			if isinstance(frame, bytes):
+				message = codecs.msgpack_to_python(frame) if codecs.msgpack else None
+			else:
+				message = codecs.loads(frame)
+		except (ValueError, TypeError):
+			return None
+		return message if isinstance(message, dict) else None
+
+	def group_of(self, channel) -> str or None:
+		for group, subscribed in self.subscriptions.items():
+			if subscribed == channel:
+				return group
+		return None
+
+	async def change_subscription(self, action: str, chat_id):
+		"""
+		Adds or removes the socket from a room's group, rooms the user is not a member of are refused
+		"""
+		chat_id = str(chat_id)
+		if not chat_id.isdigit() or not await database_sync_to_async(auth_cache.is_member)(chat_id, self.user.id):
+			return await self.reply(action, chat_id, error="Not a member of this chat")
+		group = str(ChatRoom(id=int(chat_id)))
+		if action == "subscribe":
+			await self.channel_layer.group_add(group, self.channel_name)
+			self.subscriptions[group] = f"chats/{chat_id}"
+		elif self.subscriptions.pop(group, None):
+			await self.channel_layer.group_discard(group, self.channel_name)
+		await self.reply(action, chat_id)
+
+	async def reply(self, action: str, chat_id: str, error: str = None):
+		# control replies skip the batch, the client waits on them
+		reply = dict(action=action, chat=int(chat_id) if chat_id.isdigit() else chat_id, ok=error is None)
+		if error:
+			reply["error"] = error
+		await self.send(**self.outbound_frame({"data": codecs.dumps(reply)}))
+
+	def tag_event(self, event) -> dict:
+		channel = self.subscriptions.get(event.get("group"))
+		if channel is None:
+			return event
+		# the event is json already, so it is wrapped instead of encoded again
+		return {"data": f'{{"channel":"{channel}","payload":{event["data"]}}}'}
+
+	async def notify(self, event):
+		await super().notify(self.tag_event(event))
+
+	async def disconnect(self, code):
+		for group in self.subscriptions:
+			await self.channel_layer.group_discard(group, self.channel_name)
+		self.subscriptions = {}
@@ -1,18 +1,34 @@
+from collections import defaultdict
+
+from django.conf import settings
 from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
 from drf_yasg import openapi
 from drf_yasg.utils import swagger_auto_schema
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError, NotFound
 from rest_framework.generics import ListAPIView, CreateAPIView
+from rest_framework.mixins import CreateModelMixin, RetrieveModelMixin
 from rest_framework.parsers import MultiPartParser
-from rest_framework.permissions import IsAuthenticated, AllowAny
+from rest_framework.permissions import IsAuthenticated, AllowAny, IsAdminUser
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from rest_framework.viewsets import ModelViewSet
-
-from core.helpers import send_ws_to_private
-from core.models import ChatRoom, ChatMessage
+from rest_framework.viewsets import ModelViewSet, GenericViewSet
+
+from core.attachments import save_chunk, serve_file
+from core.caches import auth_cache, recent_messages
+from core.exports import NDJSON_CONTENT_TYPE, GZIP_CONTENT_TYPE
+from core.helpers import send_ws_to_private, MessagePagination, KeysetPagination
+from core.search import get_backend, parse_terms, encode_cursor, decode_cursor
+from core.send_queues import send_queue_metrics
+from core.thumbnails import load_spec, get_derivative
+from core.models import ChatRoom, ChatMessage, User, RoomReadState, UploadSession, UploadChunk, ChatAttachment, \
+	RoomExport
 from core.services import ChatMessageSerializer, CreateMessageSerializer, CreateChatRoomSerializer, \
 	ChatRoomSerializer, ChatActionSerializer, LoginSerializer, SignupSerializer, UserSerializer, \
-	ChatMessageListSerializer
+	ChatMessageListSerializer, UploadSessionSerializer, FinalizeUploadSerializer, RoomExportSerializer
+from core.tasks import queue_room_export
 
 
 # Create your views here.
@@ -81,8 +97,13 @@ class ChatRoomAPI(ModelViewSet):
 	http_method_names = ("get", "put", "post")
 	serializer_class = ChatRoomSerializer
 
+	compress = openapi.Parameter("compress", in_=openapi.IN_QUERY, type=openapi.TYPE_STRING, enum=["gzip"],
+	                             description="gzip the export")
+
 	def get_queryset(self):
-		return self.queryset.filter(members__username=self.request.user.username)
+		return self.queryset.filter(members__username=self.request.user.username).\
+			annotate(unread=RoomReadState.unread_count_subquery(self.request.user.id)).\
+			prefetch_related("admins", "members")
 
 	def get_serializer_context(self):
 		data = super(ChatRoomAPI, self).get_serializer_context()
@@ -131,6 +152,61 @@ class ChatRoomAPI(ModelViewSet):
 	def retrieve(self, request, *args, **kwargs):
 		return super(ChatRoomAPI, self).retrieve(request, *args, **kwargs)
 
+	@swagger_auto_schema(
+		manual_parameters=[compress],
+		operation_summary="starts an export of the whole history of a chatroom as newline delimited json, "
+		                  "an EXPORT READY event on the private socket links its download",
+		tags=[
+			"ChatRoom",
+		],
+		responses={200: RoomExportSerializer()}
+	)
+	@action(detail=True, methods=["post"])
+	def export(self, request, *args, **kwargs):
+		room = self.get_object()
+		export = RoomExport.objects.create(user=request.user, room=room,
+		                                   compressed=request.query_params.get("compress") == "gzip")
+		queue_room_export(export)
+		# built already when tasks run eagerly
+		export.refresh_from_db()
+		return Response(RoomExportSerializer(export).data)
+
+
+class RoomExportAPI(RetrieveModelMixin, GenericViewSet):
+	permission_classes = (IsAuthenticated,)
+	queryset = RoomExport.objects.all()
+	serializer_class = RoomExportSerializer
+
+	def get_queryset(self):
+		return self.queryset.filter(user_id=self.request.user.id)
+
+	@swagger_auto_schema(
+		operation_summary="shows whether a room export is ready",
+		tags=[
+			"ChatRoom",
+		],
+	)
+	def retrieve(self, request, *args, **kwargs):
+		return super(RoomExportAPI, self).retrieve(request, *args, **kwargs)
+
+	@swagger_auto_schema(
+		operation_summary="downloads a ready room export, supports byte ranges and conditional requests",
+		tags=[
+			"ChatRoom",
+		],
+	)
+	@action(detail=True, methods=["get"])
+	def download(self, request, *args, **kwargs):
+		export = self.get_object()
+		# the history is only handed out while the user is still in the room
+		if export.status != RoomExport.READY or not auth_cache.is_member(export.room_id, request.user.id):
+			raise NotFound()
+		response = serve_file(request, export.stored_file)
+		if response.status_code in (200, 206):
+			response["Content-Type"] = GZIP_CONTENT_TYPE if export.compressed else NDJSON_CONTENT_TYPE
+		response["Content-Disposition"] = f'attachment; filename="{export.file_name}"'
+		return response
+
 
 class ChatMessageAPI(ModelViewSet):
 	permission_classes = (IsAuthenticated,)
@@ -138,8 +214,23 @@ class ChatMessageAPI(ModelViewSet):
 	http_method_names = ("get", "post")
 	serializer_class = ChatMessageListSerializer
 	parser_classes = (MultiPartParser,)
+	pagination_class = MessagePagination
 
 	chat_id = openapi.Parameter("chat_id", in_=openapi.IN_QUERY, type=openapi.TYPE_NUMBER)
+	before = openapi.Parameter("before", in_=openapi.IN_QUERY, type=openapi.TYPE_STRING,
+	                           description="cursor, returns the messages sent before it")
+	after = openapi.Parameter("after", in_=openapi.IN_QUERY, type=openapi.TYPE_STRING,
+	                          description="cursor, returns the messages sent after it")
+	count = openapi.Parameter("count", in_=openapi.IN_QUERY, type=openapi.TYPE_BOOLEAN,
+	                          description="include the total count with cursor pagination")
+	query = openapi.Parameter("q", in_=openapi.IN_QUERY, type=openapi.TYPE_STRING, required=True,
+	                          description="words the messages must contain, the last one may be the start of a word")
+	search_after = openapi.Parameter("after", in_=openapi.IN_QUERY, type=openapi.TYPE_STRING,
+	                                 description="cursor from next, returns the results that follow it")
+
+	# relations the message serializers read, loaded up front so a page costs a fixed number of queries
+	select_related = ("sender",)
+	prefetch_related = ("chatattachment_set",)
 
 	def get_serializer_context(self):
 		data = super(ChatMessageAPI, self).get_serializer_context()
@@ -154,7 +245,13 @@ class ChatMessageAPI(ModelViewSet):
 			return self.queryset.none()
 		if not ChatRoom.objects.filter(id=chat_id, members__username=self.request.user.username).exists():
 			return self.queryset.none()
-		return self.queryset.filter(chat_id=chat_id)
+		return self.apply_prefetch_plan(self.queryset.filter(chat_id=chat_id))
+
+	def apply_prefetch_plan(self, queryset):
+		watermark = RoomReadState.objects.filter(user_id=self.request.user.id, room_id=OuterRef("chat_id"),
+		                                         last_read_message_id__gte=OuterRef("id"))
+		return queryset.select_related(*self.select_related).prefetch_related(*self.prefetch_related).\
+			annotate(viewed_by_user=Exists(watermark))
 
 	@swagger_auto_schema(
 		request_body=CreateMessageSerializer,
@@ -163,7 +260,6 @@ class ChatMessageAPI(ModelViewSet):
 			"ChatRoom",
 		],
 	)
-	@transaction.atomic
 	def create(self, request, *args, **kwargs):
 		serializer = CreateMessageSerializer(data=request.data, context={"user": request.user,
 		                                                                 "files": request.FILES})
@@ -172,26 +268,132 @@ class ChatMessageAPI(ModelViewSet):
 		return Response(ChatMessageSerializer(message, context={"user": request.user}).data)
 
 	@swagger_auto_schema(
-		manual_parameters=[chat_id, ],
+		manual_parameters=[chat_id, before, after, count],
 		operation_summary="enables a user view chat messages",
 		tags=[
 			"ChatRoom",
 		],
 	)
 	def list(self, request, *args, **kwargs):
+		cached = self.list_recent(request)
+		if cached is not None:
+			return cached
 		queryset = self.filter_queryset(self.get_queryset())
 
 		page = self.paginate_queryset(queryset)
-		ids = (data.id for data in page)
-		messages = queryset.filter(id__in=ids).exclude(viewers__username=self.request.user.username).\
-		                                       exclude(sender=self.request.user)
-		for message in messages:
-			message.view(user=request.user)
-			send_ws_to_private(user=message.sender, event="NEW MESSAGE VIEWER",
-			                   data=ChatMessageListSerializer(message).data)
+		viewed = ChatMessage.view_many(page, request.user)
+		for message in viewed:
+			message.viewed_by_user = True
+			message.viewers_count += 1
+		self.notify_viewed(request.user, viewed)
 		serializer = self.get_serializer(page, many=True)
 		return self.get_paginated_response(serializer.data)
 
+	def list_recent(self, request):
+		"""
+		Serves the newest cursor page from the recent messages cache, overlaying what depends on the reader
+		:return: the response, or None when the page has to come from the database
+		"""
+		params = request.query_params
+		chat_id = params.get("chat_id", "")
+		if not recent_messages.enabled or params.get("pagination") != "cursor" or "before" in params \
+				or "after" in params or not chat_id.isdigit() or settings.READ_RECEIPT_PER_MESSAGE_EVENTS:
+			return None
+		paginator = KeysetPagination()
+		page_size = paginator.get_page_size(request)
+		if page_size > recent_messages.size:
+			return None
+		if not ChatRoom.objects.filter(id=chat_id, members__username=request.user.username).exists():
+			return None
+		ring = recent_messages.get(chat_id)
+		items = ring["messages"][-page_size:]
+		if len(items) < min(page_size, ring["count"]):
+			# deletes left the ring short, it is filled again on the next request
+			recent_messages.invalidate(chat_id)
+			return None
+		messages = [ChatMessage(id=item[1], chat_id=int(chat_id), sender_id=(item[3]["sender"] or {}).get("id"))
+		            for item in items]
+		self.notify_viewed(request.user, ChatMessage.view_many(messages, request.user))
+		# read after view_many, which counted this reader
+		viewers = dict(ChatMessage.objects.filter(id__in=[message.id for message in messages]).
+		               values_list("id", "viewers_count"))
+		# every message on the page is under the reader's watermark now
+		data = [dict(item[3], viewed=message.sender_id != request.user.id,
+		             viewers_count=viewers.get(message.id, item[3]["viewers_count"]),
+		             sender=self.absolute_sender(request, item[3]["sender"]))
+		        for item, message in zip(items, messages)]
+		paginator.previous = items[0][2] if items and ring["count"] > len(items) else None
+		if params.get("count") == "true":
+			paginator.count = ring["count"]
+		return paginator.get_paginated_response(data)
+
+	@staticmethod
+	def absolute_sender(request, sender: dict or None) -> dict or None:
+		"""
+		The ring is serialized without a request, its profile picture url gets the host here like the
+		serializer gives it one when it has the request
+		"""
+		if not sender or not sender.get("profile_picture"):
+			return sender
+		return dict(sender, profile_picture=request.build_absolute_uri(sender["profile_picture"]))
+
+	@staticmethod
+	def notify_viewed(viewer, messages):
+		"""
+		sends one MESSAGES VIEWED event to each sender whose messages were just viewed,
+		the old per message NEW MESSAGE VIEWER events are only sent when READ_RECEIPT_PER_MESSAGE_EVENTS is on
+		"""
+		viewed = defaultdict(list)
+		for message in messages:
+			if message.sender_id:
+				viewed[message.sender_id].append(message)
+		if not viewed:
+			return
+		viewer = UserSerializer(viewer).data
+		for sender in User.objects.filter(id__in=viewed.keys()):
+			send_ws_to_private(user=sender, event="MESSAGES VIEWED",
+			                   data=dict(chat=viewed[sender.id][0].chat_id, viewer=viewer,
+			                             messages=[message.id for message in viewed[sender.id]]))
+			if settings.READ_RECEIPT_PER_MESSAGE_EVENTS:
+				for message in viewed[sender.id]:
+					send_ws_to_private(user=sender, event="NEW MESSAGE VIEWER",
+					                   data=ChatMessageListSerializer(message).data)
+
+	@swagger_auto_schema(
+		manual_parameters=[query, chat_id, search_after],
+		operation_summary="searches the messages of the rooms a user is a member of, best matches first",
+		tags=[
+			"ChatRoom",
+		],
+	)
+	@action(detail=False, methods=["get"])
+	def search(self, request, *args, **kwargs):
+		params = request.query_params
+		terms = parse_terms(params.get("q"))
+		if not terms:
+			raise ValidationError(detail="Enter the words to search for")
+		chat_id = params.get("chat_id")
+		if chat_id and not chat_id.isdigit():
+			raise ValidationError(detail="chat_id must be a number")
+		paginator = KeysetPagination()
+		page_size = paginator.get_page_size(request)
+		after = params.get("after")
+		hits = get_backend().search(request.user.id, terms, int(chat_id) if chat_id else None,
+		                            decode_cursor(after) if after else None, page_size + 1)
+		# results only page forward, a rank cursor can't be walked back
+		paginator.previous = None
+		hits, more = hits[:page_size], len(hits) > page_size
+		paginator.next = encode_cursor(hits[-1][1], hits[-1][0]) if more else None
+		queryset = self.apply_prefetch_plan(self.queryset.filter(id__in=[hit[0] for hit in hits]))
+		messages = {message.id: message for message in queryset}
+		# searching is not reading, the messages are left unviewed
+		hits = [hit for hit in hits if hit[0] in messages]
+		data = self.get_serializer([messages[hit[0]] for hit in hits], many=True).data
+		for item, (_, rank, text) in zip(data, hits):
+			item["highlight"] = text
+			item["rank"] = rank
+		return paginator.get_paginated_response(data)
+
 	@swagger_auto_schema(
 		manual_parameters=[chat_id],
 		operation_summary="enables a user to view full details of a chat message",
@@ -223,3 +425,142 @@ class ChatActionsAPI(APIView):
 			return Response(serializer.errors)
 		chatroom = serializer.save()
 		return Response(ChatRoomSerializer(chatroom).data)
+
+
+class UploadSessionAPI(CreateModelMixin, RetrieveModelMixin, GenericViewSet):
+	permission_classes = (IsAuthenticated,)
+	queryset = UploadSession.objects.all()
+	serializer_class = UploadSessionSerializer
+
+	checksum = openapi.Parameter("X-Chunk-SHA256", in_=openapi.IN_HEADER, type=openapi.TYPE_STRING, required=True,
+	                             description="hex sha256 of the chunk")
+
+	def get_queryset(self):
+		return self.queryset.filter(user_id=self.request.user.id, expires_at__gt=timezone.now())
+
+	def get_serializer_context(self):
+		data = super(UploadSessionAPI, self).get_serializer_context()
+		data['user'] = self.request.user
+		return data
+
+	@swagger_auto_schema(
+		operation_summary="starts a resumable upload of a large attachment",
+		tags=[
+			"Upload",
+		],
+	)
+	def create(self, request, *args, **kwargs):
+		return super(UploadSessionAPI, self).create(request, *args, **kwargs)
+
+	@swagger_auto_schema(
+		operation_summary="shows which chunks and byte ranges of an upload have been received",
+		tags=[
+			"Upload",
+		],
+	)
+	def retrieve(self, request, *args, **kwargs):
+		return super(UploadSessionAPI, self).retrieve(request, *args, **kwargs)
+
+	@swagger_auto_schema(
+		manual_parameters=[checksum],
+		operation_summary="uploads one numbered chunk of the file as the raw request body",
+		tags=[
+			"Upload",
+		],
+	)
+	@action(detail=True, methods=["put"], url_path=r"chunks/(?P<index>\d+)")
+	def chunk(self, request, index, *args, **kwargs):
+		session = self.get_object()
+		index = int(index)
+		if index >= session.chunk_count:
+			raise ValidationError(detail="Chunk index out of range")
+		expected_size = session.expected_chunk_size(index)
+		if int(request.META.get("CONTENT_LENGTH") or 0) != expected_size:
+			raise ValidationError(detail=f"Chunk {index} must be {expected_size} bytes")
+		checksum = request.META.get("HTTP_X_CHUNK_SHA256", "").lower()
+		if not checksum:
+			raise ValidationError(detail="The X-Chunk-SHA256 header is required")
+		if not save_chunk(session, index, request.stream, expected_size, checksum):
+			raise ValidationError(detail="Chunk checksum mismatch, upload it again")
+		UploadChunk.objects.update_or_create(session=session, index=index,
+		                                     defaults=dict(size=expected_size, sha256=checksum))
+		return Response(UploadSessionSerializer(session).data)
+
+	@swagger_auto_schema(
+		request_body=FinalizeUploadSerializer,
+		operation_summary="assembles a complete upload into an attachment of a new chat message",
+		tags=[
+			"Upload",
+		],
+		responses={200: ChatMessageSerializer()}
+	)
+	@action(detail=True, methods=["post"])
+	def finalize(self, request, *args, **kwargs):
+		session = self.get_object()
+		serializer = FinalizeUploadSerializer(data=request.data, context={"session": session})
+		serializer.is_valid(raise_exception=True)
+		message = serializer.save()
+		return Response(ChatMessageSerializer(message, context={"user": request.user}).data)
+
+
+class AttachmentDownloadAPI(APIView):
+	permission_classes = (IsAuthenticated,)
+	http_method_names = ("get", "head")
+
+	@swagger_auto_schema(
+		operation_summary="downloads an attachment, supports byte ranges and conditional requests",
+		tags=[
+			"ChatRoom",
+		],
+	)
+	def get(self, request, pk, *args, **kwargs):
+		attachment = ChatAttachment.objects.select_related("message").filter(
+			id=pk, status=ChatAttachment.READY).first()
+		if not attachment or not auth_cache.is_member(attachment.message.chat_id, request.user.id):
+			raise NotFound()
+		stored_file = attachment.stored_file
+		return serve_file(request, stored_file.name, stored_file.storage)
+
+
+class ImageDerivativeAPI(APIView):
+	permission_classes = (IsAuthenticated,)
+	http_method_names = ("get", "head")
+
+	@swagger_auto_schema(
+		operation_summary="returns a thumbnail or webp copy of a picture, the url comes from a serializer",
+		tags=[
+			"Media",
+		],
+	)
+	def get(self, request, token, *args, **kwargs):
+		spec = load_spec(token)
+		if not spec:
+			raise NotFound()
+		source, size, image_format, attachment_id = spec
+		if attachment_id is not None:
+			chat_id = ChatAttachment.objects.filter(id=attachment_id, status=ChatAttachment.READY).\
+				values_list("message__chat_id", flat=True).first()
+			if chat_id is None or not auth_cache.is_member(chat_id, request.user.id):
+				raise NotFound()
+		derivative = get_derivative(source, size, image_format)
+		if not derivative:
+			raise NotFound()
+		# the url changes whenever the source picture does, attachment pictures are kept out of shared caches
+		cache_control = "public" if attachment_id is None else "private"
+		return serve_file(request, derivative.name, cache_control=f"{cache_control}, max-age=31536000, immutable")
+
+
+class MetricsAPI(APIView):
+	permission_classes = (IsAdminUser,)
+	http_method_names = ("get",)
+
+	@swagger_auto_schema(
+		operation_summary="enables an admin view the cache and websocket counters of this process",
+		tags=[
+			"Metrics",
+		],
+	)
+	def get(self, request, *args, **kwargs):
+		return Response(dict(websocket_auth_cache=auth_cache.stats(),
+		                     websocket_send_queues=send_queue_metrics.stats(),
+		                     recent_messages_cache=recent_messages.stats()))
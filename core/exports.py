@@ -0,0 +1,45 @@
+import zlib
+from collections import defaultdict
+from itertools import islice
+
+from core import codecs
+from core.models import ChatMessage, ChatAttachment, User
+from core.services import ChatMessageExportSerializer, UserSerializer
+
+CHUNK_SIZE = 2000
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+GZIP_CONTENT_TYPE = "application/gzip"
+
+
+def export_room(room_id: int, compress: bool = False, chunk_size: int = CHUNK_SIZE):
+	"""
+	Yields the history of a room oldest first as NDJSON, one message with its sender and attachments a line,
+	gzipped when compress is set. Messages are read from the database cursor chunk_size at a time and the
+	attachments of each chunk are fetched in one query, so memory stays flat however long the history is.
+	Senders are serialized once, the ones kept grow with the people who wrote in the room, not its messages
+	:return: generator of bytes, one piece per chunk of messages
+	"""
+	messages = ChatMessage.objects.filter(chat_id=room_id).order_by("time_sent", "id").iterator(chunk_size=chunk_size)
+	senders = {}
+	# wbits 31 writes a gzip header and trailer around the deflate stream
+	compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+	codec = codecs.get_codec()
+	while True:
+		chunk = list(islice(messages, chunk_size))
+		if not chunk:
+			break
+		attachments = defaultdict(list)
+		for attachment in ChatAttachment.objects.filter(message_id__in=[message.id for message in chunk]).\
+				order_by("id"):
+			attachments[attachment.message_id].append(attachment)
+		missing = {message.sender_id for message in chunk if message.sender_id not in senders}
+		senders.update((user.id, UserSerializer(user).data) for user in User.objects.filter(id__in=missing))
+		data = ChatMessageExportSerializer(chunk, many=True, context=dict(senders=senders,
+		                                                                  attachments=attachments)).data
+		lines = b"".join(codec.dumps_bytes(item) + b"\n" for item in data)
+		if compressor:
+			lines = compressor.compress(lines)
+		if lines:
+			yield lines
+	if compressor:
+		yield compressor.flush()
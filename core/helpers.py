@@ -1,16 +1,23 @@
 import asyncio
-import json
+import base64
 import logging
+import queue
+import threading
 from collections import OrderedDict
-from typing import List
+from datetime import datetime
 
-import websocket
-import websockets
-from decouple import config
-from rest_framework.authtoken.models import Token
-from rest_framework.pagination import PageNumberPagination
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
 from rest_framework.response import Response
 
+from core import codecs
+
 
 class CustomPagination(PageNumberPagination):
     """
@@ -40,20 +47,217 @@ class CustomPagination(PageNumberPagination):
         )
 
 
-async def websocket_client(url, payload):
-    async with websockets.connect(url) as websocket:
-        await websocket.send(payload)
-        await websocket.recv()
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination over (time_sent, id) so every page costs the same no matter how far back it is.
+    ?before=<cursor> returns the messages just older than the cursor, ?after=<cursor> the ones just newer,
+    neither returns the newest page. previous/next hold the cursors of the older/newer pages and
+    count is only computed when ?count=true
+    """
+    page_size = settings.REST_FRAMEWORK.get("PAGE_SIZE", 20)
+    page_size_query_param = "page_size"
+    max_page_size = 1000
+    ordering = ("time_sent", "id")
+    invalid_cursor_message = "Invalid cursor"
 
+    def __init__(self):
+        self.items = []
+        self.previous = None
+        self.next = None
+        self.count = None
 
-def get_or_create_eventloop():
-    try:
-        return asyncio.get_event_loop()
-    except RuntimeError as ex:
-        if "There is no current event loop in thread" in str(ex):
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            return asyncio.get_event_loop()
+    @staticmethod
+    def is_requested(request) -> bool:
+        params = request.query_params
+        return params.get("pagination") == "cursor" or "before" in params or "after" in params
+
+    @staticmethod
+    def encode_cursor(instance) -> str:
+        value = f"{instance.time_sent.isoformat()}|{instance.id}"
+        return base64.urlsafe_b64encode(value.encode()).decode()
+
+    def decode_cursor(self, cursor: str):
+        try:
+            time_sent, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+            return datetime.fromisoformat(time_sent), int(pk)
+        except (ValueError, UnicodeDecodeError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def get_page_size(self, request) -> int:
+        try:
+            return max(1, min(int(request.query_params.get(self.page_size_query_param, self.page_size)),
+                              self.max_page_size))
+        except ValueError:
+            return self.page_size
+
+    def paginate_queryset(self, queryset, request, view=None):
+        page_size = self.get_page_size(request)
+        before = request.query_params.get("before")
+        after = request.query_params.get("after")
+        if request.query_params.get("count") == "true":
+            self.count = queryset.count()
+        if after:
+            time_sent, pk = self.decode_cursor(after)
+            items = list(queryset.filter(Q(time_sent__gt=time_sent) | Q(time_sent=time_sent, id__gt=pk)).
+                         order_by(*self.ordering)[:page_size + 1])
+            has_more = len(items) > page_size
+            self.items = items[:page_size]
+            self.previous = self.encode_cursor(self.items[0]) if self.items else None
+            self.next = self.encode_cursor(self.items[-1]) if has_more else None
+            return self.items
+        if before:
+            time_sent, pk = self.decode_cursor(before)
+            queryset = queryset.filter(Q(time_sent__lt=time_sent) | Q(time_sent=time_sent, id__lt=pk))
+        items = list(queryset.order_by(*(f"-{field}" for field in self.ordering))[:page_size + 1])
+        has_more = len(items) > page_size
+        self.items = list(reversed(items[:page_size]))
+        self.previous = self.encode_cursor(self.items[0]) if has_more else None
+        # the cursors are exclusive, so the pages around this one start from its own first and last message
+        self.next = self.encode_cursor(self.items[-1]) if before and self.items else None
+        return self.items
+
+    def get_paginated_response(self, data):
+        return Response(
+            OrderedDict(
+                [
+                    ("count", self.count),
+                    ("next", self.next),
+                    ("previous", self.previous),
+                    ("page", None),
+                    ("results", data),
+                ]
+            )
+        )
+
+
+class MessagePagination(CustomPagination):
+    """
+    Page number pagination that switches to KeysetPagination when the client asks for cursors
+    """
+    def __init__(self):
+        self.keyset = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if KeysetPagination.is_requested(request):
+            self.keyset = KeysetPagination()
+            return self.keyset.paginate_queryset(queryset, request, view)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.keyset:
+            return self.keyset.get_paginated_response(data)
+        return super().get_paginated_response(data)
+
+
+class PublishWorker(threading.Thread):
+    """
+    Background thread that drains queued websocket events and sends them to the channel layer in batches,
+    so the request thread never waits on the channel layer
+    """
+    max_batch_size = 100
+
+    def __init__(self):
+        super().__init__(name="ws-publisher", daemon=True)
+        self.queue = queue.Queue()
+
+    def put(self, group: str, message: dict):
+        self.queue.put((group, message))
+
+    def join_queue(self):
+        """
+            Blocks until every queued event has been handed to the channel layer
+        :return:
+        """
+        self.queue.join()
+
+    def run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                loop.run_until_complete(self.send_batch(batch))
+            except Exception as e:
+                logging.critical(e, exc_info=True)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    @staticmethod
+    async def send_batch(batch):
+        channel_layer = get_channel_layer()
+        results = await asyncio.gather(
+            *(channel_layer.group_send(group, message) for group, message in batch), return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                logging.critical(result, exc_info=result)
+
+
+class ChannelPublisher:
+    """
+    Pushes websocket events straight onto the channel layer groups the consumers are subscribed to
+    (chat_<id>, general and user_<id>) instead of connecting to the websocket server as a client.
+
+    When deferred, events are only sent once the surrounding transaction commits and are handed to a
+    background worker which batches them, otherwise they are sent immediately on the calling thread.
+    """
+    _worker = None
+    _worker_lock = threading.Lock()
+
+    @staticmethod
+    def is_deferred(deferred=None) -> bool:
+        if deferred is None:
+            return getattr(settings, "WEBSOCKET_PUBLISH_DEFERRED", False)
+        return deferred
+
+    @staticmethod
+    def build_message(event: str, data, sender=None, group: str = None) -> dict:
+        payload = dict(event=event, data=data)
+        if sender is not None:
+            payload["sender"] = sender
+        # the group lets a multiplexed socket tell which of its channels the event belongs to
+        return {"type": "notify", "data": codecs.dumps(payload, DjangoJSONEncoder), "group": group}
+
+    @classmethod
+    def get_worker(cls) -> PublishWorker:
+        with cls._worker_lock:
+            if cls._worker is None or not cls._worker.is_alive():
+                cls._worker = PublishWorker()
+                cls._worker.start()
+            return cls._worker
+
+    @classmethod
+    def publish(cls, group: str, event: str, data, sender=None, deferred=None):
+        """
+            Sends an event to every socket in a channel layer group
+        :param group: group name e.g chat_1, general, user_1
+        :param event:
+        :param data:
+        :param sender: id of the user the event originates from
+        :param deferred: send after the transaction commits on the background worker,
+                         defaults to the WEBSOCKET_PUBLISH_DEFERRED setting
+        :return:
+        """
+        message = cls.build_message(event, data, sender, group)
+        if not cls.is_deferred(deferred):
+            async_to_sync(get_channel_layer().group_send)(group, message)
+            return
+        transaction.on_commit(lambda: cls.get_worker().put(group, message))
+
+    @classmethod
+    def flush(cls):
+        """
+            Waits for the background worker to send every deferred event that has been committed
+        :return:
+        """
+        if cls._worker is not None:
+            cls._worker.join_queue()
 
 
 def send_ws_to_chat(user, chat_id: int, event: str, data: dict):
@@ -66,14 +270,9 @@ def send_ws_to_chat(user, chat_id: int, event: str, data: dict):
     :return:
     """
     try:
-        payload = dict(event=event, data=data)
         if not user:
             return
-        payload["sender"] = user.id
-        token, created = Token.objects.get_or_create(user=user)
-        url = f"ws://{config('WEBSOCKET_URL', 'localhost')}:8001/ws/{token.key}/chats/{chat_id}/"
-        loop = get_or_create_eventloop()
-        loop.run_until_complete(websocket_client(url, json.dumps(payload)))
+        ChannelPublisher.publish(f"chat_{chat_id}", event, data, sender=user.id)
     except Exception as e:
         logging.critical(e, exc_info=True)
 
@@ -87,18 +286,13 @@ def send_ws_to_general(user, event: str, data: dict):
        :return:
        """
     try:
-        payload = dict(event=event, data=data)
         if not user:
             return
-        payload["sender"] = user.id
-        token, created = Token.objects.get_or_create(user=user)
-        url = f"ws://{config('WEBSOCKET_URL', 'localhost')}:8001/ws/{token.key}/general/"
-        loop = get_or_create_eventloop()
-        loop.run_until_complete(send_data(url, payload))
-
+        ChannelPublisher.publish("general", event, data, sender=user.id)
     except Exception as e:
         logging.critical(e, exc_info=True)
 
+
 def send_ws_to_private(user, event: str, data: dict):
     """
            Utility used to send messages to the websocket ( a private route)
@@ -108,20 +302,8 @@ def send_ws_to_private(user, event: str, data: dict):
        :return:
        """
     try:
-        payload = dict(event=event, data=data)
         if not user:
             return
-        payload["sender"] = user.id
-        token, created = Token.objects.get_or_create(user=user)
-        url = f"ws://{config('WEBSOCKET_URL', 'localhost')}:8001/ws/{token.key}/private/"
-        loop = get_or_create_eventloop()
-        loop.run_until_complete(websocket_client(url, json.dumps(payload)))
+        ChannelPublisher.publish(str(user), event, data, sender=user.id)
     except Exception as e:
         logging.critical(e, exc_info=True)
-
-
-async def send_data(url, data:dict):
-    async with websockets.connect(url) as websocket:
-        await websocket.send(json.dumps(data))
-
-# Run the event loop to send data
@@ -0,0 +1,236 @@
+import json
+import os
+import shutil
+import statistics
+import tempfile
+import time
+from itertools import accumulate
+from random import Random
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.core.cache import caches
+from django.db import connection
+from django.db.models import Max
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+
+from ChatClone.celery import app as celery_app
+
+IN_MEMORY_CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+# a fresh cache per run, rows of the throwaway database reuse the ids cached by earlier runs
+BENCHMARK_CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "benchmark"}}
+
+
+def seed_messages(chat, senders, count: int, batch_size: int = 10000):
+	"""
+		Bulk inserts count messages into chat, sent round robin by senders
+	:return:
+	"""
+	from core.models import ChatMessage
+	for start in range(0, count, batch_size):
+		ChatMessage.objects.bulk_create([
+			ChatMessage(chat_id=chat.id, text=f"message {index}", sender_id=senders[index % len(senders)].id)
+			for index in range(start, min(count, start + batch_size))
+		], batch_size=batch_size)
+
+
+def make_vocabulary(size: int, seed: int = 1) -> list:
+	"""
+		Distinct made up words, reproducible from the seed
+	"""
+	random = Random(seed)
+	syllables = [consonant + vowel for consonant in "bdfgklmnprstvz" for vowel in "aeiou"]
+	words = {}
+	while len(words) < size:
+		words.setdefault("".join(random.choice(syllables) for _ in range(random.randint(2, 4))), None)
+	return list(words)
+
+
+def seed_dataset(users: int, rooms: int, members_per_room: int, messages: int, read_fraction: float = 0.5,
+                 seed: int = 1, password: str = "bench", batch_size: int = 10000, words: int = 0,
+                 vocabulary_size: int = 5000) -> dict:
+	"""
+		Bulk inserts a reproducible dataset: users sharing one password hash, rooms with members_per_room members
+		drawn from the users, messages spread over the rooms and sent by their members, and read watermarks
+		part way into every room for read_fraction of its members
+	:param seed: seed of the random choices, the same arguments give the same dataset
+	:param words: when set, messages are that many words of a vocabulary drawn with zipf frequencies, its first
+		word the most common, instead of "message <index>"
+	:return: dict(users, rooms) of the created rows and the vocabulary
+	"""
+	from django.contrib.auth.hashers import make_password
+	from core.models import User, ChatRoom, ChatMessage, RoomReadState
+	random = Random(seed)
+	password = make_password(password)
+	for start in range(0, users, batch_size):
+		User.objects.bulk_create([
+			User(username=f"user{index}", email=f"user{index}@example.com", first_name="User", last_name=str(index),
+			     password=password) for index in range(start, min(users, start + batch_size))
+		], batch_size=batch_size)
+	user_ids = list(User.objects.filter(username__startswith="user").order_by("id").values_list("id", flat=True))
+	ChatRoom.objects.bulk_create([
+		ChatRoom(name=f"room {index}", maximum_members=max(100, members_per_room + 10), members_count=members_per_room)
+		for index in range(rooms)
+	], batch_size=batch_size)
+	room_ids = list(ChatRoom.objects.filter(name__startswith="room ").order_by("id").values_list("id", flat=True))
+	members = {room_id: random.sample(user_ids, members_per_room) for room_id in room_ids}
+	memberships = [ChatRoom.members.through(chatroom_id=room_id, user_id=user_id)
+	               for room_id, room_members in members.items() for user_id in room_members]
+	ChatRoom.members.through.objects.bulk_create(memberships, batch_size=batch_size)
+	ChatRoom.admins.through.objects.bulk_create([ChatRoom.admins.through(chatroom_id=room_id, user_id=room_members[0])
+	                                             for room_id, room_members in members.items()], batch_size=batch_size)
+	vocabulary = make_vocabulary(vocabulary_size, seed) if words else []
+	# a separate stream, the rooms and senders are the same with or without words
+	text_random = Random(f"text {seed}")
+	frequencies = list(accumulate(1 / rank for rank in range(1, len(vocabulary) + 1)))
+	for start in range(0, messages, batch_size):
+		batch = []
+		for index in range(start, min(messages, start + batch_size)):
+			room_id = random.choice(room_ids)
+			text = " ".join(text_random.choices(vocabulary, cum_weights=frequencies, k=words)) if words \
+				else f"message {index}"
+			batch.append(ChatMessage(chat_id=room_id, text=text, sender_id=random.choice(members[room_id])))
+		ChatMessage.objects.bulk_create(batch, batch_size=batch_size)
+	last_message = dict(ChatMessage.objects.values("chat_id").annotate(last=Max("id")).values_list("chat_id", "last"))
+	RoomReadState.objects.bulk_create([
+		RoomReadState(user_id=user_id, room_id=room_id, last_read_message_id=random.randint(0, last_message[room_id]))
+		for room_id, room_members in members.items() if room_id in last_message
+		for user_id in room_members if random.random() < read_fraction
+	], batch_size=batch_size)
+	return dict(users=user_ids, rooms=room_ids, vocabulary=vocabulary)
+
+
+def compare_to_baseline(results: dict, baseline: dict, tolerance: float, noise_ms: float = 0.5) -> list:
+	"""
+		Lists the regressions of results against a baseline saved from --json: query counts that grew and
+		median timings that got more than tolerance slower and by more than noise_ms, the mean and tail
+		percentiles of a short run move with every hiccup of the machine
+	:return: one line per regression
+	"""
+	regressions = []
+	for name, result in results.items():
+		before = baseline.get(name)
+		if not isinstance(result, dict) or not isinstance(before, dict):
+			continue
+		for key, value in result.items():
+			old = before.get(key)
+			if not isinstance(value, (int, float)) or not isinstance(old, (int, float)) or isinstance(value, bool):
+				continue
+			if key == "queries" and value > old:
+				regressions.append(f"{name}: {value} queries, was {old}")
+			elif key == "p50_ms" and value > old * (1 + tolerance) and value - old > noise_ms:
+				regressions.append(f"{name}: {key} {value}, was {old}")
+	return regressions
+
+
+def table_bytes(model) -> int or None:
+	"""
+		Returns the disk space used by a model's table and its indexes, when the database can tell
+	:param model:
+	:return:
+	"""
+	table = model._meta.db_table
+	with connection.cursor() as cursor:
+		if connection.vendor == "sqlite":
+			cursor.execute("SELECT SUM(pgsize) FROM dbstat WHERE name IN "
+			               "(SELECT name FROM sqlite_master WHERE tbl_name = %s)", [table])
+		elif connection.vendor == "postgresql":
+			cursor.execute("SELECT pg_total_relation_size(%s)", [table])
+		else:
+			return None
+		return cursor.fetchone()[0]
+
+
+def measure(func, iterations: int, warmup: int = 5) -> dict:
+	"""
+		Calls func repeatedly and returns its latency distribution in milliseconds
+	:param func: callable taking no arguments
+	:param iterations:
+	:param warmup: calls made before timing starts
+	:return:
+	"""
+	for _ in range(warmup):
+		func()
+	timings = []
+	for _ in range(iterations):
+		start = time.perf_counter()
+		func()
+		timings.append((time.perf_counter() - start) * 1000)
+	return summarize(timings)
+
+
+def summarize(timings) -> dict:
+	timings = sorted(timings)
+	if not timings:
+		return dict(count=0)
+
+	def percentile(p):
+		return round(timings[min(len(timings) - 1, int(len(timings) * p / 100))], 3)
+	return dict(
+		count=len(timings),
+		mean_ms=round(statistics.fmean(timings), 3),
+		p50_ms=percentile(50),
+		p95_ms=percentile(95),
+		p99_ms=percentile(99),
+		max_ms=round(timings[-1], 3),
+	)
+
+
+class BenchmarkCommand(BaseCommand):
+	"""
+	Base for benchmark commands, runs the benchmark against a throwaway test database, a temporary media root,
+	the in-memory channel layer and eager celery tasks so nothing touches real data or needs a broker
+	"""
+	iterations = 200
+	# keep a sqlite test database in a file under the temporary media root, so other processes can open it
+	database_file = False
+
+	def add_arguments(self, parser):
+		parser.add_argument("--iterations", type=int, default=self.iterations)
+		parser.add_argument("--json", action="store_true", help="print the results as json")
+		parser.add_argument("--baseline", help="json results of an earlier run, regressions against it fail the command")
+		parser.add_argument("--tolerance", type=float, default=0.25,
+		                    help="fraction a timing may grow by before it counts as a regression")
+
+	def run_benchmark(self, **options) -> dict:
+		raise NotImplementedError
+
+	def handle(self, *args, **options):
+		media_root = tempfile.mkdtemp(prefix="chatclone-bench-")
+		setup_test_environment()
+		test_name = connection.settings_dict["TEST"]["NAME"]
+		if self.database_file and connection.vendor == "sqlite":
+			connection.settings_dict["TEST"]["NAME"] = os.path.join(media_root, "db.sqlite3")
+		old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+		always_eager = celery_app.conf.task_always_eager
+		celery_app.conf.update(CELERY_TASK_ALWAYS_EAGER=True)
+		try:
+			# everything runs in this process, so the recent messages cache can live on the local memory cache
+			with override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, MEDIA_ROOT=media_root,
+			                       CACHES=BENCHMARK_CACHES,
+			                       RECENT_MESSAGES_CACHE=dict(settings.RECENT_MESSAGES_CACHE, CACHE="default")):
+				caches["default"].clear()
+				results = self.run_benchmark(**options)
+		finally:
+			celery_app.conf.update(CELERY_TASK_ALWAYS_EAGER=always_eager)
+			connection.creation.destroy_test_db(old_name, verbosity=0)
+			connection.settings_dict["TEST"]["NAME"] = test_name
+			teardown_test_environment()
+			shutil.rmtree(media_root, ignore_errors=True)
+		self.report(results, options["json"])
+		if options["baseline"]:
+			with open(options["baseline"]) as file:
+				regressions = compare_to_baseline(results, json.load(file), options["tolerance"])
+			if regressions:
+				raise CommandError("regressed against the baseline:\n" + "\n".join(regressions))
+
+	def report(self, results: dict, as_json: bool = False):
+		if as_json:
+			self.stdout.write(json.dumps(results, indent=2, default=str))
+			return
+		for name, result in results.items():
+			if isinstance(result, dict):
+				line = "  ".join(f"{key}={value}" for key, value in result.items())
+			else:
+				line = str(result)
+			self.stdout.write(f"{name:<32} {line}")
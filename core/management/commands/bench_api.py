@@ -0,0 +1,134 @@
+import gc
+import math
+import time
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from rest_framework.authtoken.models import Token
+
+from core.management.benchmark import BenchmarkCommand, measure, seed_dataset, summarize
+from core.models import ChatRoom
+
+# most SQL queries one request of each endpoint may issue on the seeded dataset
+QUERY_BUDGETS = {
+	"login": 4,
+	"room list": 5,
+	"room retrieve": 6,
+	"message list, first page": 6,
+	"message list, deep page": 6,
+	"message list, newest cursor page": 4,
+	"message create": 16,
+	"chat action join": 13,
+	"chat action leave": 13,
+}
+PAGE_SIZE = 20
+
+
+class Command(BenchmarkCommand):
+	help = "Times the REST hot paths on a seeded dataset and fails when one issues more SQL queries than its budget, " \
+	       "--json output of a run can be passed back as --baseline to fail on regressions"
+	iterations = 50
+
+	def add_arguments(self, parser):
+		super().add_arguments(parser)
+		parser.add_argument("--users", type=int, default=1000)
+		parser.add_argument("--rooms", type=int, default=50)
+		parser.add_argument("--members-per-room", type=int, default=100)
+		parser.add_argument("--messages", type=int, default=100000)
+		parser.add_argument("--read-fraction", type=float, default=0.5,
+		                    help="share of the members of a room with a read watermark in it")
+		parser.add_argument("--seed", type=int, default=1)
+		parser.add_argument("--login-iterations", type=int, default=10,
+		                    help="logins timed, each hashes the password with the configured hasher")
+
+	def run_benchmark(self, **options):
+		start = time.perf_counter()
+		dataset = seed_dataset(options["users"], options["rooms"], options["members_per_room"], options["messages"],
+		                       options["read_fraction"], options["seed"])
+		seed_seconds = time.perf_counter() - start
+		room = ChatRoom.objects.get(id=dataset["rooms"][0])
+		viewer = room.admins.get()
+		spare = ChatRoom.objects.exclude(members=viewer).filter(id__in=dataset["rooms"]).first()
+		# page 50 of the room's history, or its last page when it is shorter
+		deep_page = max(1, min(50, math.ceil(room.chatmessage_set.count() / PAGE_SIZE)))
+		client = Client(HTTP_AUTHORIZATION=f"Token {Token.objects.create(user=viewer).key}")
+
+		def request(method, url, data=None, **extra):
+			def run():
+				response = getattr(client, method)(url, data, **extra)
+				assert response.status_code == 200, response.content
+				return response
+			return run
+
+		def create_message():
+			upload = SimpleUploadedFile("note.txt", b"benchmark attachment", content_type="text/plain")
+			request("post", "/api/v1/chat-messages/", dict(chat=room.id, text="benchmark", file=upload))()
+
+		endpoints = {
+			"login": (request("post", "/api/v1/login/", dict(username=viewer.username, password="bench"),
+			                  content_type="application/json"), options["login_iterations"]),
+			"room list": (request("get", "/api/v1/chat-rooms/"), options["iterations"]),
+			"room retrieve": (request("get", f"/api/v1/chat-rooms/{room.id}/"), options["iterations"]),
+			"message list, first page": (request("get", "/api/v1/chat-messages/",
+			                                     dict(chat_id=room.id, page=1, page_size=PAGE_SIZE)),
+			                             options["iterations"]),
+			"message list, deep page": (request("get", "/api/v1/chat-messages/",
+			                                    dict(chat_id=room.id, page=deep_page, page_size=PAGE_SIZE)),
+			                            options["iterations"]),
+			"message list, newest cursor page": (request("get", "/api/v1/chat-messages/",
+			                                             dict(chat_id=room.id, pagination="cursor",
+			                                                  page_size=PAGE_SIZE)),
+			                                     options["iterations"]),
+			"message create": (create_message, options["iterations"]),
+		}
+		results = dict(dataset=dict(users=len(dataset["users"]), rooms=len(dataset["rooms"]),
+		                            messages=options["messages"], viewer_rooms=viewer.members.count(),
+		                            deep_page=deep_page, seed=options["seed"], seed_s=round(seed_seconds, 2)))
+		for name, (func, iterations) in endpoints.items():
+			gc.collect()
+			timings = measure(func, iterations)
+			results[name] = dict(queries=self.count_queries(func), budget=QUERY_BUDGETS[name], **timings)
+
+		# joins and leaves alternate so the room is left as it was found
+		def act(action):
+			post = request("post", "/api/v1/chat-rooms/actions/", dict(chat=spare.id, action=action),
+			               content_type="application/json")
+
+			def run():
+				# validation errors are answered with 200 too
+				response = post()
+				assert "id" in response.json(), response.content
+			return run
+		actions = {action: act(action) for action in ("join", "leave")}
+		queries = {action: self.count_queries(func) for action, func in actions.items()}
+		timings = {action: [] for action in actions}
+		gc.collect()
+		for _ in range(options["iterations"]):
+			for action, func in actions.items():
+				begin = time.perf_counter()
+				func()
+				timings[action].append((time.perf_counter() - begin) * 1000)
+		for action in actions:
+			name = f"chat action {action}"
+			results[name] = dict(queries=queries[action], budget=QUERY_BUDGETS[name], **summarize(timings[action]))
+
+		for name, result in results.items():
+			if "budget" in result:
+				result["ok"] = result["queries"] <= result["budget"]
+		self.results = results
+		return results
+
+	@staticmethod
+	def count_queries(func) -> int:
+		with CaptureQueriesContext(connection) as queries:
+			func()
+		return len(queries)
+
+	def handle(self, *args, **options):
+		super().handle(*args, **options)
+		failed = [name for name, result in self.results.items() if result.get("ok") is False]
+		if failed:
+			raise CommandError(f"query budget exceeded: {', '.join(failed)}")
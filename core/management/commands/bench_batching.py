@@ -0,0 +1,84 @@
+import asyncio
+import time
+
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.test.utils import override_settings
+from django.urls import path
+from rest_framework.authtoken.models import Token
+
+from ChatClone.routing import consumers
+from core import codecs
+from core.management.benchmark import BenchmarkCommand
+from core.models import User
+
+
+class Command(BenchmarkCommand):
+	help = "Load tests the general group with and without frame batching, counting the frames every socket is " \
+	       "sent (one write each on a real server) and the CPU it takes"
+
+	def add_arguments(self, parser):
+		super().add_arguments(parser)
+		parser.add_argument("--sockets", type=int, default=50)
+		parser.add_argument("--events", type=int, default=1000)
+		parser.add_argument("--rate", type=int, default=1000, help="group events published per second")
+
+	def run_benchmark(self, **options):
+		user = User.objects.create_user(username="bench", email="bench@example.com", password="bench")
+		token, _ = Token.objects.get_or_create(user=user)
+		event = codecs.dumps(dict(event="LOGGED IN", data=dict(id=user.id, username="someone", first_name="Some",
+		                                                     last_name="One", profile_picture=None)))
+		results = {}
+		# the default capacity of 100 would drop the events of an unbatched burst
+		layers = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer", "CONFIG": {"capacity": 100000}}}
+		with override_settings(CHANNEL_LAYERS=layers):
+			for mode, consumer in consumers["general"].items():
+				application = URLRouter([path("ws/<token>/general/", consumer.as_asgi())])
+				for protocol in ("json", codecs.JSON_BATCHED_SUBPROTOCOL):
+					results[f"{mode} {protocol}"] = asyncio.run(self.load(
+						application, f"/ws/{token.key}/general/", protocol, event, **options))
+		return results
+
+	@staticmethod
+	async def load(application, url: str, protocol: str, event: str, sockets: int, events: int, rate: int,
+	               **options) -> dict:
+		communicators = []
+		for _ in range(sockets):
+			communicator = WebsocketCommunicator(application, url, subprotocols=[protocol])
+			connected, _ = await communicator.connect()
+			assert connected, "connection refused"
+			await communicator.receive_from()
+			communicators.append(communicator)
+		frames = 0
+
+		async def drain(communicator):
+			nonlocal frames
+			received = 0
+			while received < events:
+				text = await communicator.receive_from(timeout=10)
+				frames += 1
+				# counted instead of decoded, the clients' decoding is not the server's CPU
+				received += text.count('"event":')
+
+		layer = get_channel_layer()
+		cpu = time.process_time()
+		start = time.perf_counter()
+		readers = [asyncio.create_task(drain(communicator)) for communicator in communicators]
+		for index in range(events):
+			await layer.group_send("general", {"type": "notify", "data": event})
+			# paced like real traffic, a burst would fill every batch at once
+			await asyncio.sleep(max(0.0, start + (index + 1) / rate - time.perf_counter()))
+		await asyncio.gather(*readers)
+		wall = time.perf_counter() - start
+		cpu = time.process_time() - cpu
+		for communicator in communicators:
+			await communicator.disconnect()
+		delivered = events * sockets
+		return dict(
+			frames=frames,
+			events_per_frame=round(delivered / frames, 1),
+			cpu_ms=round(cpu * 1000),
+			cpu_us_per_event=round(cpu * 1000000 / delivered, 2),
+			wall_s=round(wall, 2),
+		)
@@ -0,0 +1,87 @@
+import asyncio
+import gc
+import threading
+import time
+import tracemalloc
+
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.urls import path
+from rest_framework.authtoken.models import Token
+
+from ChatClone.routing import consumers
+from core.management.benchmark import BenchmarkCommand
+from core.models import User, ChatRoom
+
+
+class Command(BenchmarkCommand):
+	help = "Measures idle connection density of the sync and async websocket consumers"
+
+	def add_arguments(self, parser):
+		super().add_arguments(parser)
+		parser.add_argument("--connections", type=int, default=500, help="idle sockets opened per consumer")
+		parser.add_argument("--memory-budget", type=int, default=512,
+		                    help="memory in MB used to project sockets per process")
+
+	def run_benchmark(self, **options):
+		user = User.objects.create_user(username="bench", email="bench@example.com", password="bench")
+		chat = ChatRoom.objects.create(name="bench")
+		chat.members.add(user)
+		token, _ = Token.objects.get_or_create(user=user)
+		paths = {
+			"chats": f"/ws/{token.key}/chats/{chat.id}/",
+			"general": f"/ws/{token.key}/general/",
+			"private": f"/ws/{token.key}/private/",
+		}
+		routes = {
+			"chats": "ws/<token>/chats/<chat_id>/",
+			"general": "ws/<token>/general/",
+			"private": "ws/<token>/private/",
+		}
+		groups = {"chats": str(chat), "general": "general", "private": str(user)}
+		results = {}
+		for route, implementations in consumers.items():
+			for mode, consumer in implementations.items():
+				application = URLRouter([path(routes[route], consumer.as_asgi())])
+				results[f"{route} {mode}"] = asyncio.run(self.measure_density(
+					application, paths[route], groups[route], options["connections"], options["memory_budget"]))
+		return results
+
+	@staticmethod
+	async def measure_density(application, url: str, group: str, connections: int, memory_budget: int) -> dict:
+		gc.collect()
+		tracemalloc.start()
+		baseline, _ = tracemalloc.get_traced_memory()
+		threads_before = threading.active_count()
+		communicators = []
+		start = time.perf_counter()
+		for _ in range(connections):
+			communicator = WebsocketCommunicator(application, url)
+			connected, _ = await communicator.connect()
+			assert connected, "connection refused"
+			await communicator.receive_from()
+			communicators.append(communicator)
+		connect_seconds = time.perf_counter() - start
+		gc.collect()
+		current, peak = tracemalloc.get_traced_memory()
+		threads = threading.active_count() - threads_before
+
+		start = time.perf_counter()
+		await get_channel_layer().group_send(group, {"type": "notify", "data": "{}"})
+		for communicator in communicators:
+			await communicator.receive_from()
+		fan_out_seconds = time.perf_counter() - start
+
+		for communicator in communicators:
+			await communicator.disconnect()
+		tracemalloc.stop()
+		per_connection = (current - baseline) / connections
+		return dict(
+			connections=connections,
+			connects_per_sec=round(connections / connect_seconds),
+			kb_per_idle_connection=round(per_connection / 1024, 2),
+			extra_threads=threads,
+			fan_out_ms=round(fan_out_seconds * 1000, 2),
+			projected_sockets_per_process=int(memory_budget * 1024 * 1024 / per_connection) if per_connection else None,
+		)
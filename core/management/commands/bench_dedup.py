@@ -0,0 +1,61 @@
+import os
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+
+from core.management.benchmark import BenchmarkCommand, measure
+from core.storage import ContentAddressedStorage
+
+
+def directory_bytes(path: str) -> int:
+	return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+class Command(BenchmarkCommand):
+	help = "Compares disk usage and latency of storing attachments the way it was done before deduplication, " \
+	       "staged then copied into the field, against the content addressed attachment storage"
+	iterations = 20
+
+	def add_arguments(self, parser):
+		super().add_arguments(parser)
+		parser.add_argument("--size-mb", type=float, default=4)
+
+	def run_benchmark(self, **options):
+		size = int(options["size_mb"] * 1024 * 1024)
+		iterations = options["iterations"]
+		sources = os.path.join(settings.MEDIA_ROOT, "sources")
+		os.makedirs(sources)
+		# one more distinct file than saves, the warmup save uses the first
+		paths = []
+		for index in range(iterations + 1):
+			paths.append(os.path.join(sources, f"{index}.mp4"))
+			with open(paths[-1], "wb") as file:
+				file.write(os.urandom(size))
+
+		def copying(storage, files):
+			def run():
+				with open(next(files), "rb") as file:
+					staged = storage.save("staging/clip.mp4", File(file))
+				with storage.open(staged, "rb") as file:
+					storage.save("root/videos/clip.mp4", File(file))
+				storage.delete(staged)
+			return run
+
+		def deduplicating(storage, files):
+			def run():
+				with open(next(files), "rb") as file:
+					storage.save("staging/clip.mp4", File(file))
+			return run
+
+		results = {}
+		for distinct in (False, True):
+			label = "distinct files" if distinct else "duplicate copies"
+			for name, storage_class, store in (("copied", FileSystemStorage, copying),
+			                                   ("dedup", ContentAddressedStorage, deduplicating)):
+				location = os.path.join(settings.MEDIA_ROOT, f"{name}-{int(distinct)}")
+				files = iter(paths if distinct else [paths[0]] * (iterations + 1))
+				result = measure(store(storage_class(location=location), files), iterations, warmup=1)
+				result["disk_bytes"] = directory_bytes(location)
+				results[f"{label} {name}"] = result
+		return results
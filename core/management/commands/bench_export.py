@@ -0,0 +1,40 @@
+import gc
+import time
+import tracemalloc
+
+from core.exports import export_room
+from core.management.benchmark import BenchmarkCommand, seed_messages
+from core.models import User, ChatRoom, ChatMessage
+
+
+class Command(BenchmarkCommand):
+	help = "Exports a growing room and reports the throughput and the peak memory of the export, which should not " \
+	       "grow with the room"
+
+	def add_arguments(self, parser):
+		super().add_arguments(parser)
+		parser.add_argument("--messages", type=int, nargs="+", default=[10000, 100000])
+
+	def run_benchmark(self, **options):
+		users = [User.objects.create_user(username=f"bench{index}", email=f"bench{index}@example.com",
+		                                  password="bench") for index in range(10)]
+		chat = ChatRoom.objects.create(name="bench")
+		for user in users:
+			chat.add_member(user)
+		results = {}
+		for count in sorted(options["messages"]):
+			seed_messages(chat, users, count - ChatMessage.objects.filter(chat=chat).count())
+			for compress in ("", "gzip"):
+				results[f"{count} messages{', gzip' if compress else ''}"] = self.export(chat, count, compress)
+		return results
+
+	@staticmethod
+	def export(chat, count: int, compress: str) -> dict:
+		gc.collect()
+		tracemalloc.start()
+		start = time.perf_counter()
+		size = sum(len(piece) for piece in export_room(chat.id, bool(compress)))
+		seconds = time.perf_counter() - start
+		_, peak = tracemalloc.get_traced_memory()
+		tracemalloc.stop()
+		return dict(bytes=size, seconds=round(seconds, 2), messages_per_sec=round(count / seconds), peak_kb=peak // 1024)
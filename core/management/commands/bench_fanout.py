@@ -0,0 +1,66 @@
+import asyncio
+import json
+import time
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.urls import path
+from rest_framework.authtoken.models import Token
+
+from ChatClone.routing import consumers
+from core.consumers import check_envelope
+from core.management.benchmark import BenchmarkCommand, measure
+from core.models import User, ChatRoom
+
+PAYLOAD_SIZES = {"1KB": 1024, "32KB": 32 * 1024}
+
+
+def make_frame(user_id, size: int) -> str:
+	frame = json.dumps(dict(event="TYPING", sender=user_id, data=dict(text="")))
+	return json.dumps(dict(event="TYPING", sender=user_id, data=dict(text="x" * (size - len(frame)))))
+
+
+class Command(BenchmarkCommand):
+	help = "Measures inbound frames per second every websocket consumer fans out, for 1KB and 32KB payloads"
+	iterations = 2000
+
+	def run_benchmark(self, **options):
+		user = User.objects.create_user(username="bench", email="bench@example.com", password="bench")
+		chat = ChatRoom.objects.create(name="bench")
+		chat.members.add(user)
+		token, _ = Token.objects.get_or_create(user=user)
+		paths = {
+			"chats": (f"/ws/{token.key}/chats/{chat.id}/", "ws/<token>/chats/<chat_id>/"),
+			"general": (f"/ws/{token.key}/general/", "ws/<token>/general/"),
+			"private": (f"/ws/{token.key}/private/", "ws/<token>/private/"),
+		}
+		results = {}
+		for label, size in PAYLOAD_SIZES.items():
+			frame = make_frame(user.id, size)
+			results[f"re-encode {label}"] = measure(lambda: json.dumps(json.loads(frame)), options["iterations"])
+			results[f"pass-through {label}"] = measure(lambda: check_envelope(frame, user.id), options["iterations"])
+			for route, implementations in consumers.items():
+				url, route_pattern = paths[route]
+				for mode, consumer in implementations.items():
+					application = URLRouter([path(route_pattern, consumer.as_asgi())])
+					results[f"{route} {mode} {label}"] = asyncio.run(
+						self.measure_throughput(application, url, frame, options["iterations"]))
+		return results
+
+	@staticmethod
+	async def measure_throughput(application, url: str, frame: str, count: int) -> dict:
+		"""
+		Sends count frames from a socket that is a member of the group it fans out to and waits for all of them
+		"""
+		communicator = WebsocketCommunicator(application, url)
+		connected, _ = await communicator.connect()
+		assert connected, "connection refused"
+		await communicator.receive_from()
+		start = time.perf_counter()
+		for _ in range(count):
+			await communicator.send_to(text_data=frame)
+			received = await communicator.receive_from()
+		seconds = time.perf_counter() - start
+		assert received == frame, "the frame was changed on the way"
+		await communicator.disconnect()
+		return dict(frames=count, frames_per_sec=round(count / seconds), bytes=len(frame))
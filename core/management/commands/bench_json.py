@@ -0,0 +1,40 @@
+from django.test import Client
+from django.test.utils import override_settings
+from rest_framework.authtoken.models import Token
+
+from core.codecs import CODECS, AVAILABLE, FastJSONRenderer
+from core.management.benchmark import BenchmarkCommand, measure, seed_messages
+from core.models import User, ChatRoom, ChatMessage, ChatAttachment
+
+
+class Command(BenchmarkCommand):
+	help = "Compares the JSON codecs on ChatMessageAPI.list pages, rendering alone and the whole request"
+	iterations = 100
+
+	def add_arguments(self, parser):
+		super().add_arguments(parser)
+		parser.add_argument("--page-size", type=int, default=100)
+
+	def run_benchmark(self, **options):
+		senders = [User.objects.create_user(username=f"sender{index}", email=f"sender{index}@example.com",
+		                                    password="sender") for index in range(5)]
+		chat = ChatRoom.objects.create(name="bench")
+		chat.members.add(*senders)
+		seed_messages(chat, senders, options["page_size"] * 2)
+		ChatAttachment.objects.bulk_create([ChatAttachment(message=message, picture=f"root/pictures/{message.id}.png")
+		                                    for message in ChatMessage.objects.filter(chat=chat)[::2]])
+		client = Client(HTTP_AUTHORIZATION=f"Token {Token.objects.create(user=senders[0]).key}")
+		params = {"chat_id": chat.id, "pagination": "cursor", "page_size": options["page_size"]}
+		page = client.get("/api/v1/chat-messages/", params).data
+
+		results = {}
+		for name, codec in CODECS.items():
+			if not AVAILABLE[name]:
+				continue
+			with override_settings(JSON_CODEC=name):
+				renderer = FastJSONRenderer()
+				results[f"{name} render"] = measure(lambda: renderer.render(page), options["iterations"])
+				results[f"{name} request"] = measure(lambda: client.get("/api/v1/chat-messages/", params),
+				                                     options["iterations"])
+			results[f"{name} render"]["bytes"] = len(codec.dumps_bytes(page))
+		return results
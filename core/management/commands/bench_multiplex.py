@@ -0,0 +1,119 @@
+import asyncio
+import gc
+import json
+import time
+import tracemalloc
+
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.urls import path
+from rest_framework.authtoken.models import Token
+
+from ChatClone.routing import consumers
+from core.consumers import MultiplexConsumer
+from core.management.benchmark import BenchmarkCommand
+from core.models import User, ChatRoom
+
+DRAIN_TIMEOUT = 1
+DRAIN_SECONDS_PER_SOCKET = 0.05
+
+
+class Command(BenchmarkCommand):
+	help = "Compares the sockets, group memberships and memory a user in many rooms costs with one socket " \
+	       "per channel against a single multiplexed socket"
+
+	def add_arguments(self, parser):
+		super().add_arguments(parser)
+		parser.add_argument("--users", type=int, default=20)
+		parser.add_argument("--rooms", type=int, default=30, help="rooms every user is a member of")
+
+	def run_benchmark(self, **options):
+		users = [User.objects.create_user(username=f"bench{index}", email=f"bench{index}@example.com",
+		                                  password="bench") for index in range(options["users"])]
+		rooms = [ChatRoom.objects.create(name=f"bench {index}") for index in range(options["rooms"])]
+		for room in rooms:
+			room.members.add(*users)
+		tokens = [Token.objects.get_or_create(user=user)[0].key for user in users]
+		results = {}
+		for mode, consumer in consumers["chats"].items():
+			application = URLRouter([
+				path("ws/<token>/chats/<chat_id>/", consumer.as_asgi()),
+				path("ws/<token>/general/", consumers["general"][mode].as_asgi()),
+				path("ws/<token>/private/", consumers["private"][mode].as_asgi()),
+			])
+			results[f"separate {mode}"] = asyncio.run(self.measure(application, tokens, rooms, self.connect_separate))
+		application = URLRouter([path("ws/<token>/", MultiplexConsumer.as_asgi())])
+		results["multiplex"] = asyncio.run(self.measure(application, tokens, rooms, self.connect_multiplexed))
+		return results
+
+	@staticmethod
+	async def connect_separate(application, token: str, rooms) -> list:
+		"""
+		:return: [(communicator, room events it receives)]
+		"""
+		urls = [(f"/ws/{token}/general/", 0), (f"/ws/{token}/private/", 0)]
+		urls += [(f"/ws/{token}/chats/{room.id}/", 1) for room in rooms]
+		communicators = []
+		for url, events in urls:
+			communicator = WebsocketCommunicator(application, url)
+			connected, _ = await communicator.connect()
+			assert connected, "connection refused"
+			await communicator.receive_from()
+			communicators.append((communicator, events))
+		return communicators
+
+	@staticmethod
+	async def connect_multiplexed(application, token: str, rooms) -> list:
+		communicator = WebsocketCommunicator(application, f"/ws/{token}/")
+		connected, _ = await communicator.connect()
+		assert connected, "connection refused"
+		await communicator.receive_from()
+		for room in rooms:
+			await communicator.send_to(text_data=json.dumps({"action": "subscribe", "chat": room.id}))
+			assert json.loads(await communicator.receive_from())["ok"], "subscription refused"
+		return [(communicator, len(rooms))]
+
+	@staticmethod
+	async def drain(communicator, events: int, timeout: float):
+		for _ in range(events):
+			await communicator.receive_from(timeout)
+
+	async def measure(self, application, tokens, rooms, connect) -> dict:
+		users = len(tokens)
+		layer = get_channel_layer()
+		# the sync consumers leave their groups behind, they would be counted and sent to otherwise
+		await layer.flush()
+		gc.collect()
+		tracemalloc.start()
+		baseline, _ = tracemalloc.get_traced_memory()
+		start = time.perf_counter()
+		communicators = []
+		for token in tokens:
+			communicators += await connect(application, token, rooms)
+		connect_seconds = time.perf_counter() - start
+		gc.collect()
+		current, _ = tracemalloc.get_traced_memory()
+		memberships = sum(len(channels) for channels in layer.groups.values())
+
+		# every user gets one event from every room, on whichever socket carries it
+		start = time.perf_counter()
+		for room in rooms:
+			await layer.group_send(str(room), {"type": "notify", "data": "{}", "group": str(room)})
+		# every socket is served by the same loop, the last one may wait on all the others before its first frame
+		timeout = DRAIN_TIMEOUT + DRAIN_SECONDS_PER_SOCKET * len(communicators)
+		await asyncio.gather(*(self.drain(communicator, events, timeout) for communicator, events in communicators))
+		fan_out_seconds = time.perf_counter() - start
+
+		for communicator, _ in communicators:
+			await communicator.disconnect()
+		tracemalloc.stop()
+		return dict(
+			users=users,
+			rooms_per_user=len(rooms),
+			sockets_per_user=len(communicators) // users,
+			group_memberships_per_user=memberships // users,
+			kb_per_user=round((current - baseline) / users / 1024, 2),
+			connect_ms_per_user=round(connect_seconds * 1000 / users, 2),
+			fan_out_ms=round(fan_out_seconds * 1000, 2),
+		)
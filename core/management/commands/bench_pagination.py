@@ -0,0 +1,41 @@
+from django.test import Client
+from rest_framework.authtoken.models import Token
+
+from core.helpers import KeysetPagination
+from core.management.benchmark import BenchmarkCommand, measure, seed_messages
+from core.models import User, ChatRoom, ChatMessage
+
+
+class Command(BenchmarkCommand):
+	help = "Compares message history latency of page number and cursor pagination from the newest to the oldest page"
+	iterations = 20
+
+	def add_arguments(self, parser):
+		super().add_arguments(parser)
+		parser.add_argument("--page-size", type=int, default=20)
+		parser.add_argument("--pages", type=int, nargs="+", default=[1, 10, 100, 1000, 10000])
+
+	def run_benchmark(self, **options):
+		page_size = options["page_size"]
+		pages = options["pages"]
+		user = User.objects.create_user(username="bench", email="bench@example.com", password="bench")
+		chat = ChatRoom.objects.create(name="bench")
+		chat.add_member(user)
+		seed_messages(chat, [user], max(pages) * page_size)
+		client = Client(HTTP_AUTHORIZATION=f"Token {Token.objects.create(user=user).key}")
+		history = ChatMessage.objects.filter(chat=chat).order_by("-time_sent", "-id")
+
+		def get(params):
+			def run():
+				response = client.get("/api/v1/chat-messages/", dict(chat_id=chat.id, page_size=page_size, **params))
+				assert response.status_code == 200, response.content
+			return run
+
+		results = {}
+		for page in pages:
+			results[f"page number, page {page}"] = measure(get(dict(page=page)), options["iterations"])
+			params = dict(pagination="cursor")
+			if page > 1:
+				params["before"] = KeysetPagination.encode_cursor(history[(page - 1) * page_size - 1])
+			results[f"cursor, page {page}"] = measure(get(params), options["iterations"])
+		return results
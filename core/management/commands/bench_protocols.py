@@ -0,0 +1,98 @@
+import asyncio
+import json
+import time
+
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.urls import path
+from rest_framework.authtoken.models import Token
+
+from ChatClone.routing import consumers
+from core import codecs
+from core.helpers import ChannelPublisher
+from core.management.benchmark import BenchmarkCommand
+from core.models import User, ChatRoom, ChatMessage, ChatAttachment
+from core.services import ChatMessageSerializer
+
+
+def microseconds(func, iterations: int) -> float:
+	start = time.perf_counter()
+	for _ in range(iterations):
+		func()
+	return round((time.perf_counter() - start) / iterations * 1000000, 2)
+
+
+class Command(BenchmarkCommand):
+	help = "Compares bytes on the wire and CPU per NEW MESSAGE event of the json and MessagePack websocket protocols"
+	iterations = 2000
+
+	def payloads(self):
+		sender = User.objects.create_user(username="sender", email="sender@example.com", password="sender",
+		                                  first_name="Ada", last_name="Lovelace", profile_picture="profile_pics/ada.png")
+		chat = ChatRoom.objects.create(name="bench")
+		chat.add_member(sender)
+		short = ChatMessage.objects.create(chat=chat, sender=sender, text="see you at 5?")
+		long = ChatMessage.objects.create(chat=chat, sender=sender, text="lorem ipsum dolor sit amet " * 80)
+		pictures = ChatMessage.objects.create(chat=chat, sender=sender, text="holiday")
+		for index in range(3):
+			ChatAttachment.objects.create(message=pictures, picture=f"root/pictures/{index}.jpg")
+		events = {}
+		for name, message in (("short text", short), ("long text", long), ("3 pictures", pictures)):
+			events[name] = ChannelPublisher.build_message("NEW MESSAGE", ChatMessageSerializer(message).data,
+			                                              sender=sender.id)["data"]
+		return sender, chat, events
+
+	def run_benchmark(self, **options):
+		if not codecs.msgpack:
+			return {"msgpack": "not installed"}
+		sender, chat, events = self.payloads()
+		iterations = options["iterations"]
+		codec = codecs.get_codec()
+		transcode = codecs.json_to_msgpack.__wrapped__
+		results = {}
+		for name, text in events.items():
+			packed = transcode(text)
+			envelope = codec.loads(text)
+			assert codecs.msgpack_to_python(packed) == envelope
+			results[f"{name} json"] = dict(
+				bytes=len(text.encode()),
+				encode_us=microseconds(lambda: codec.dumps(envelope), iterations),
+				decode_us=microseconds(lambda: json.loads(text), iterations),
+			)
+			results[f"{name} msgpack"] = dict(
+				bytes=len(packed),
+				encode_us=microseconds(lambda: codecs.msgpack.packb(envelope), iterations),
+				decode_us=microseconds(lambda: codecs.msgpack_to_python(packed), iterations),
+				transcode_us=microseconds(lambda: transcode(text), iterations),
+			)
+		token = Token.objects.create(user=sender)
+		application = URLRouter([path("ws/<token>/chats/<chat_id>/", consumers["chats"]["async"].as_asgi())])
+		for protocol in ("json", codecs.MSGPACK_SUBPROTOCOL):
+			results[f"fan-out {protocol}"] = asyncio.run(self.fan_out(
+				application, f"/ws/{token.key}/chats/{chat.id}/", str(chat), events["3 pictures"], protocol,
+				iterations))
+		return results
+
+	@staticmethod
+	async def fan_out(application, url: str, group: str, text: str, protocol: str, count: int) -> dict:
+		"""
+		Sends count group events to a socket speaking protocol and times their delivery
+		"""
+		communicator = WebsocketCommunicator(application, url, subprotocols=[protocol])
+		connected, subprotocol = await communicator.connect()
+		assert connected, "connection refused"
+		await communicator.receive_from()
+		layer = get_channel_layer()
+		received = 0
+		loop = asyncio.get_running_loop()
+		start = loop.time()
+		# distinct events, so the transcoding cache only helps the way it does between sockets of a group
+		events = [f'{text[:-1]},"sequence":{index}}}' for index in range(count)]
+		for event in events:
+			await layer.group_send(group, {"type": "notify", "data": event})
+			frame = await communicator.receive_output()
+			received += len(frame.get("bytes") or frame.get("text").encode())
+		seconds = loop.time() - start
+		await communicator.disconnect()
+		return dict(subprotocol=subprotocol, events_per_sec=round(count / seconds), bytes_per_event=received // count)
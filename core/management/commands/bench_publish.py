@@ -0,0 +1,96 @@
+import asyncio
+import json
+import threading
+from unittest import mock
+
+import websockets
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import Client
+from django.test.utils import override_settings
+from rest_framework.authtoken.models import Token
+
+from core.helpers import ChannelPublisher
+from core.management.benchmark import BenchmarkCommand, measure
+from core.models import User, ChatRoom
+
+
+class LegacyWebsocketServer(threading.Thread):
+	"""
+	Stand-in for the daphne websocket route the old helpers connected to, it greets every
+	connection and reads one frame just like ChatConsumer did
+	"""
+	def __init__(self):
+		super().__init__(daemon=True)
+		self.port = None
+		self.ready = threading.Event()
+
+	async def handler(self, websocket, *args):
+		await websocket.send("connected")
+		await websocket.recv()
+
+	async def serve(self):
+		async with websockets.serve(self.handler, "127.0.0.1", 0) as server:
+			self.port = server.sockets[0].getsockname()[1]
+			self.ready.set()
+			await asyncio.Future()
+
+	def run(self):
+		asyncio.run(self.serve())
+
+
+def legacy_send_ws_to_chat(port):
+	async def websocket_client(url, payload):
+		async with websockets.connect(url) as websocket:
+			await websocket.send(payload)
+			await websocket.recv()
+
+	def send_ws_to_chat(user, chat_id: int, event: str, data: dict):
+		payload = dict(event=event, data=data, sender=user.id)
+		token, created = Token.objects.get_or_create(user=user)
+		url = f"ws://127.0.0.1:{port}/ws/{token.key}/chats/{chat_id}/"
+		loop = asyncio.new_event_loop()
+		try:
+			loop.run_until_complete(websocket_client(url, json.dumps(payload)))
+		finally:
+			loop.close()
+	return send_ws_to_chat
+
+
+class Command(BenchmarkCommand):
+	help = "Compares message POST latency of the old per-event websocket client against the channel layer publisher"
+	iterations = 100
+
+	def add_arguments(self, parser):
+		super().add_arguments(parser)
+		parser.add_argument("--listeners", type=int, default=20, help="sockets subscribed to the chat group")
+
+	def run_benchmark(self, **options):
+		user = User.objects.create_user(username="bench", email="bench@example.com", password="bench")
+		chat = ChatRoom.objects.create(name="bench")
+		chat.members.add(user)
+		token, _ = Token.objects.get_or_create(user=user)
+		channel_layer = get_channel_layer()
+		for index in range(options["listeners"]):
+			async_to_sync(channel_layer.group_add)(str(chat), f"bench.listener{index}")
+
+		client = Client(HTTP_AUTHORIZATION=f"Token {token.key}")
+
+		def post_message():
+			response = client.post("/api/v1/chat-messages/", data={
+				"chat": chat.id, "text": "hello", "file": SimpleUploadedFile("a.txt", b"a", "text/plain")})
+			assert response.status_code == 200, response.content
+
+		server = LegacyWebsocketServer()
+		server.start()
+		server.ready.wait()
+		results = {}
+		with mock.patch("core.services.send_ws_to_chat", legacy_send_ws_to_chat(server.port)):
+			results["post legacy websocket client"] = measure(post_message, options["iterations"])
+		with override_settings(WEBSOCKET_PUBLISH_DEFERRED=False):
+			results["post channel layer"] = measure(post_message, options["iterations"])
+		with override_settings(WEBSOCKET_PUBLISH_DEFERRED=True):
+			results["post channel layer deferred"] = measure(post_message, options["iterations"])
+			ChannelPublisher.flush()
+		return results
@@ -0,0 +1,55 @@
+from django.db import connection
+
+from core.management.benchmark import BenchmarkCommand, measure, seed_messages, table_bytes
+from core.models import User, ChatRoom, ChatMessage, RoomReadState
+
+
+class Command(BenchmarkCommand):
+	help = "Compares table size and message list latency of the legacy viewers table against read watermarks"
+	iterations = 50
+
+	def add_arguments(self, parser):
+		super().add_arguments(parser)
+		parser.add_argument("--messages", type=int, default=1000000)
+		parser.add_argument("--members", type=int, default=5)
+		parser.add_argument("--page-size", type=int, default=20)
+
+	def run_benchmark(self, **options):
+		members = [User.objects.create_user(username=f"member{index}", email=f"member{index}@example.com",
+		                                    password="member") for index in range(options["members"])]
+		chat = ChatRoom.objects.create(name="bench")
+		chat.members.add(*members)
+		seed_messages(chat, members, options["messages"])
+
+		# every member has read everything, which is what the viewers table grows towards
+		viewers = ChatMessage.viewers.through
+		with connection.cursor() as cursor:
+			cursor.execute(
+				f"INSERT INTO {viewers._meta.db_table} (chatmessage_id, user_id) "
+				f"SELECT message.id, member.id FROM {ChatMessage._meta.db_table} message "
+				f"CROSS JOIN {User._meta.db_table} member WHERE message.sender_id <> member.id")
+		newest = ChatMessage.objects.filter(chat=chat).order_by("-id").values_list("id", flat=True).first()
+		for member in members:
+			RoomReadState.objects.create(user=member, room=chat, last_read_message_id=newest)
+
+		reader = members[0]
+		page = list(ChatMessage.objects.filter(chat=chat).order_by("-id")[:options["page_size"]])
+
+		def legacy_page():
+			for message in page:
+				message.viewers.count()
+				message.viewers.filter(id=reader.id).exists()
+
+		def watermark_page():
+			for message in page:
+				message.count_viewers()
+				message.viewed(reader.id)
+
+		return {
+			"viewers table": dict(rows=viewers.objects.count(), bytes=table_bytes(viewers)),
+			"read state table": dict(rows=RoomReadState.objects.count(), bytes=table_bytes(RoomReadState)),
+			"list page legacy viewers": measure(legacy_page, options["iterations"]),
+			"list page watermarks": measure(watermark_page, options["iterations"]),
+			"unread count watermarks": measure(lambda: RoomReadState.unread_count(reader.id, chat.id),
+			                                   options["iterations"]),
+		}
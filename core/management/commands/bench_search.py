@@ -0,0 +1,93 @@
+import gc
+import time
+
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from rest_framework.authtoken.models import Token
+
+from core.management.benchmark import BenchmarkCommand, measure, seed_dataset, table_bytes
+from core.models import ChatRoom, ChatMessage
+from core.search import get_backend
+
+PAGE_SIZE = 20
+
+
+class Command(BenchmarkCommand):
+	help = "Seeds messages of zipf distributed words and times the search endpoint for common, rare, multi word and " \
+	       "prefix queries against an unindexed scan, with the cost of building and maintaining the index"
+	iterations = 20
+
+	def add_arguments(self, parser):
+		super().add_arguments(parser)
+		parser.add_argument("--users", type=int, default=1000)
+		parser.add_argument("--rooms", type=int, default=50)
+		parser.add_argument("--members-per-room", type=int, default=100)
+		parser.add_argument("--messages", type=int, default=1000000)
+		parser.add_argument("--words", type=int, default=8, help="words in every message")
+		parser.add_argument("--vocabulary", type=int, default=5000, help="distinct words the messages are made of")
+		parser.add_argument("--seed", type=int, default=1)
+
+	def run_benchmark(self, **options):
+		backend = get_backend()
+		start = time.perf_counter()
+		dataset = seed_dataset(options["users"], options["rooms"], options["members_per_room"], options["messages"],
+		                       seed=options["seed"], words=options["words"],
+		                       vocabulary_size=options["vocabulary"])
+		# the triggers index every message as it is inserted
+		seed_seconds = time.perf_counter() - start
+		start = time.perf_counter()
+		backend.rebuild()
+		rebuild_seconds = time.perf_counter() - start
+		vocabulary = dataset["vocabulary"]
+		room = ChatRoom.objects.get(id=dataset["rooms"][0])
+		viewer = room.admins.get()
+		client = Client(HTTP_AUTHORIZATION=f"Token {Token.objects.create(user=viewer).key}")
+
+		def search(**params):
+			def run():
+				response = client.get("/api/v1/chat-messages/search/", dict(page_size=PAGE_SIZE, **params))
+				assert response.status_code == 200, response.content
+				return response.json()
+			return run
+
+		common, middle, rare = vocabulary[0], vocabulary[len(vocabulary) // 50], vocabulary[-1]
+		cases = {
+			"common word": search(q=common),
+			"common word, next page": search(q=common, after=search(q=common)()["next"]),
+			"mid frequency word": search(q=middle),
+			"mid frequency word, one room": search(q=middle, chat_id=room.id),
+			"rare word": search(q=rare),
+			"two words": search(q=f"{vocabulary[1]} {vocabulary[20]}"),
+			"prefix": search(q=vocabulary[10][:3]),
+		}
+		results = dict(dataset=dict(
+			messages=options["messages"], words=options["words"], vocabulary=len(vocabulary),
+			viewer_rooms=viewer.members.count(), backend=type(backend).__name__, seed_s=round(seed_seconds, 2),
+			rebuild_s=round(rebuild_seconds, 2), table_bytes=table_bytes(ChatMessage),
+			index_bytes=backend.index_bytes()))
+		for name, func in cases.items():
+			gc.collect()
+			with CaptureQueriesContext(connection) as queries:
+				hits = len(func()["results"])
+			results[name] = dict(hits=hits, queries=len(queries), **measure(func, options["iterations"], warmup=2))
+
+		# what the endpoint would cost without an index, an unranked scan of the viewer's rooms
+		def scan(term):
+			def run():
+				return list(ChatMessage.objects.filter(chat__members=viewer, text__icontains=term).
+				            order_by("-id")[:PAGE_SIZE])
+			return run
+		for name, term in (("common word", common), ("rare word", rare)):
+			gc.collect()
+			results[f"{name}, icontains scan"] = dict(hits=len(scan(term)()),
+			                                          **measure(scan(term), options["iterations"], warmup=2))
+
+		# every insert also writes the index
+		messages = iter(range(options["iterations"] + 5))
+		sender = viewer
+
+		def insert():
+			ChatMessage.objects.create(chat=room, sender=sender, text=f"{common} {rare} {next(messages)}")
+		results["indexed insert"] = measure(insert, options["iterations"])
+		return results
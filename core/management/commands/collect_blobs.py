@@ -0,0 +1,19 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from core.models import Blob
+
+
+class Command(BaseCommand):
+	help = "Deletes the deduplicated attachment files that no attachment references anymore"
+
+	def add_arguments(self, parser):
+		parser.add_argument("--grace-hours", type=float, default=24,
+		                    help="keep unreferenced blobs stored more recently than this, they may be mid upload")
+		parser.add_argument("--dry-run", action="store_true", help="only report what would be deleted")
+
+	def handle(self, *args, **options):
+		count, freed = Blob.collect(timedelta(hours=options["grace_hours"]), options["dry_run"])
+		verb = "would delete" if options["dry_run"] else "deleted"
+		self.stdout.write(f"{verb} {count} unreferenced blobs, {freed} bytes")
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from core.models import UploadSession, RoomExport
+
+
+class Command(BaseCommand):
+	help = "Deletes upload sessions that expired before being finalized, together with their chunks, and expired " \
+	       "room exports"
+
+	def handle(self, *args, **options):
+		self.stdout.write(f"deleted {UploadSession.delete_expired()} expired upload sessions and "
+		                  f"{RoomExport.delete_expired()} expired room exports")
@@ -0,0 +1,108 @@
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from rest_framework.authtoken.models import Token
+
+from core.caches import auth_cache
+from core.consumers import ChatConsumer
+from core.management.benchmark import BenchmarkCommand, seed_messages
+from core.models import User, ChatRoom, ChatMessage
+
+EXPLAINED_STATEMENTS = ("SELECT", "UPDATE", "DELETE")
+
+
+class Command(BenchmarkCommand):
+	help = "Runs EXPLAIN on every query issued by the chat hot paths and flags full table scans"
+
+	def add_arguments(self, parser):
+		super().add_arguments(parser)
+		parser.add_argument("--check", action="store_true", help="fail when a hot query does a full table scan")
+		parser.add_argument("--verbose-plans", action="store_true", help="print the plan of every query")
+
+	def seed(self):
+		user = User.objects.create_user(username="Reader", email="reader@example.com", password="reader")
+		other = User.objects.create_user(username="writer", email="writer@example.com", password="writer")
+		chat = ChatRoom.objects.create(name="explain")
+		chat.add_member(user)
+		chat.add_member(other)
+		chat.admins.add(user)
+		spare = ChatRoom.objects.create(name="spare")
+		seed_messages(chat, [user, other], 100)
+		return dict(user=user, chat=chat, spare=spare, token=Token.objects.create(user=user))
+
+	def hot_paths(self, user, chat, spare, token):
+		"""
+			Returns (name, callable) for every hot path of core/controllers.py, core/services.py and the consumers
+		:return:
+		"""
+		client = Client(HTTP_AUTHORIZATION=f"Token {token.key}")
+		newest = ChatMessage.objects.filter(chat=chat).order_by("-id").first()
+
+		def request(method, url, data=None, **extra):
+			def run():
+				response = getattr(client, method)(url, data or {}, **extra)
+				assert response.status_code < 400, response.content
+			return run
+
+		def consumer_connect():
+			auth_cache.clear()
+			ChatConsumer.is_authenticated({"url_route": {"kwargs": {"token": token.key, "chat_id": str(chat.id)}}})
+
+		def join_and_leave():
+			request("post", "/api/v1/chat-rooms/actions/", {"chat": spare.id, "action": "join"})()
+			request("post", "/api/v1/chat-rooms/actions/", {"chat": spare.id, "action": "leave"})()
+
+		return [
+			("LoginAPI.post", request("post", "/api/v1/login/", {"username": "reader", "password": "reader"})),
+			("ChatRoomAPI.list", request("get", "/api/v1/chat-rooms/")),
+			("ChatRoomAPI.retrieve", request("get", f"/api/v1/chat-rooms/{chat.id}/")),
+			("ChatMessageAPI.list", request("get", "/api/v1/chat-messages/", {"chat_id": chat.id, "page": 2})),
+			("ChatMessageAPI.list cursor", request("get", "/api/v1/chat-messages/", {
+				"chat_id": chat.id, "pagination": "cursor", "count": "true"})),
+			("ChatMessageAPI.retrieve", request("get", f"/api/v1/chat-messages/{newest.id}/", {"chat_id": chat.id})),
+			("ChatActionsAPI.post", join_and_leave),
+			("consumer connect", consumer_connect),
+		]
+
+	@staticmethod
+	def explain(sql: str):
+		with connection.cursor() as cursor:
+			if connection.vendor == "sqlite":
+				cursor.execute(f"EXPLAIN QUERY PLAN {sql}")
+				return [row[-1] for row in cursor.fetchall()]
+			cursor.execute(f"EXPLAIN {sql}")
+			return [row[0] for row in cursor.fetchall()]
+
+	@staticmethod
+	def full_scans(plan):
+		if connection.vendor == "sqlite":
+			# "SCAN table" reads every row, "SCAN table USING INDEX" walks a whole index in order
+			return [line for line in plan if line.startswith("SCAN ") and "CONSTANT ROW" not in line]
+		return [line.strip() for line in plan if "Seq Scan" in line]
+
+	def run_benchmark(self, **options):
+		results = {}
+		self.flagged = []
+		for name, func in self.hot_paths(**self.seed()):
+			with CaptureQueriesContext(connection) as queries:
+				func()
+			statements = {query["sql"] for query in queries if query["sql"].lstrip().upper().startswith(
+				EXPLAINED_STATEMENTS)}
+			scans = []
+			for sql in sorted(statements):
+				plan = self.explain(sql)
+				if options["verbose_plans"]:
+					self.stdout.write(f"{name}: {sql}\n    " + "\n    ".join(plan))
+				for line in self.full_scans(plan):
+					scans.append(line)
+					self.flagged.append((name, sql, line))
+			results[name] = dict(queries=len(statements), full_scans=len(scans))
+		return results
+
+	def handle(self, *args, **options):
+		super().handle(*args, **options)
+		for name, sql, line in self.flagged:
+			self.stdout.write(f"{name}: {line}\n    {sql}")
+		if options["check"] and self.flagged:
+			raise CommandError(f"{len(self.flagged)} hot queries do full table scans")
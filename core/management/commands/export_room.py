@@ -0,0 +1,29 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.exports import export_room, CHUNK_SIZE
+from core.models import ChatRoom
+
+
+class Command(BaseCommand):
+	help = "Writes the whole history of a room as newline delimited json, oldest first, to a file or stdout"
+
+	def add_arguments(self, parser):
+		parser.add_argument("room", type=int, help="id of the room")
+		parser.add_argument("--output", default="-", help="file to write, stdout by default")
+		parser.add_argument("--gzip", action="store_true")
+		parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="messages read from the database at once")
+
+	def handle(self, *args, **options):
+		if not ChatRoom.objects.filter(id=options["room"]).exists():
+			raise CommandError(f"Room {options['room']} does not exist")
+		output = sys.stdout.buffer if options["output"] == "-" else open(options["output"], "wb")
+		try:
+			for piece in export_room(options["room"], options["gzip"], options["chunk_size"]):
+				output.write(piece)
+		finally:
+			if output is not sys.stdout.buffer:
+				output.close()
+			else:
+				output.flush()
@@ -0,0 +1,187 @@
+import asyncio
+import itertools
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+import websockets
+from django.conf import settings
+from django.core.management.base import CommandError
+from django.db import connection
+from rest_framework.authtoken.models import Token
+
+from core.management.benchmark import BenchmarkCommand, summarize
+from core.models import User, ChatRoom
+
+ROUTES = ("chats", "general", "private")
+# module and arguments before the application path, uvicorn's websockets protocol waits for slow clients to drain
+SERVERS = {
+	"uvicorn": lambda port: ["uvicorn", "--host", "127.0.0.1", "--port", str(port), "--ws", "websockets",
+	                         "--log-level", "warning"],
+	"daphne": lambda port: ["daphne", "-b", "127.0.0.1", "-p", str(port), "-v", "0"],
+}
+
+
+def free_port() -> int:
+	with socket.socket() as sock:
+		sock.bind(("127.0.0.1", 0))
+		return sock.getsockname()[1]
+
+
+def process_cpu_seconds(pid: int) -> float or None:
+	"""
+	User and system cpu time of a process, None where /proc is not available
+	"""
+	try:
+		with open(f"/proc/{pid}/stat") as stat:
+			fields = stat.read().rsplit(")", 1)[1].split()
+	except OSError:
+		return None
+	return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+class Socket:
+	def __init__(self, route: str, group: str, user_id: int, url: str):
+		self.route = route
+		self.group = group
+		self.user_id = user_id
+		self.url = url
+		self.connection = None
+
+
+class Command(BenchmarkCommand):
+	help = "Seeds users and rooms, serves them with uvicorn or daphne on the in-memory channel layer and drives websocket " \
+	       "traffic through the chats, general and private sockets of every user, reporting fan-out latency, " \
+	       "delivered and dropped events and the cpu the server used"
+	database_file = True
+
+	def add_arguments(self, parser):
+		super().add_arguments(parser)
+		parser.add_argument("--users", type=int, default=20)
+		parser.add_argument("--rooms", type=int, default=5, help="rooms every user is a member of and connects to")
+		parser.add_argument("--routes", default="chats,general", help="routes messages are sent on")
+		parser.add_argument("--rate", type=int, default=200, help="messages sent per second")
+		parser.add_argument("--duration", type=float, default=10, help="seconds messages are sent for")
+		parser.add_argument("--drain", type=float, default=5, help="seconds to wait for the last deliveries")
+		parser.add_argument("--consumers", choices=("sync", "async"), default="sync")
+		parser.add_argument("--server", dest="server_name", choices=tuple(SERVERS), default="uvicorn")
+		parser.add_argument("--payload", type=int, default=200, help="bytes of text in every message")
+
+	def run_benchmark(self, **options):
+		if set(options["routes"].split(",")) - set(ROUTES):
+			raise CommandError(f"routes must be among {', '.join(ROUTES)}")
+		User.objects.bulk_create([
+			User(username=f"load{index}", email=f"load{index}@example.com") for index in range(options["users"])])
+		users = list(User.objects.filter(username__startswith="load"))
+		ChatRoom.objects.bulk_create([ChatRoom(name=f"load {index}") for index in range(options["rooms"])])
+		rooms = list(ChatRoom.objects.filter(name__startswith="load"))
+		ChatRoom.members.through.objects.bulk_create([
+			ChatRoom.members.through(chatroom_id=room.id, user_id=user.id) for room in rooms for user in users])
+		tokens = {user.id: Token.objects.create(user=user).key for user in users}
+		port = free_port()
+
+		sockets = []
+		for user in users:
+			prefix = f"ws://127.0.0.1:{port}/ws/{tokens[user.id]}"
+			sockets += [Socket("chats", str(room), user.id, f"{prefix}/chats/{room.id}/") for room in rooms]
+			sockets.append(Socket("general", "general", user.id, f"{prefix}/general/"))
+			sockets.append(Socket("private", str(user), user.id, f"{prefix}/private/"))
+
+		server = self.start_server(port, options["consumers"], options["server_name"])
+		try:
+			return {f"{options['consumers']} consumers": asyncio.run(self.load(server, port, sockets, **options))}
+		finally:
+			server.terminate()
+			server.wait(10)
+
+	def start_server(self, port: int, consumers: str, name: str) -> subprocess.Popen:
+		environment = dict(
+			os.environ, DJANGO_SETTINGS_MODULE=os.environ.get("DJANGO_SETTINGS_MODULE", "ChatClone.settings"),
+			DATABASE_NAME=str(connection.settings_dict["NAME"]), CHANNEL_LAYER="memory",
+			WEBSOCKET_CHATS_CONSUMER=consumers, WEBSOCKET_GENERAL_CONSUMER=consumers,
+			WEBSOCKET_PRIVATE_CONSUMER=consumers, WEBSOCKET_PUBLISH_DEFERRED="False")
+		server = subprocess.Popen([sys.executable, "-m"] + SERVERS[name](port) + ["ChatClone.asgi:application"],
+		                          cwd=settings.BASE_DIR, env=environment)
+		deadline = time.monotonic() + 30
+		while time.monotonic() < deadline:
+			if server.poll() is not None:
+				raise CommandError(f"{name} exited before it started listening")
+			try:
+				socket.create_connection(("127.0.0.1", port), timeout=1).close()
+				return server
+			except OSError:
+				time.sleep(0.2)
+		server.terminate()
+		raise CommandError(f"{name} did not start listening")
+
+	async def load(self, server, port: int, sockets: list, routes: str, rate: int, duration: float, drain: float,
+	               payload: int, **options) -> dict:
+		members = defaultdict(int)
+		origin = f"http://127.0.0.1:{port}"
+		start = time.perf_counter()
+		for batch in range(0, len(sockets), 100):
+			await asyncio.gather(*(self.connect(item, origin) for item in sockets[batch:batch + 100]))
+		connect_seconds = time.perf_counter() - start
+		for item in sockets:
+			members[item.group] += 1
+
+		latencies = []
+		readers = [asyncio.create_task(self.read(item, latencies)) for item in sockets]
+		senders = itertools.cycle([item for item in sockets if item.route in routes.split(",")])
+		text = "x" * payload
+		expected = 0
+		server_cpu = process_cpu_seconds(server.pid)
+		client_cpu = time.process_time()
+		start = time.perf_counter()
+		for sequence in range(int(rate * duration)):
+			sender = next(senders)
+			frame = json.dumps(dict(event="LOAD TEST", sender=sender.user_id,
+			                        data=dict(sequence=sequence, text=text, sent=time.time())))
+			await sender.connection.send(frame)
+			expected += members[sender.group]
+			await asyncio.sleep(max(0.0, start + (sequence + 1) / rate - time.perf_counter()))
+		send_seconds = time.perf_counter() - start
+		deadline = time.perf_counter() + drain
+		while len(latencies) < expected and time.perf_counter() < deadline:
+			await asyncio.sleep(0.05)
+		wall = time.perf_counter() - start
+		if server_cpu is not None:
+			server_cpu = process_cpu_seconds(server.pid) - server_cpu
+		client_cpu = time.process_time() - client_cpu
+		delivered = len(latencies)
+		latency = {f"latency_{key}": value for key, value in summarize(latencies).items() if key != "count"}
+
+		for reader in readers:
+			reader.cancel()
+		await asyncio.gather(*(item.connection.close() for item in sockets), return_exceptions=True)
+		return dict(
+			sockets=len(sockets),
+			connects_per_sec=round(len(sockets) / connect_seconds),
+			sent=int(rate * duration),
+			achieved_rate=round(int(rate * duration) / send_seconds),
+			expected=expected,
+			delivered=delivered,
+			dropped=expected - delivered,
+			**latency,
+			server_cpu_s=round(server_cpu, 2) if server_cpu is not None else None,
+			server_cpu_percent=round(server_cpu * 100 / wall, 1) if server_cpu is not None else None,
+			client_cpu_s=round(client_cpu, 2),
+		)
+
+	@staticmethod
+	async def connect(item: Socket, origin: str):
+		item.connection = await websockets.connect(item.url, origin=origin, max_queue=None)
+		# the greeting
+		await item.connection.recv()
+
+	@staticmethod
+	async def read(item: Socket, latencies: list):
+		async for frame in item.connection:
+			received = time.time()
+			event = json.loads(frame)
+			if event.get("event") == "LOAD TEST":
+				latencies.append((received - event["data"]["sent"]) * 1000)
@@ -0,0 +1,46 @@
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max
+
+from core.models import ChatMessage, RoomReadState
+
+
+class Command(BaseCommand):
+	help = "Copies the legacy ChatMessage.viewers rows into per user RoomReadState watermarks and recounts " \
+	       "viewers_count from them"
+
+	def add_arguments(self, parser):
+		parser.add_argument("--batch-size", type=int, default=5000)
+		parser.add_argument("--clear", action="store_true", help="empty the legacy viewers table afterwards")
+
+	@transaction.atomic
+	def handle(self, *args, **options):
+		viewers = ChatMessage.viewers.through
+		watermarks = viewers.objects.values("user_id", "chatmessage__chat_id").\
+			annotate(last_read=Max("chatmessage_id")).order_by()
+		batch = []
+		migrated = 0
+		for row in watermarks.iterator(chunk_size=options["batch_size"]):
+			batch.append(row)
+			if len(batch) >= options["batch_size"]:
+				migrated += self.save_batch(batch)
+				batch = []
+		migrated += self.save_batch(batch)
+		self.stdout.write(f"migrated {migrated} read states")
+		# viewers_count is counted from the watermarks now, the ones just written are not in it yet
+		call_command("repair_counters", batch_size=options["batch_size"], stdout=self.stdout)
+		if options["clear"]:
+			deleted, _ = viewers.objects.all().delete()
+			self.stdout.write(f"removed {deleted} legacy viewer rows")
+
+	@staticmethod
+	def save_batch(batch) -> int:
+		RoomReadState.objects.bulk_create(
+			[RoomReadState(user_id=row["user_id"], room_id=row["chatmessage__chat_id"]) for row in batch],
+			ignore_conflicts=True)
+		for row in batch:
+			RoomReadState.objects.filter(user_id=row["user_id"], room_id=row["chatmessage__chat_id"],
+			                             last_read_message_id__lt=row["last_read"]).\
+				update(last_read_message_id=row["last_read"])
+		return len(batch)
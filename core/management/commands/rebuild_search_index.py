@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.models import ChatMessage
+from core.search import get_backend
+
+
+class Command(BaseCommand):
+	help = "Drops the full-text index of the messages and indexes every message again, run it after changing the " \
+	       "search backend or its configuration, or when the index is suspected to have drifted"
+
+	def add_arguments(self, parser):
+		parser.add_argument("--optimize", action="store_true",
+		                    help="only merge the index into fewer segments instead of rebuilding it")
+
+	def handle(self, *args, **options):
+		backend = get_backend()
+		start = time.perf_counter()
+		if options["optimize"]:
+			backend.optimize()
+			self.stdout.write(f"optimized the {type(backend).__name__} index in {time.perf_counter() - start:.1f}s")
+			return
+		backend.rebuild()
+		self.stdout.write(f"indexed {ChatMessage.objects.count()} messages with {type(backend).__name__} in "
+		                  f"{time.perf_counter() - start:.1f}s")
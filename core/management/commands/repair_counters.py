@@ -0,0 +1,73 @@
+from bisect import bisect_left
+from collections import Counter
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count, F
+
+from core.models import ChatRoom, ChatMessage, RoomReadState, ChatAttachment, Blob
+
+
+class Command(BaseCommand):
+	help = "Verifies the denormalized members_count, viewers_count and blob ref_count columns and repairs the ones " \
+	       "that drifted"
+
+	def add_arguments(self, parser):
+		parser.add_argument("--check", action="store_true", help="only report drift and fail when there is any")
+		parser.add_argument("--batch-size", type=int, default=2000)
+
+	def handle(self, *args, **options):
+		drifted_rooms = self.repair_members(options["check"])
+		drifted_messages = self.repair_viewers(options["check"], options["batch_size"])
+		drifted_blobs = self.repair_blobs(options["check"])
+		self.stdout.write(f"{drifted_rooms} rooms, {drifted_messages} messages and {drifted_blobs} blobs had "
+		                  f"drifted counters")
+		if options["check"] and (drifted_rooms or drifted_messages or drifted_blobs):
+			raise CommandError("counters have drifted, run repair_counters to fix them")
+
+	@staticmethod
+	def repair_members(check: bool) -> int:
+		drifted = ChatRoom.objects.annotate(actual=Count("members")).exclude(members_count=F("actual"))
+		rooms = [(room.id, room.actual) for room in drifted]
+		if not check:
+			for room_id, actual in rooms:
+				ChatRoom.objects.filter(id=room_id).update(members_count=actual)
+		return len(rooms)
+
+	@staticmethod
+	def repair_viewers(check: bool, batch_size: int) -> int:
+		drifted = 0
+		for room_id in ChatRoom.objects.values_list("id", flat=True).iterator():
+			watermarks = dict(RoomReadState.objects.filter(room_id=room_id).
+			                  values_list("user_id", "last_read_message_id"))
+			marks = sorted(watermarks.values())
+			batch = []
+			messages = ChatMessage.objects.filter(chat_id=room_id).only("id", "sender_id", "viewers_count")
+			for message in messages.iterator(chunk_size=batch_size):
+				actual = len(marks) - bisect_left(marks, message.id)
+				if watermarks.get(message.sender_id, 0) >= message.id:
+					actual -= 1
+				if actual != message.viewers_count:
+					message.viewers_count = actual
+					batch.append(message)
+				if len(batch) >= batch_size:
+					drifted += len(batch)
+					if not check:
+						ChatMessage.objects.bulk_update(batch, ["viewers_count"])
+					batch = []
+			drifted += len(batch)
+			if not check and batch:
+				ChatMessage.objects.bulk_update(batch, ["viewers_count"])
+		return drifted
+
+	@staticmethod
+	def repair_blobs(check: bool) -> int:
+		references = Counter()
+		fields = ("picture", "audio", "document", "video")
+		for names in ChatAttachment.objects.filter(status=ChatAttachment.READY).values_list(*fields).iterator():
+			references.update(name for name in names if name)
+		drifted = [(blob.id, references[blob.name]) for blob in Blob.objects.only("name", "ref_count").iterator()
+		           if blob.ref_count != references[blob.name]]
+		if not check:
+			for blob_id, actual in drifted:
+				Blob.objects.filter(id=blob_id).update(ref_count=actual)
+		return len(drifted)
@@ -1,7 +1,15 @@
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
 from django.contrib.auth.models import AbstractUser
-from django.db import models
+from django.core.files.storage import default_storage
+from django.db import models, IntegrityError
+from django.utils import timezone
+from django.db.models.functions import Coalesce, Upper
 
 from core.helpers import send_ws_to_chat
+from core.storage import attachment_storage
 
 
 # Create your models here.
@@ -12,6 +20,12 @@ class User(AbstractUser):
 	email = models.EmailField(unique=True)
 	profile_picture = models.ImageField(upload_to="profile_pics")
 
+	class Meta(AbstractUser.Meta):
+		indexes = [
+			# case insensitive username lookups done on login
+			models.Index(Upper("username"), name="user_username_upper_idx"),
+		]
+
 	def __str__(self):
 		return f"user_{self.id}"
 
@@ -22,41 +36,150 @@ class ChatRoom(models.Model):
 	members = models.ManyToManyField("User", blank=True, related_name="members")
 	maximum_members = models.PositiveSmallIntegerField(default=100)
 	admins = models.ManyToManyField("User", blank=True)
+	members_count = models.PositiveIntegerField(default=0)
 	date_created = models.DateTimeField(auto_now_add=True)
 	date_updated = models.DateTimeField(auto_now=True)
 
 	def __str__(self):
 		return f"chat_{self.id}"
 
+	def add_member(self, user):
+		self.members.add(user)
+		self.count_members()
+
+	def remove_member(self, user):
+		self.members.remove(user)
+		self.count_members()
+
+	def count_members(self):
+		"""
+		sets members_count from the members table in one statement, adding or removing a member twice at once
+		changes one row but would apply the delta twice
+		"""
+		members = ChatRoom.members.through.objects.filter(chatroom_id=models.OuterRef("id")).order_by().\
+			values("chatroom_id").annotate(count=models.Count("id")).values("count")
+		ChatRoom.objects.filter(id=self.id).update(members_count=Coalesce(models.Subquery(members), 0))
+
 
 class ChatMessage(models.Model):
 	chat = models.ForeignKey("ChatRoom", on_delete=models.CASCADE)
 	text = models.CharField(max_length=300)
+	# superseded by RoomReadState, no longer written, kept so migrate_read_states can copy it over
 	viewers = models.ManyToManyField("User", blank=True, related_name="viewers")
 	sender = models.ForeignKey('User', on_delete=models.SET_NULL, null=True)
 	time_sent = models.DateTimeField(auto_now_add=True)
+	viewers_count = models.PositiveIntegerField(default=0)
+
+	class Meta:
+		indexes = [
+			# serves the (time_sent, id) keyset used to page through a room's history
+			models.Index(fields=["chat", "time_sent", "id"], name="chatmessage_history_idx"),
+		]
 
 	def attachments(self):
-		return ChatAttachment.objects.filter(message=self)
+		# served from the prefetch cache when the queryset prefetched chatattachment_set
+		return self.chatattachment_set.all()
 
 	def view(self, user):
-		self.viewers.add(user)
-		self.save()
-		return
+		RoomReadState.advance(user.id, self.chat_id, self.id)
+
+	@staticmethod
+	def view_many(messages, user):
+		"""
+		moves the user's read watermark of the room to the newest of the messages,
+		returns the messages that had not been viewed by the user before
+		"""
+		if not messages:
+			return []
+		previous = RoomReadState.advance(user.id, messages[0].chat_id, max(message.id for message in messages))
+		return [message for message in messages if message.id > previous and message.sender_id != user.id]
 
 	def viewed(self, user_id):
-		return self.viewers.filter(id=user_id).exists()
+		if user_id == self.sender_id:
+			return False
+		return RoomReadState.objects.filter(user_id=user_id, room_id=self.chat_id,
+		                                    last_read_message_id__gte=self.id).exists()
+
+	def count_viewers(self):
+		"""
+		counts the viewers from the read watermarks, viewers_count holds the same number denormalized
+		"""
+		return RoomReadState.objects.filter(room_id=self.chat_id, last_read_message_id__gte=self.id).\
+			exclude(user_id=self.sender_id).count()
+
+
+class RoomReadState(models.Model):
+	"""
+	The newest message of a room a user has read, every message up to it counts as viewed by the user
+	"""
+	user = models.ForeignKey("User", on_delete=models.CASCADE)
+	room = models.ForeignKey("ChatRoom", on_delete=models.CASCADE)
+	last_read_message_id = models.PositiveBigIntegerField(default=0)
+
+	class Meta:
+		unique_together = ("user", "room")
+		indexes = [
+			# counts the viewers of a message, the readers whose watermark reached it
+			models.Index(fields=["room", "last_read_message_id"], name="readstate_room_watermark_idx"),
+		]
+
+	@staticmethod
+	def advance(user_id, room_id, message_id) -> int:
+		"""
+		moves the watermark forward to message_id and bumps viewers_count of the messages it passed,
+		returns the previous watermark
+		"""
+		state, _ = RoomReadState.objects.get_or_create(user_id=user_id, room_id=room_id)
+		previous = state.last_read_message_id
+		while message_id > previous:
+			if RoomReadState.objects.filter(id=state.id, last_read_message_id=previous).\
+					update(last_read_message_id=message_id):
+				ChatMessage.objects.filter(chat_id=room_id, id__gt=previous, id__lte=message_id).\
+					exclude(sender_id=user_id).update(viewers_count=models.F("viewers_count") + 1)
+				break
+			# another request moved the watermark first, only count what it left behind
+			previous = RoomReadState.objects.filter(id=state.id).values_list("last_read_message_id", flat=True).get()
+		return previous
+
+	@staticmethod
+	def unread_count(user_id, room_id) -> int:
+		watermark = RoomReadState.objects.filter(user_id=user_id, room_id=room_id).\
+			values_list("last_read_message_id", flat=True).first() or 0
+		return ChatMessage.objects.filter(chat_id=room_id, id__gt=watermark).exclude(sender_id=user_id).count()
+
+	@staticmethod
+	def unread_count_subquery(user_id):
+		"""
+		unread_count of the outer ChatRoom as an expression, so a list of rooms counts them in its own query
+		"""
+		watermark = RoomReadState.objects.filter(user_id=user_id, room_id=models.OuterRef(models.OuterRef("id"))).\
+			values("last_read_message_id")[:1]
+		unread = ChatMessage.objects.filter(chat_id=models.OuterRef("id"),
+		                                    id__gt=Coalesce(models.Subquery(watermark), 0)).\
+			exclude(sender_id=user_id).order_by().values("chat_id").annotate(count=models.Count("id")).values("count")
+		return Coalesce(models.Subquery(unread), 0)
 
 
 class ChatAttachment(models.Model):
+	PENDING = "pending"
+	READY = "ready"
+	FAILED = "failed"
+
 	message = models.ForeignKey("ChatMessage", on_delete=models.CASCADE)
-	picture = models.ImageField(upload_to="root/pictures", default=None, null=True)
-	audio = models.FileField(upload_to="root/audios", default=None, null=True)
-	document = models.FileField(upload_to="root/documents", default=None, null=True)
-	video = models.FileField(upload_to="root/videos", default=None)
+	picture = models.ImageField(upload_to="root/pictures", storage=attachment_storage, default=None, null=True)
+	audio = models.FileField(upload_to="root/audios", storage=attachment_storage, default=None, null=True)
+	document = models.FileField(upload_to="root/documents", storage=attachment_storage, default=None, null=True)
+	video = models.FileField(upload_to="root/videos", storage=attachment_storage, default=None)
+	status = models.CharField(max_length=10, default=READY,
+	                          choices=((PENDING, PENDING), (READY, READY), (FAILED, FAILED)))
+	# upload waiting in the staging area for core.tasks.process_attachment
+	staged_file = models.CharField(max_length=255, blank=True, default="")
+	original_name = models.CharField(max_length=255, blank=True, default="")
 
 	@property
 	def file(self):
+		if self.status != self.READY:
+			return None
 		if self.video:
 			return self.video.url
 		elif self.picture:
@@ -65,6 +188,186 @@ class ChatAttachment(models.Model):
 			return self.audio.url
 		return self.document.url
 
+	@property
+	def stored_file(self):
+		if self.status != self.READY:
+			return None
+		return getattr(self, self.file_type)
+
 	@property
 	def file_type(self):
+		if self.status != self.READY:
+			return None
 		return "picture" if self.picture else "video" if self.video else "audio" if self.audio else "document"
+
+
+class UploadSession(models.Model):
+	"""
+	A resumable upload, the client PUTs numbered chunks and finalizes them into a ChatAttachment
+	"""
+	id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+	user = models.ForeignKey("User", on_delete=models.CASCADE)
+	chat = models.ForeignKey("ChatRoom", on_delete=models.CASCADE)
+	file_name = models.CharField(max_length=255)
+	total_size = models.PositiveBigIntegerField()
+	chunk_size = models.PositiveIntegerField()
+	date_created = models.DateTimeField(auto_now_add=True)
+	expires_at = models.DateTimeField()
+
+	def save(self, *args, **kwargs):
+		if not self.expires_at:
+			self.expires_at = timezone.now() + timedelta(hours=settings.UPLOAD_SESSION_TTL_HOURS)
+		super().save(*args, **kwargs)
+
+	@property
+	def chunk_count(self) -> int:
+		return max(1, -(-self.total_size // self.chunk_size))
+
+	def expected_chunk_size(self, index) -> int:
+		if index == self.chunk_count - 1:
+			return self.total_size - self.chunk_size * index
+		return self.chunk_size
+
+	def chunk_path(self, index) -> str:
+		return f"uploads/{self.id}/{index:06d}"
+
+	def received_chunks(self):
+		return list(self.uploadchunk_set.order_by("index").values_list("index", flat=True))
+
+	def received_ranges(self):
+		"""
+		merges the received chunks into [start, end) byte ranges
+		"""
+		ranges = []
+		for index in self.received_chunks():
+			start = index * self.chunk_size
+			end = start + self.expected_chunk_size(index)
+			if ranges and ranges[-1][1] == start:
+				ranges[-1][1] = end
+			else:
+				ranges.append([start, end])
+		return ranges
+
+	def delete_chunks(self):
+		for index in self.received_chunks():
+			default_storage.delete(self.chunk_path(index))
+
+	@staticmethod
+	def delete_expired() -> int:
+		expired = UploadSession.objects.filter(expires_at__lt=timezone.now())
+		count = 0
+		for session in expired.iterator():
+			session.delete_chunks()
+			session.delete()
+			count += 1
+		return count
+
+
+class UploadChunk(models.Model):
+	session = models.ForeignKey("UploadSession", on_delete=models.CASCADE)
+	index = models.PositiveIntegerField()
+	size = models.PositiveIntegerField()
+	sha256 = models.CharField(max_length=64)
+
+	class Meta:
+		unique_together = ("session", "index")
+
+
+class RoomExport(models.Model):
+	"""
+	A room history export, written to storage by core.tasks.build_room_export and downloaded once it is ready
+	"""
+	PENDING = "pending"
+	READY = "ready"
+	FAILED = "failed"
+
+	user = models.ForeignKey("User", on_delete=models.CASCADE)
+	room = models.ForeignKey("ChatRoom", on_delete=models.CASCADE)
+	compressed = models.BooleanField(default=False)
+	status = models.CharField(max_length=10, default=PENDING,
+	                          choices=((PENDING, PENDING), (READY, READY), (FAILED, FAILED)))
+	# name of the file in the default storage once it is ready
+	stored_file = models.CharField(max_length=255, blank=True, default="")
+	date_created = models.DateTimeField(auto_now_add=True)
+	expires_at = models.DateTimeField()
+
+	def save(self, *args, **kwargs):
+		if not self.expires_at:
+			self.expires_at = timezone.now() + timedelta(hours=settings.ROOM_EXPORT_TTL_HOURS)
+		super().save(*args, **kwargs)
+
+	@property
+	def file_name(self) -> str:
+		return f"{self.room}.ndjson{'.gz' if self.compressed else ''}"
+
+	@staticmethod
+	def delete_expired() -> int:
+		expired = RoomExport.objects.filter(expires_at__lt=timezone.now())
+		count = 0
+		for export in expired.iterator():
+			if export.stored_file:
+				default_storage.delete(export.stored_file)
+			export.delete()
+			count += 1
+		return count
+
+
+class ImageDerivative(models.Model):
+	"""
+	A resized or re-encoded copy of a stored picture, generated on demand by core.thumbnails.
+	last_accessed drives the least recently used eviction that keeps the derivatives under DERIVATIVE_CACHE_MAX_BYTES
+	"""
+	key = models.CharField(max_length=64, unique=True)
+	source = models.CharField(max_length=255)
+	name = models.CharField(max_length=255)
+	size = models.PositiveIntegerField()
+	last_accessed = models.DateTimeField(default=timezone.now, db_index=True)
+
+
+class Blob(models.Model):
+	"""
+	A file of core.storage.ContentAddressedStorage, ref_count is the number of ready attachments using it
+	"""
+	name = models.CharField(max_length=255, unique=True)
+	digest = models.CharField(max_length=64, db_index=True)
+	size = models.PositiveBigIntegerField()
+	ref_count = models.PositiveIntegerField(default=0)
+	# bumped on every save of the content, so a blob that is being stored again is not collected
+	last_stored = models.DateTimeField(default=timezone.now, db_index=True)
+
+	@staticmethod
+	def stored(name, digest, size):
+		try:
+			Blob.objects.update_or_create(name=name, defaults=dict(digest=digest, size=size,
+			                                                       last_stored=timezone.now()))
+		except IntegrityError:
+			Blob.objects.filter(name=name).update(last_stored=timezone.now())
+
+	@staticmethod
+	def acquire(name):
+		Blob.objects.filter(name=name).update(ref_count=models.F("ref_count") + 1)
+
+	@staticmethod
+	def release(name):
+		Blob.objects.filter(name=name, ref_count__gt=0).update(ref_count=models.F("ref_count") - 1)
+
+	@staticmethod
+	def collect(grace: timedelta, dry_run: bool = False):
+		"""
+		Deletes the blobs no attachment uses that were last stored before the grace period
+		:return: (blobs deleted, bytes freed)
+		"""
+		pending = ChatAttachment.objects.filter(status=ChatAttachment.PENDING, staged_file=models.OuterRef("name"))
+		unused = Blob.objects.filter(ref_count=0, last_stored__lt=timezone.now() - grace).exclude(
+			models.Exists(pending))
+		count = freed = 0
+		for blob in unused.iterator():
+			# the filter is repeated so a blob acquired meanwhile survives
+			if not dry_run and not Blob.objects.filter(id=blob.id, ref_count=0,
+			                                           last_stored=blob.last_stored).delete()[0]:
+				continue
+			if not dry_run:
+				attachment_storage.delete(blob.name)
+			count += 1
+			freed += blob.size
+		return count, freed
@@ -0,0 +1,216 @@
+import base64
+import re
+from html import escape
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.utils.module_loading import import_string
+from rest_framework.exceptions import NotFound
+
+from core.models import ChatMessage, ChatRoom
+
+# mark the matched terms in the raw text, they become <mark> tags once the text is escaped
+START_MARK = "\x02"
+STOP_MARK = "\x03"
+TERM = re.compile(r"\w+")
+BACKENDS = {
+	"sqlite": "core.search.SqliteSearchBackend",
+	"postgresql": "core.search.PostgresSearchBackend",
+}
+
+
+def parse_terms(query: str) -> list:
+	"""
+	Splits a query into the words every result must contain, the operators of the engines are not exposed
+	"""
+	return [term.lower() for term in TERM.findall(query or "")][:16]
+
+
+def highlight(text: str) -> str:
+	return escape(text).replace(START_MARK, "<mark>").replace(STOP_MARK, "</mark>")
+
+
+def encode_cursor(rank: float, pk: int) -> str:
+	return base64.urlsafe_b64encode(f"{rank!r}|{pk}".encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple:
+	try:
+		rank, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+		return float(rank), int(pk)
+	except (ValueError, UnicodeDecodeError):
+		raise NotFound("Invalid cursor")
+
+
+def get_backend():
+	name = settings.MESSAGE_SEARCH["BACKEND"]
+	if name == "auto":
+		if connection.vendor not in BACKENDS:
+			raise ImproperlyConfigured(f"No message search backend for {connection.vendor}, "
+			                           f"set MESSAGE_SEARCH_BACKEND to one")
+		name = BACKENDS[connection.vendor]
+	return import_string(name)()
+
+
+class SearchBackend:
+	"""
+	Inverted index over the text of every message. search returns [(message id, rank, highlighted text)] best
+	first, a lower rank is a better match so (rank, id) orders the results and is the cursor of the next page.
+	Ranks move as messages are indexed, a page read while the room is busy may repeat or skip a result
+	"""
+	members_table = ChatRoom.members.through._meta.db_table
+	messages_table = ChatMessage._meta.db_table
+
+	def ensure_index(self):
+		"""
+		Creates the index and what keeps it in sync when they are missing, called after every migrate
+		"""
+		raise NotImplementedError
+
+	def rebuild(self):
+		"""
+		Drops the index and indexes every message again
+		"""
+		raise NotImplementedError
+
+	def optimize(self):
+		pass
+
+	def index_bytes(self) -> int or None:
+		return None
+
+	def search(self, user_id: int, terms: list, chat_id: int = None, after: tuple = None, limit: int = 20) -> list:
+		"""
+		:param user_id: only messages of the rooms the user is a member of are returned
+		:param terms: words from parse_terms, the last one also matches as a prefix
+		:param after: (rank, id) of the last result of the previous page
+		"""
+		raise NotImplementedError
+
+	def scope(self, user_id: int, chat_id: int = None):
+		sql = f" AND m.chat_id IN (SELECT chatroom_id FROM {self.members_table} WHERE user_id = %s)"
+		params = [user_id]
+		if chat_id is not None:
+			sql += " AND m.chat_id = %s"
+			params.append(chat_id)
+		return sql, params
+
+	@staticmethod
+	def fetch(sql: str, params: list) -> list:
+		with connection.cursor() as cursor:
+			cursor.execute(sql, params)
+			return [(pk, rank, highlight(text)) for pk, rank, text in cursor.fetchall()]
+
+
+class SqliteSearchBackend(SearchBackend):
+	"""
+	FTS5 table with the messages table as its external content, so the text is stored once and only the index
+	is added. Triggers keep it in sync with every insert, delete and edit of the text, bulk ones included
+	"""
+	table = f"{SearchBackend.messages_table}_fts"
+
+	def ensure_index(self):
+		messages, table = self.messages_table, self.table
+		with connection.cursor() as cursor:
+			cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [table])
+			created = cursor.fetchone() is None
+			cursor.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {table} USING fts5(text, content='{messages}', "
+			               f"content_rowid='id', tokenize='unicode61 remove_diacritics 2')")
+			cursor.execute(f"CREATE TRIGGER IF NOT EXISTS {table}_insert AFTER INSERT ON {messages} BEGIN "
+			               f"INSERT INTO {table}(rowid, text) VALUES (new.id, new.text); END")
+			cursor.execute(f"CREATE TRIGGER IF NOT EXISTS {table}_delete AFTER DELETE ON {messages} BEGIN "
+			               f"INSERT INTO {table}({table}, rowid, text) VALUES ('delete', old.id, old.text); END")
+			cursor.execute(f"CREATE TRIGGER IF NOT EXISTS {table}_update AFTER UPDATE OF text ON {messages} BEGIN "
+			               f"INSERT INTO {table}({table}, rowid, text) VALUES ('delete', old.id, old.text); "
+			               f"INSERT INTO {table}(rowid, text) VALUES (new.id, new.text); END")
+			if created:
+				# the messages already stored have to be indexed, the delete and update triggers would
+				# otherwise remove rows the index never had and corrupt it
+				cursor.execute(f"INSERT INTO {table}({table}) VALUES ('rebuild')")
+
+	def rebuild(self):
+		with connection.cursor() as cursor:
+			for trigger in ("insert", "delete", "update"):
+				cursor.execute(f"DROP TRIGGER IF EXISTS {self.table}_{trigger}")
+			cursor.execute(f"DROP TABLE IF EXISTS {self.table}")
+		self.ensure_index()
+
+	def optimize(self):
+		with connection.cursor() as cursor:
+			cursor.execute(f"INSERT INTO {self.table}({self.table}) VALUES ('optimize')")
+
+	def index_bytes(self) -> int or None:
+		with connection.cursor() as cursor:
+			# the shadow tables of the index, the text stays in the messages table
+			cursor.execute("SELECT SUM(pgsize) FROM dbstat WHERE name LIKE %s", [f"{self.table}%"])
+			return cursor.fetchone()[0]
+
+	def search(self, user_id: int, terms: list, chat_id: int = None, after: tuple = None, limit: int = 20) -> list:
+		if not terms:
+			return []
+		# quoted so every term is a plain token, the rank column is bm25
+		match = " ".join(f'"{term}"' for term in terms) + "*"
+		scope, params = self.scope(user_id, chat_id)
+		sql = f"SELECT f.rowid AS id, f.rank AS rank, highlight({self.table}, 0, %s, %s) AS text " \
+		      f"FROM {self.table} f JOIN {self.messages_table} m ON m.id = f.rowid WHERE {self.table} MATCH %s" + scope
+		params = [START_MARK, STOP_MARK, match] + params
+		if after:
+			# materialized so bm25 runs once a row instead of again for every comparison with the cursor
+			sql = f"WITH hits AS MATERIALIZED ({sql}) SELECT id, rank, text FROM hits " \
+			      f"WHERE rank > %s OR (rank = %s AND id > %s)"
+			params += [after[0], after[0], after[1]]
+		return self.fetch(sql + " ORDER BY rank, id LIMIT %s", params + [limit])
+
+
+class PostgresSearchBackend(SearchBackend):
+	"""
+	GIN index on the tsvector of the text, Postgres keeps an expression index in sync by itself.
+	Ranked with ts_rank_cd, negated so lower is better like bm25
+	"""
+	index = f"{SearchBackend.messages_table}_tsv_idx"
+
+	@property
+	def config(self) -> str:
+		return settings.MESSAGE_SEARCH["POSTGRES_CONFIG"]
+
+	@property
+	def vector(self) -> str:
+		# has to match the indexed expression for the index to be used
+		return f"to_tsvector('{self.config}'::regconfig, m.text)"
+
+	def ensure_index(self):
+		with connection.cursor() as cursor:
+			cursor.execute(f"CREATE INDEX IF NOT EXISTS {self.index} ON {self.messages_table} "
+			               f"USING GIN ({self.vector.replace('m.text', 'text')})")
+
+	def rebuild(self):
+		with connection.cursor() as cursor:
+			cursor.execute(f"DROP INDEX IF EXISTS {self.index}")
+		self.ensure_index()
+
+	def optimize(self):
+		with connection.cursor() as cursor:
+			cursor.execute(f"VACUUM ANALYZE {self.messages_table}")
+
+	def index_bytes(self) -> int or None:
+		with connection.cursor() as cursor:
+			cursor.execute("SELECT pg_relation_size(%s)", [self.index])
+			return cursor.fetchone()[0]
+
+	def search(self, user_id: int, terms: list, chat_id: int = None, after: tuple = None, limit: int = 20) -> list:
+		if not terms:
+			return []
+		query = " & ".join(terms) + ":*"
+		scope, params = self.scope(user_id, chat_id)
+		# float8 so the rank survives the round trip through the cursor exactly
+		sql = f"SELECT id, rank, ts_headline('{self.config}'::regconfig, text, query, " \
+		      f"'StartSel={START_MARK}, StopSel={STOP_MARK}, HighlightAll=true') FROM (" \
+		      f"SELECT m.id, m.text, q.query, (-ts_rank_cd({self.vector}, q.query))::float8 AS rank " \
+		      f"FROM {self.messages_table} m, to_tsquery('{self.config}'::regconfig, %s) q(query) " \
+		      f"WHERE {self.vector} @@ q.query" + scope + ") results"
+		params = [query] + params
+		if after:
+			sql += " WHERE rank > %s OR (rank = %s AND id > %s)"
+			params += [after[0], after[0], after[1]]
+		return self.fetch(sql + " ORDER BY rank, id LIMIT %s", params + [limit])
@@ -0,0 +1,202 @@
+import asyncio
+import logging
+import threading
+import weakref
+from collections import deque
+
+from django.conf import settings
+
+from core import codecs
+
+DROP_OLDEST = "drop_oldest"
+DROP_NONCRITICAL = "drop_noncritical"
+CLOSE = "close"
+POLICIES = (DROP_OLDEST, DROP_NONCRITICAL, CLOSE)
+
+
+def frame_events(message: dict) -> list or None:
+	"""
+	Returns the event names in an outbound frame, single, batched or multiplexed,
+	None when it isn't an event frame (the greeting, a control reply)
+	"""
+	try:
+		if message.get("bytes") is not None:
+			data = codecs.msgpack_to_python(message["bytes"]) if codecs.msgpack else None
+		else:
+			data = codecs.loads(message.get("text") or "")
+	except (ValueError, TypeError):
+		return None
+	events = []
+	for item in data if isinstance(data, list) else [data]:
+		if isinstance(item, dict) and isinstance(item.get("payload"), dict):
+			item = item["payload"]
+		if not isinstance(item, dict) or not isinstance(item.get("event"), str):
+			return None
+		events.append(item["event"])
+	return events or None
+
+
+class SendQueue:
+	"""
+	Bounded buffer between a consumer and the send callable of the ASGI server. Frames are written by one task, so a
+	client that reads slowly backs frames up here instead of in the server, and once MAX_FRAMES or MAX_BYTES are
+	queued the policy makes room: drop_oldest drops the oldest frame, drop_noncritical drops the frames that only
+	hold NONCRITICAL_EVENTS and closes the socket when there are none, close closes it with CLOSE_CODE.
+	Frames only back up when the server's send waits for the client, uvicorn --ws websockets waits for its write
+	buffer to drain while daphne buffers every frame itself and returns at once
+	"""
+	def __init__(self, send, options: dict = None):
+		options = options or settings.WEBSOCKET_SEND_QUEUE
+		if options["POLICY"] not in POLICIES:
+			raise ValueError(f"Unknown send queue policy {options['POLICY']}")
+		self.send = send
+		self.max_frames = options["MAX_FRAMES"]
+		self.max_bytes = options["MAX_BYTES"]
+		self.policy = options["POLICY"]
+		self.close_code = options["CLOSE_CODE"]
+		self.noncritical = frozenset(options["NONCRITICAL_EVENTS"])
+		# [message, size, noncritical or None when not classified yet], accept and close messages have no size
+		self.entries = deque()
+		self.frames = 0
+		self.bytes = 0
+		self.closed = False
+		self.writer = None
+		send_queue_metrics.register(self)
+
+	async def put(self, message: dict):
+		if self.closed:
+			return
+		if message["type"] == "websocket.send":
+			size = len(message.get("bytes") or message.get("text") or "")
+			entry = [message, size, None]
+			if not self.make_room(entry):
+				return
+			self.frames += 1
+			self.bytes += size
+			send_queue_metrics.queued(self)
+		else:
+			entry = [message, None, None]
+			self.closed = message["type"] == "websocket.close"
+		self.entries.append(entry)
+		if self.writer is None or self.writer.done():
+			self.writer = asyncio.get_running_loop().create_task(self.write())
+
+	async def write(self):
+		while self.entries:
+			message, size, _ = self.entries.popleft()
+			if size is not None:
+				self.frames -= 1
+				self.bytes -= size
+			await self.send(message)
+
+	def is_noncritical(self, entry) -> bool:
+		# classified only when room has to be made, a full queue is the rare case
+		if entry[2] is None:
+			events = frame_events(entry[0])
+			entry[2] = bool(events) and all(event in self.noncritical for event in events)
+		return entry[2]
+
+	def make_room(self, entry) -> bool:
+		"""
+		Applies the policy until the frame fits, a frame larger than the whole queue is still sent when it is alone
+		:return: False when the frame is dropped or the socket closed instead
+		"""
+		while self.frames and (self.frames >= self.max_frames or self.bytes + entry[1] > self.max_bytes):
+			if self.policy == CLOSE:
+				self.close_slow()
+				return False
+			if self.policy == DROP_OLDEST:
+				victim = next(queued for queued in self.entries if queued[1] is not None)
+			elif self.is_noncritical(entry):
+				send_queue_metrics.evicted(DROP_NONCRITICAL, entry[1])
+				return False
+			else:
+				victim = next((queued for queued in self.entries
+				               if queued[1] is not None and self.is_noncritical(queued)), None)
+				if victim is None:
+					self.close_slow()
+					return False
+			self.entries.remove(victim)
+			self.frames -= 1
+			self.bytes -= victim[1]
+			send_queue_metrics.evicted(self.policy, victim[1])
+		return True
+
+	def close_slow(self):
+		"""
+		Drops everything queued and closes the socket, the frame being written is abandoned since a stalled client
+		would hold the close behind it
+		"""
+		logging.warning(f"closing a websocket that fell {self.frames} frames behind")
+		send_queue_metrics.closed(self.frames, self.bytes)
+		self.entries.clear()
+		self.frames = 0
+		self.bytes = 0
+		self.closed = True
+		if self.writer is not None and not self.writer.done():
+			self.writer.cancel()
+		self.writer = asyncio.get_running_loop().create_task(self.send({"type": "websocket.close",
+		                                                                  "code": self.close_code}))
+
+	def stop(self):
+		if self.writer is not None and not self.writer.done():
+			self.writer.cancel()
+		self.entries.clear()
+		send_queue_metrics.unregister(self)
+
+
+class SendQueueMetrics:
+	"""
+	Depth of the open send queues of this process and what their policies evicted
+	"""
+	def __init__(self):
+		self._queues = weakref.WeakSet()
+		self._lock = threading.Lock()
+		self.reset()
+
+	def reset(self):
+		with self._lock:
+			self.peak_frames = 0
+			self.evicted_frames = {DROP_OLDEST: 0, DROP_NONCRITICAL: 0, CLOSE: 0}
+			self.evicted_bytes = 0
+			self.closed_connections = 0
+
+	def register(self, queue: SendQueue):
+		with self._lock:
+			self._queues.add(queue)
+
+	def unregister(self, queue: SendQueue):
+		with self._lock:
+			self._queues.discard(queue)
+
+	def queued(self, queue: SendQueue):
+		if queue.frames > self.peak_frames:
+			self.peak_frames = queue.frames
+
+	def evicted(self, policy: str, size: int):
+		with self._lock:
+			self.evicted_frames[policy] += 1
+			self.evicted_bytes += size
+
+	def closed(self, frames: int, size: int):
+		with self._lock:
+			self.evicted_frames[CLOSE] += frames
+			self.evicted_bytes += size
+			self.closed_connections += 1
+
+	def stats(self) -> dict:
+		with self._lock:
+			queues = list(self._queues)
+			return dict(
+				open_queues=len(queues),
+				queued_frames=sum(queue.frames for queue in queues),
+				queued_bytes=sum(queue.bytes for queue in queues),
+				deepest_queue=max((queue.frames for queue in queues), default=0),
+				peak_queue=self.peak_frames,
+				evicted_frames=dict(self.evicted_frames),
+				evicted_bytes=self.evicted_bytes,
+				closed_connections=self.closed_connections,
+			)
+
+
+send_queue_metrics = SendQueueMetrics()
@@ -1,8 +1,21 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Value
+from django.db.models.functions import Upper
+from django.utils import timezone
+from django.urls import reverse
 from rest_framework import serializers
 from rest_framework.authtoken.models import Token
 
+from core.attachments import stage_upload, assemble_upload
+from core.caches import recent_messages
 from core.helpers import send_ws_to_general, send_ws_to_chat
-from core.models import User, ChatRoom, ChatMessage, ChatAttachment
+from core.models import User, ChatRoom, ChatMessage, ChatAttachment, RoomReadState, UploadSession, RoomExport
+from core.tasks import queue_attachments
+from core.thumbnails import derivative_urls
+
+PROFILE_PICTURE_SIZES = ("small", "medium")
+ATTACHMENT_PICTURE_SIZES = ("medium", "large")
 
 
 class SignupSerializer(serializers.ModelSerializer):
@@ -21,7 +34,9 @@ class LoginSerializer(serializers.Serializer):
 	password = serializers.CharField()
 
 	def validate(self, attrs):
-		user = User.objects.filter(username__iexact=attrs.pop('username')).first()
+		# compared through Upper so the lookup can use the user_username_upper_idx index
+		user = User.objects.annotate(username_upper=Upper("username")).\
+			filter(username_upper=Upper(Value(attrs.pop('username')))).first()
 		if not user:
 			raise serializers.ValidationError(detail="You dont have an account with us")
 		if not user.check_password(attrs.pop('password')):
@@ -37,9 +52,14 @@ class LoginSerializer(serializers.Serializer):
 
 
 class UserSerializer(serializers.ModelSerializer):
+	profile_picture_thumbnails = serializers.SerializerMethodField()
+
 	class Meta:
 		model = User
-		fields = ("id", "first_name", "last_name", "username", "profile_picture")
+		fields = ("id", "first_name", "last_name", "username", "profile_picture", "profile_picture_thumbnails")
+
+	def get_profile_picture_thumbnails(self, obj):
+		return derivative_urls(obj.profile_picture.name, PROFILE_PICTURE_SIZES)
 
 
 class ChatRoomListSerializer(serializers.ModelSerializer):
@@ -51,14 +71,21 @@ class ChatRoomListSerializer(serializers.ModelSerializer):
 class ChatRoomSerializer(serializers.ModelSerializer):
 	admins = UserSerializer(many=True)
 	members = UserSerializer(many=True)
-	members_count = serializers.SerializerMethodField()
+	unread_count = serializers.SerializerMethodField()
 
 	class Meta:
 		model = ChatRoom
 		fields = "__all__"
+		read_only_fields = ("members_count",)
 
-	def get_members_count(self, obj):
-		return obj.members.count()
+	def get_unread_count(self, obj):
+		user = self.context.get("user")
+		if not user:
+			return None
+		# annotated by ChatRoomAPI.get_queryset
+		if hasattr(obj, "unread"):
+			return obj.unread
+		return RoomReadState.unread_count(user.id, obj.id)
 
 
 class CreateChatRoomSerializer(serializers.ModelSerializer):
@@ -68,7 +95,7 @@ class CreateChatRoomSerializer(serializers.ModelSerializer):
 
 	def validate(self, attrs):
 		user = self.context.get("user")
-		if self.instance and attrs['maximum_members'] < self.instance.members.count():
+		if self.instance and attrs['maximum_members'] < self.instance.members_count:
 			raise serializers.ValidationError(
 				detail="The members count cannot be less than number of members in the room")
 		if self.instance and not self.instance.admins.filter(id=user.id).exists():
@@ -78,9 +105,9 @@ class CreateChatRoomSerializer(serializers.ModelSerializer):
 	def create(self, validated_data):
 		user = self.context.get("user")
 		chat_room = super(CreateChatRoomSerializer, self).create(validated_data)
-		chat_room.members.add(user)
+		chat_room.add_member(user)
 		chat_room.admins.add(user)
-		chat_room.save()
+		chat_room.refresh_from_db(fields=["members_count"])
 		send_ws_to_general(user=user, event="NEW CHATROOM", data=ChatRoomListSerializer(chat_room).data)
 		return chat_room
 
@@ -94,14 +121,26 @@ class CreateChatRoomSerializer(serializers.ModelSerializer):
 class ChatAttachments(serializers.ModelSerializer):
 	file = serializers.SerializerMethodField()
 	file_type = serializers.SerializerMethodField()
+	download = serializers.SerializerMethodField()
+	thumbnails = serializers.SerializerMethodField()
 
 	class Meta:
 		model = ChatAttachment
-		fields = ("id", "file", "file_type")
+		fields = ("id", "file", "file_type", "status", "download", "thumbnails")
 
 	def get_file(self, obj):
 		return obj.file
 
+	def get_download(self, obj):
+		if obj.status != ChatAttachment.READY:
+			return None
+		return reverse("attachment-download", args=[obj.id])
+
+	def get_thumbnails(self, obj):
+		if obj.file_type != "picture":
+			return None
+		return derivative_urls(obj.picture.name, ATTACHMENT_PICTURE_SIZES, obj.id)
+
 	def get_file_type(self, obj):
 		return obj.file_type
 
@@ -109,23 +148,22 @@ class ChatAttachments(serializers.ModelSerializer):
 class ChatMessageSerializer(serializers.ModelSerializer):
 	attachments = serializers.SerializerMethodField()
 	sender = UserSerializer(read_only=True)
-	viewers_count = serializers.SerializerMethodField()
 	viewed = serializers.SerializerMethodField()
 
 	class Meta:
 		model = ChatMessage
-		fields = "__all__"
+		exclude = ("viewers",)
+		read_only_fields = ("viewers_count",)
 
 	def get_attachments(self, obj):
 		return ChatAttachments(obj.attachments(), many=True).data
 
-	def get_viewers_count(self, obj):
-		return obj.viewers.count()
-
 	def get_viewed(self, obj):
 		user = self.context.get("user")
 		if not user:
 			return None
+		if hasattr(obj, "viewed_by_user"):
+			return obj.viewed_by_user and obj.sender_id != user.id
 		return obj.viewed(user.id)
 
 
@@ -133,6 +171,28 @@ class ChatMessageListSerializer(ChatMessageSerializer):
 	viewers = None
 
 
+class ChatMessageExportSerializer(serializers.ModelSerializer):
+	"""
+	A message of a room export. Senders and attachments are fetched a chunk of messages at a time and handed over
+	in the context, as "senders" {user id: serialized user} and "attachments" {message id: [attachment]}
+	"""
+	sender = serializers.SerializerMethodField()
+	attachments = serializers.SerializerMethodField()
+	# exports are written in utc, which also skips looking up the active timezone for every message
+	time_sent = serializers.DateTimeField(default_timezone=timezone.utc)
+
+	class Meta:
+		model = ChatMessage
+		fields = ("id", "chat", "sender", "text", "time_sent", "viewers_count", "attachments")
+
+	def get_sender(self, obj):
+		return self.context["senders"].get(obj.sender_id)
+
+	def get_attachments(self, obj):
+		attachments = self.context["attachments"].get(obj.id)
+		return ChatAttachments(attachments, many=True).data if attachments else []
+
+
 class CreateMessageSerializer(serializers.Serializer):
 	chat = serializers.PrimaryKeyRelatedField(queryset=ChatRoom.objects.all())
 	text = serializers.CharField(default=None)
@@ -151,31 +211,36 @@ class CreateMessageSerializer(serializers.Serializer):
 		return attrs
 
 	def create(self, validated_data):
+		"""
+		stages the uploads outside the transaction, commits the message with pending attachments
+		and leaves moving them into storage to core.tasks.process_attachment
+		"""
 		user = self.context.get("user")
 		files = validated_data.pop("files", list())
-		message = ChatMessage.objects.create(chat_id=validated_data['chat'].id,
-		                                     text=validated_data['text'],
-		                                     sender_id=user.id)
-		if not files:
-			return message
+		staged = []
 		for file_attachment in files:
-			picture = None
-			audio = None
-			video = None
-			document = None
 			if isinstance(file_attachment, str):
 				file_attachment = files[file_attachment]
-			content_type = file_attachment.content_type.split("/")[-1]
-			if content_type in ("jpg", "jpeg", "gif", "png"):
-				picture = file_attachment
-			elif content_type in ("mp3", "ogg", "mpeg", "wav"):
-				audio = file_attachment
-			elif content_type in ("mp4", "3gp"):
-				video = file_attachment
-			else:
-				document = file_attachment
-			ChatAttachment.objects.create(
-				message=message, picture=picture, audio=audio, video=video, document=document)
+			staged.append((stage_upload(file_attachment), file_attachment.name))
+		# a failed commit leaves the staged blobs unreferenced for collect_blobs, they may be shared
+		return self.commit_message(user, validated_data['chat'].id, validated_data['text'], staged)
+
+	@staticmethod
+	def commit_message(user, chat_id, text, staged):
+		"""
+		creates the message with a pending attachment for each (staged file, original name) pair
+		"""
+		with transaction.atomic():
+			# the sender is set as an instance so serializing the message doesn't load it again
+			message = ChatMessage.objects.create(chat_id=chat_id, text=text, sender=user)
+			# serialized once committed, with the attachments created below
+			transaction.on_commit(lambda: recent_messages.push(message))
+			if not staged:
+				return message
+			attachments = [ChatAttachment.objects.create(message=message, status=ChatAttachment.PENDING,
+			                                             staged_file=staged_file, original_name=name)
+			               for staged_file, name in staged]
+			transaction.on_commit(lambda: queue_attachments(attachments))
 		send_ws_to_chat(user=user, chat_id=message.chat_id, event="NEW MESSAGE",
 		                data=ChatMessageSerializer(message).data)
 		return message
@@ -192,7 +257,7 @@ class ChatActionSerializer(serializers.Serializer):
 			raise serializers.ValidationError(detail="You are already a member of this chat")
 		if not is_member and attrs['action'] == "leave":
 			raise serializers.ValidationError(detail="You are not a member of this chat")
-		if attrs['chat'].members.count() == attrs['chat'].maximum_members:
+		if attrs['chat'].members_count >= attrs['chat'].maximum_members:
 			raise serializers.ValidationError(detail="This group is full")
 		return attrs
 
@@ -202,17 +267,81 @@ class ChatActionSerializer(serializers.Serializer):
 		action = validated_data.pop("action")
 		event = ""
 		if action == "join":
-			chatroom.members.add(user)
+			chatroom.add_member(user)
 			event = "NEW MEMBER"
 		elif action == "leave":
-			chatroom.members.remove(user)
+			chatroom.remove_member(user)
 			chatroom.admins.remove(user)
 			event = "MEMBER EXIT"
-		chatroom.save()
+		chatroom.save(update_fields=["date_updated"])
+		chatroom.refresh_from_db(fields=["members_count"])
 		# ensure that a chatroom admin members list is not empty
-		if chatroom.admins.count() == 0 and chatroom.members.count() > 0:
+		if chatroom.admins.count() == 0 and chatroom.members_count > 0:
 			chatroom.admins.add(chatroom.members.first())
-			chatroom.save()
 		send_ws_to_chat(user=chatroom.admins.first(), chat_id=chatroom.id, event=event,
 		                data=UserSerializer(user).data)
 		return chatroom
+
+
+class RoomExportSerializer(serializers.ModelSerializer):
+	download = serializers.SerializerMethodField()
+
+	class Meta:
+		model = RoomExport
+		fields = ("id", "room", "compressed", "status", "download", "date_created", "expires_at")
+
+	def get_download(self, obj):
+		if obj.status != RoomExport.READY:
+			return None
+		return reverse("room-export-download", args=[obj.id])
+
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+	chunk_count = serializers.ReadOnlyField()
+	received_chunks = serializers.SerializerMethodField()
+	received_ranges = serializers.SerializerMethodField()
+
+	class Meta:
+		model = UploadSession
+		fields = ("id", "chat", "file_name", "total_size", "chunk_size", "chunk_count", "received_chunks",
+		          "received_ranges", "expires_at")
+		read_only_fields = ("expires_at",)
+		extra_kwargs = {"chunk_size": {"required": False}}
+
+	def get_received_chunks(self, obj):
+		return obj.received_chunks()
+
+	def get_received_ranges(self, obj):
+		return obj.received_ranges()
+
+	def validate(self, attrs):
+		user = self.context.get("user")
+		if not attrs['chat'].members.filter(id=user.id).exists():
+			raise serializers.ValidationError(detail="You are not a member of this group")
+		if attrs['total_size'] > settings.UPLOAD_MAX_SIZE:
+			raise serializers.ValidationError(detail="The file is too large")
+		attrs['chunk_size'] = min(attrs.get('chunk_size') or settings.UPLOAD_CHUNK_SIZE, settings.UPLOAD_CHUNK_SIZE)
+		attrs['user'] = user
+		return attrs
+
+
+class FinalizeUploadSerializer(serializers.Serializer):
+	text = serializers.CharField(default="", allow_blank=True)
+
+	def validate(self, attrs):
+		session = self.context.get("session")
+		missing = set(range(session.chunk_count)) - set(session.received_chunks())
+		if missing:
+			raise serializers.ValidationError(detail=f"Missing chunks {sorted(missing)}")
+		if not session.chat.members.filter(id=session.user_id).exists():
+			raise serializers.ValidationError(detail="You are not a member of this group")
+		return attrs
+
+	def create(self, validated_data):
+		session = self.context.get("session")
+		staged = assemble_upload(session)
+		message = CreateMessageSerializer.commit_message(session.user, session.chat_id, validated_data['text'],
+		                                                 [(staged, session.file_name)])
+		session.delete_chunks()
+		session.delete()
+		return message
@@ -0,0 +1,89 @@
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, post_migrate
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from core.caches import auth_cache, recent_messages
+from core.models import ChatRoom, User, ChatMessage, ChatAttachment, Blob
+from core.search import get_backend
+
+
+@receiver(m2m_changed, sender=ChatRoom.members.through)
+def invalidate_memberships(sender, instance, action, reverse, pk_set, **kwargs):
+	if action not in ("post_add", "post_remove", "pre_clear"):
+		return
+	if action == "pre_clear":
+		if reverse:
+			auth_cache.invalidate_user(instance.id)
+		else:
+			auth_cache.invalidate_room(instance.id)
+		return
+	for pk in pk_set or ():
+		if reverse:
+			auth_cache.invalidate_membership(pk, instance.id)
+		else:
+			auth_cache.invalidate_membership(instance.id, pk)
+
+
+@receiver(post_save, sender=ChatRoom)
+def invalidate_room_name(sender, instance, **kwargs):
+	auth_cache.rooms.delete(instance.id)
+
+
+@receiver(post_delete, sender=ChatRoom)
+def invalidate_room(sender, instance, **kwargs):
+	auth_cache.invalidate_room(instance.id)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_user(sender, instance, **kwargs):
+	auth_cache.invalidate_user(instance.id)
+
+
+@receiver(post_delete, sender=Token)
+def invalidate_token(sender, instance, **kwargs):
+	auth_cache.invalidate_token(instance.key)
+
+
+@receiver(post_delete, sender=ChatAttachment)
+def release_blob(sender, instance, **kwargs):
+	# also runs for the attachments deleted by the cascade from ChatMessage
+	if instance.status == ChatAttachment.READY:
+		Blob.release(instance.stored_file.name)
+
+
+@receiver(post_save, sender=ChatAttachment)
+def refresh_recent_attachment(sender, instance, created, **kwargs):
+	# new attachments are committed with their message, which is serialized with them
+	if created:
+		return
+	room_id, message_id = instance.message.chat_id, instance.message_id
+	transaction.on_commit(lambda: recent_messages.refresh_attachment(room_id, message_id, instance.id, instance))
+
+
+@receiver(post_delete, sender=ChatAttachment)
+def remove_recent_attachment(sender, instance, **kwargs):
+	# read now, the primary key is cleared once the delete finishes
+	room_id, message_id, attachment_id = instance.message.chat_id, instance.message_id, instance.id
+	transaction.on_commit(lambda: recent_messages.refresh_attachment(room_id, message_id, attachment_id))
+
+
+@receiver(post_delete, sender=ChatMessage)
+def remove_recent_message(sender, instance, **kwargs):
+	# read now, the primary key is cleared once the delete finishes
+	room_id, message_id = instance.chat_id, instance.id
+	transaction.on_commit(lambda: recent_messages.remove(room_id, message_id))
+
+
+@receiver(post_migrate)
+def create_search_index(sender, app_config, using, **kwargs):
+	# there is no migration for the index, the messages table may have just been created by migrate --run-syncdb
+	if app_config.name != "core":
+		return
+	try:
+		backend = get_backend()
+	except ImproperlyConfigured:
+		return
+	backend.ensure_index()
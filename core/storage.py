@@ -0,0 +1,88 @@
+import hashlib
+import os
+import tempfile
+
+from django.core.files.move import file_move_safe
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+BLOB_DIRECTORY = "blobs"
+BLOCK_SIZE = 64 * 1024
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+	"""
+	File system storage that keeps every distinct file once, under the sha256 of its content.
+	Saving a file that is already stored only hashes it and returns the existing name, the Blob rows
+	track how many attachments use each file so the collect_blobs command can delete unused ones
+	"""
+	def get_available_name(self, name, max_length=None):
+		# names are digests, two saves of the same name are the same content
+		return name
+
+	@staticmethod
+	def blob_name(digest: str, name: str) -> str:
+		# the extension is kept so content types can still be guessed from the name
+		extension = os.path.splitext(name)[1].lower()
+		return f"{BLOB_DIRECTORY}/{digest[:2]}/{digest[2:4]}/{digest}{extension}"
+
+	def _save(self, name, content):
+		from core.models import Blob
+
+		temporary = None
+		if content.seekable():
+			# hash first, so a duplicate is read but never written
+			digest, size = self.hash(content)
+		else:
+			digest, size, temporary = self.spool(content)
+		blob_name = self.blob_name(digest, name)
+		if self.exists(blob_name):
+			if temporary:
+				os.remove(temporary)
+		elif temporary:
+			self.move(temporary, blob_name)
+		elif hasattr(content, "temporary_file_path"):
+			# uploads django already spooled to disk are moved like FileSystemStorage does
+			self.move(content.temporary_file_path(), blob_name)
+		else:
+			self.move(self.spool(content)[2], blob_name)
+		Blob.stored(blob_name, digest, size)
+		return blob_name
+
+	@staticmethod
+	def hash(content):
+		sha256 = hashlib.sha256()
+		size = 0
+		for data in content.chunks(BLOCK_SIZE):
+			sha256.update(data)
+			size += len(data)
+		return sha256.hexdigest(), size
+
+	def spool(self, content):
+		"""
+		Copies content into a temporary file next to the blobs while hashing it
+		:return: (digest, size, temporary path)
+		"""
+		directory = self.path(BLOB_DIRECTORY)
+		os.makedirs(directory, exist_ok=True)
+		sha256 = hashlib.sha256()
+		size = 0
+		with tempfile.NamedTemporaryFile(dir=directory, prefix=".spool-", delete=False) as temporary:
+			for data in content.chunks(BLOCK_SIZE):
+				sha256.update(data)
+				size += len(data)
+				temporary.write(data)
+		return sha256.hexdigest(), size, temporary.name
+
+	def move(self, temporary: str, blob_name: str):
+		path = self.path(blob_name)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		if self.directory_permissions_mode is not None:
+			os.chmod(os.path.dirname(path), self.directory_permissions_mode)
+		file_move_safe(temporary, path, allow_overwrite=True)
+		if self.file_permissions_mode is not None:
+			os.chmod(path, self.file_permissions_mode)
+
+
+attachment_storage = ContentAddressedStorage()
@@ -0,0 +1,92 @@
+import logging
+import tempfile
+
+from celery import shared_task
+from django.core.files import File
+from django.core.files.storage import default_storage
+
+from core.attachments import ingest_attachment
+from core.helpers import ChannelPublisher, send_ws_to_private
+from core.models import ChatAttachment, UploadSession, RoomExport
+
+
+@shared_task
+def process_attachment(attachment_id):
+	"""
+	Moves a staged upload into storage and tells the room its attachment is ready
+	"""
+	from core.services import ChatAttachments
+
+	attachment = ChatAttachment.objects.select_related("message").filter(
+		id=attachment_id, status=ChatAttachment.PENDING).first()
+	if not attachment:
+		return
+	ready = ingest_attachment(attachment)
+	message = attachment.message
+	ChannelPublisher.publish(f"chat_{message.chat_id}", "ATTACHMENT READY" if ready else "ATTACHMENT FAILED",
+	                         dict(message=message.id, attachment=ChatAttachments(attachment).data),
+	                         sender=message.sender_id)
+
+
+@shared_task
+def delete_expired_upload_sessions():
+	"""
+	Removes upload sessions that were never finalized, with their chunks
+	"""
+	return UploadSession.delete_expired()
+
+
+@shared_task
+def delete_expired_room_exports():
+	return RoomExport.delete_expired()
+
+
+@shared_task
+def build_room_export(export_id):
+	"""
+	Writes the history of a room to storage through a temporary file, so neither the worker nor the request
+	serving the download holds it in memory, then tells the user it can be downloaded
+	"""
+	from core.exports import export_room
+	from core.services import RoomExportSerializer
+
+	export = RoomExport.objects.select_related("user").filter(id=export_id, status=RoomExport.PENDING).first()
+	if not export:
+		return
+	try:
+		with tempfile.TemporaryFile() as file:
+			for piece in export_room(export.room_id, export.compressed):
+				file.write(piece)
+			file.seek(0)
+			export.stored_file = default_storage.save(f"exports/{export.id}/{export.file_name}", File(file))
+		export.status = RoomExport.READY
+	except Exception as e:
+		logging.critical(e, exc_info=True)
+		export.status = RoomExport.FAILED
+	export.save(update_fields=["stored_file", "status"])
+	send_ws_to_private(user=export.user, event="EXPORT READY" if export.status == RoomExport.READY else "EXPORT FAILED",
+	                   data=RoomExportSerializer(export).data)
+
+
+def queue_attachments(attachments):
+	"""
+	Queues the processing of freshly committed attachments, a broker outage leaves them pending instead of
+	failing the request that already committed the message
+	"""
+	for attachment in attachments:
+		try:
+			process_attachment.delay(attachment.id)
+		except Exception as e:
+			logging.critical(e, exc_info=True)
+
+
+def queue_room_export(export):
+	"""
+	Queues the build of an export, a broker outage fails the export instead of the request
+	"""
+	try:
+		build_room_export.delay(export.id)
+	except Exception as e:
+		logging.critical(e, exc_info=True)
+		export.status = RoomExport.FAILED
+		export.save(update_fields=["status"])
@@ -0,0 +1,745 @@
+import asyncio
+import gzip
+import hashlib
+import io
+import json
+import shutil
+import tempfile
+import uuid
+from datetime import datetime, date, time, timedelta, timezone
+from decimal import Decimal
+from unittest import skipUnless
+
+from asgiref.sync import async_to_sync
+from asgiref.testing import ApplicationCommunicator
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.asgi import get_asgi_application
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import path
+from django.utils.translation import gettext_lazy
+from PIL import Image
+from rest_framework.authtoken.models import Token
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder as DRFJSONEncoder
+
+from ChatClone.celery import app as celery_app
+from ChatClone.routing import consumers
+from core import codecs
+from core.attachments import serve_file
+from core.caches import auth_cache, recent_messages
+from core.codecs import CODECS, AVAILABLE, FastJSONRenderer, StdlibCodec
+from core.consumers import MultiplexConsumer
+from core.controllers import ChatMessageAPI
+from core.management.benchmark import seed_messages
+from core.models import User, ChatRoom, ChatMessage, ChatAttachment, RoomReadState
+from core.search import SqliteSearchBackend
+from core.send_queues import send_queue_metrics, POLICIES, DROP_OLDEST, DROP_NONCRITICAL
+from core.services import ChatAttachments, UserSerializer
+from core.storage import attachment_storage
+
+IN_MEMORY_CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+LOCMEM_CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "tests"}}
+GOLDEN = {
+	"datetimes": [
+		datetime(2023, 5, 17, 9, 30, 12),
+		datetime(2023, 5, 17, 9, 30, 12, 345678),
+		datetime(2023, 5, 17, 9, 30, 12, 345678, tzinfo=timezone.utc),
+		datetime(2023, 5, 17, 9, 30, tzinfo=timezone(timedelta(hours=1))),
+		date(2023, 5, 17),
+		time(9, 30, 12, 5000),
+		timedelta(days=1, seconds=3, microseconds=7),
+	],
+	"decimals": [Decimal("1.10"), Decimal("0.000001"), Decimal("0.00006658"), Decimal("-12345.6789"), Decimal("1E+3"),
+	             Decimal("1E+20")],
+	"text": ["plain", "café \U0001f600", "line separator ", "</script>", "quote\"back\\slash"],
+	# plain floats under 1e-4 or from 1e16 are written in orjson's exponent form, equal but not golden
+	"numbers": [0, -1, 2 ** 53, 2 ** 70, 0.1, 1.5, 123456.789, True, False, None],
+	"other": {"uuid": uuid.UUID("12345678-1234-5678-1234-567812345678"), "lazy": gettext_lazy("Not found."),
+	          1: "int key", "nested": [{"a": [[]]}, {}]},
+}
+
+
+class ChatTestMixin:
+	"""
+	Runs against the in-memory channel layer, a temporary media root and eager celery tasks
+	"""
+	@classmethod
+	def setUpClass(cls):
+		super().setUpClass()
+		cls.media_root = tempfile.mkdtemp(prefix="chatclone-tests-")
+		cls.media = override_settings(MEDIA_ROOT=cls.media_root)
+		cls.media.enable()
+		cls.always_eager = celery_app.conf.task_always_eager
+		celery_app.conf.update(CELERY_TASK_ALWAYS_EAGER=True)
+
+	@classmethod
+	def tearDownClass(cls):
+		celery_app.conf.update(CELERY_TASK_ALWAYS_EAGER=cls.always_eager)
+		cls.media.disable()
+		shutil.rmtree(cls.media_root, ignore_errors=True)
+		super().tearDownClass()
+
+	def setUp(self):
+		from django.core.cache import caches
+		caches["default"].clear()
+		auth_cache.clear()
+
+	@staticmethod
+	def create_user(name: str) -> User:
+		return User.objects.create_user(username=name, email=f"{name}@example.com", password="password")
+
+	@staticmethod
+	def token(user) -> str:
+		return Token.objects.get_or_create(user=user)[0].key
+
+	def asgi_request(self, method: str, path: str, user, query: str = "") -> tuple:
+		"""
+		Sends a request through the ASGI handler the project is served with, the view runs on a thread of its own
+		so only a TransactionTestCase's rows are visible to it
+		:return: (status, headers, body)
+		"""
+		scope = {
+			"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": method, "scheme": "http",
+			"path": path, "raw_path": path.encode(), "query_string": query.encode(), "root_path": "",
+			"headers": [(b"host", b"testserver"), (b"authorization", f"Token {self.token(user)}".encode())],
+			"client": ("127.0.0.1", 50000), "server": ("testserver", 80),
+		}
+
+		async def run():
+			communicator = ApplicationCommunicator(get_asgi_application(), scope)
+			await communicator.send_input({"type": "http.request", "body": b"", "more_body": False})
+			start = await communicator.receive_output(5)
+			body = b""
+			while True:
+				message = await communicator.receive_output(5)
+				body += message.get("body", b"")
+				if not message.get("more_body"):
+					break
+			return start["status"], dict(start["headers"]), body
+		return async_to_sync(run)()
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, CACHES=LOCMEM_CACHES, WEBSOCKET_PUBLISH_DEFERRED=False)
+class ChatTestCase(ChatTestMixin, TestCase):
+	pass
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, CACHES=LOCMEM_CACHES, WEBSOCKET_PUBLISH_DEFERRED=False)
+class ChatTransactionTestCase(ChatTestMixin, TransactionTestCase):
+	pass
+
+
+class RoomExportTests(ChatTransactionTestCase):
+	def setUp(self):
+		super().setUp()
+		self.user = self.create_user("exporter")
+		self.other = self.create_user("other")
+		self.room = ChatRoom.objects.create(name="exported")
+		self.room.add_member(self.user)
+		self.room.add_member(self.other)
+		seed_messages(self.room, [self.user, self.other], 250)
+
+	def export(self, query: str = "") -> dict:
+		status, _, body = self.asgi_request("POST", f"/api/v1/chat-rooms/{self.room.id}/export/", self.user, query)
+		self.assertEqual(status, 200, body)
+		return json.loads(body)
+
+	def test_export_downloads_over_asgi(self):
+		export = self.export()
+		self.assertEqual(export["status"], "ready")
+		status, headers, body = self.asgi_request("GET", export["download"], self.user)
+		self.assertEqual(status, 200, body)
+		self.assertEqual(headers[b"Content-Type"], b"application/x-ndjson")
+		lines = [json.loads(line) for line in body.splitlines()]
+		self.assertEqual([line["text"] for line in lines], [f"message {index}" for index in range(250)])
+		self.assertEqual(lines[0]["sender"]["id"], self.user.id)
+
+	def test_gzipped_export(self):
+		export = self.export("compress=gzip")
+		status, headers, body = self.asgi_request("GET", export["download"], self.user)
+		self.assertEqual(status, 200)
+		self.assertEqual(headers[b"Content-Type"], b"application/gzip")
+		self.assertEqual(len(gzip.decompress(body).splitlines()), 250)
+
+	def test_only_the_requesting_member_downloads(self):
+		export = self.export()
+		status, _, _ = self.asgi_request("GET", export["download"], self.other)
+		self.assertEqual(status, 404)
+		self.room.remove_member(self.user)
+		status, _, _ = self.asgi_request("GET", export["download"], self.user)
+		self.assertEqual(status, 404)
+
+
+class KeysetPaginationTests(ChatTestCase):
+	def setUp(self):
+		super().setUp()
+		self.user = self.create_user("reader")
+		self.room = ChatRoom.objects.create(name="paged")
+		self.room.add_member(self.user)
+		seed_messages(self.room, [self.user], 10)
+		self.client.defaults["HTTP_AUTHORIZATION"] = f"Token {self.token(self.user)}"
+
+	def page(self, **params) -> dict:
+		response = self.client.get("/api/v1/chat-messages/", dict(chat_id=self.room.id, pagination="cursor",
+		                                                          page_size=3, **params))
+		self.assertEqual(response.status_code, 200, response.content)
+		return response.json()
+
+	def test_cursors_round_trip_without_gaps(self):
+		history = [f"message {index}" for index in range(10)]
+		page = self.page()
+		older = [message["text"] for message in page["results"]]
+		while page["previous"]:
+			page = self.page(before=page["previous"])
+			older = [message["text"] for message in page["results"]] + older
+		self.assertEqual(older, history)
+		newer = [message["text"] for message in page["results"]]
+		while page["next"]:
+			page = self.page(after=page["next"])
+			newer += [message["text"] for message in page["results"]]
+		self.assertEqual(newer, history)
+
+	def test_next_of_an_older_page_starts_after_its_last_message(self):
+		newest = self.page()
+		older = self.page(before=newest["previous"])
+		self.assertEqual(self.page(after=older["next"])["results"], newest["results"])
+
+
+class UploadSessionTests(ChatTestCase):
+	def setUp(self):
+		super().setUp()
+		self.user = self.create_user("uploader")
+		self.room = ChatRoom.objects.create(name="uploads")
+		self.room.add_member(self.user)
+		self.client.defaults["HTTP_AUTHORIZATION"] = f"Token {self.token(self.user)}"
+		self.content = b"0123456789" * 10
+		response = self.client.post("/api/v1/uploads/", dict(chat=self.room.id, file_name="notes.txt",
+		                                                      total_size=len(self.content), chunk_size=40))
+		self.assertEqual(response.status_code, 201, response.content)
+		self.session = response.json()
+
+	def put_chunk(self, index: int, data: bytes, sha256: str = None):
+		return self.client.put(f"/api/v1/uploads/{self.session['id']}/chunks/{index}/", data,
+		                       content_type="application/octet-stream",
+		                       HTTP_X_CHUNK_SHA256=sha256 or hashlib.sha256(data).hexdigest())
+
+	def test_a_broken_resend_keeps_the_accepted_chunk(self):
+		chunks = [self.content[start:start + 40] for start in range(0, len(self.content), 40)]
+		for index, data in enumerate(chunks):
+			self.assertEqual(self.put_chunk(index, data).status_code, 200)
+		response = self.put_chunk(1, chunks[1], sha256="0" * 64)
+		self.assertEqual(response.status_code, 400)
+		response = self.client.post(f"/api/v1/uploads/{self.session['id']}/finalize/", dict(text="notes"))
+		self.assertEqual(response.status_code, 200, response.content)
+		attachment = ChatAttachment.objects.get(message_id=response.json()["id"])
+		# processing runs on commit, the assembled blob is still staged inside the test's transaction
+		with attachment_storage.open(attachment.staged_file, "rb") as staged_file:
+			self.assertEqual(staged_file.read(), self.content)
+
+
+class ServeFileTests(ChatTestCase):
+	def setUp(self):
+		super().setUp()
+		self.name = default_storage.save("served.bin", ContentFile(bytes(range(100))))
+		self.etag = self.get()["ETag"]
+
+	def get(self, **headers):
+		response = serve_file(RequestFactory().get("/", **headers), self.name)
+		if response.streaming:
+			response.body = b"".join(response.streaming_content)
+		response.close()
+		return response
+
+	def test_single_range(self):
+		response = self.get(HTTP_RANGE="bytes=10-19")
+		self.assertEqual(response.status_code, 206)
+		self.assertEqual(response["Content-Range"], "bytes 10-19/100")
+		self.assertEqual(response.body, bytes(range(10, 20)))
+
+	def test_suffix_range(self):
+		response = self.get(HTTP_RANGE="bytes=-5")
+		self.assertEqual(response.status_code, 206)
+		self.assertEqual(response["Content-Range"], "bytes 95-99/100")
+		self.assertEqual(response.body, bytes(range(95, 100)))
+
+	def test_unsatisfiable_range(self):
+		response = self.get(HTTP_RANGE="bytes=100-")
+		self.assertEqual(response.status_code, 416)
+		self.assertEqual(response["Content-Range"], "bytes */100")
+
+	def test_invalid_range_sends_the_whole_file(self):
+		response = self.get(HTTP_RANGE="bytes=5-3")
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(response.body, bytes(range(100)))
+
+	def test_if_none_match(self):
+		self.assertEqual(self.get(HTTP_IF_NONE_MATCH=self.etag).status_code, 304)
+
+	def test_stale_if_range_sends_the_whole_file(self):
+		response = self.get(HTTP_RANGE="bytes=10-19", HTTP_IF_RANGE='"stale"')
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(response.body, bytes(range(100)))
+		response = self.get(HTTP_RANGE="bytes=10-19", HTTP_IF_RANGE=self.etag)
+		self.assertEqual(response.status_code, 206)
+
+
+class ImageDerivativeTests(ChatTestCase):
+	def setUp(self):
+		super().setUp()
+		self.member = self.create_user("member")
+		self.stranger = self.create_user("stranger")
+		room = ChatRoom.objects.create(name="pictures")
+		room.add_member(self.member)
+		picture = io.BytesIO()
+		Image.new("RGB", (64, 64), "red").save(picture, "PNG")
+		name = default_storage.save("root/pictures/red.png", ContentFile(picture.getvalue()))
+		message = ChatMessage.objects.create(chat=room, sender=self.member, text="picture")
+		self.attachment = ChatAttachment.objects.create(message=message, picture=name)
+
+	def get(self, url: str, user=None):
+		headers = dict(HTTP_AUTHORIZATION=f"Token {self.token(user)}") if user else {}
+		return self.client.get(url, **headers)
+
+	def test_attachment_derivatives_are_private_to_the_room(self):
+		url = ChatAttachments(self.attachment).data["thumbnails"]["medium"]
+		self.assertEqual(self.get(url).status_code, 401)
+		self.assertEqual(self.get(url, self.stranger).status_code, 404)
+		response = self.get(url, self.member)
+		self.assertEqual(response.status_code, 200)
+		self.assertTrue(response["Cache-Control"].startswith("private"))
+
+	def test_profile_picture_derivatives_stay_public(self):
+		self.stranger.profile_picture = self.attachment.picture.name
+		url = UserSerializer(self.stranger).data["profile_picture_thumbnails"]["small"]
+		response = self.get(url, self.member)
+		self.assertEqual(response.status_code, 200)
+		self.assertTrue(response["Cache-Control"].startswith("public"))
+
+
+class CounterTests(ChatTestCase):
+	def setUp(self):
+		super().setUp()
+		self.users = [self.create_user(f"counted{index}") for index in range(3)]
+		self.room = ChatRoom.objects.create(name="counted", maximum_members=2)
+
+	def members_count(self) -> int:
+		return ChatRoom.objects.values_list("members_count", flat=True).get(id=self.room.id)
+
+	def test_repeated_membership_changes_count_once(self):
+		for _ in range(2):
+			self.room.add_member(self.users[0])
+		self.room.add_member(self.users[1])
+		self.assertEqual(self.members_count(), 2)
+		for _ in range(2):
+			self.room.remove_member(self.users[0])
+		self.assertEqual(self.members_count(), 1)
+		self.room.remove_member(self.users[1])
+		self.assertEqual(self.members_count(), 0)
+
+	def test_migrate_read_states_counts_viewers(self):
+		for user in self.users[:2]:
+			self.room.add_member(user)
+		sender, reader = self.users[:2]
+		messages = [ChatMessage.objects.create(chat=self.room, sender=sender, text=f"message {index}")
+		            for index in range(3)]
+		messages[1].viewers.add(reader)
+		call_command("migrate_read_states", stdout=io.StringIO())
+		self.assertEqual(list(ChatMessage.objects.filter(chat=self.room).order_by("id").
+		                      values_list("viewers_count", flat=True)), [1, 1, 0])
+
+
+class WebsocketAuthCacheTests(ChatTestCase):
+	"""
+	Rows are bulk created so no signal invalidates the cache, as when another process writes them
+	"""
+	def test_missing_token_is_not_cached(self):
+		user = self.create_user("ada")
+		self.assertIsNone(auth_cache.get_user("a" * 40))
+		Token.objects.bulk_create([Token(key="a" * 40, user=user)])
+		self.assertEqual(auth_cache.get_user("a" * 40), (user.id, "ada"))
+
+	def test_non_membership_is_not_cached(self):
+		user = self.create_user("ada")
+		room = ChatRoom.objects.create(name="room")
+		self.assertFalse(auth_cache.is_member(room.id, user.id))
+		ChatRoom.members.through.objects.bulk_create([ChatRoom.members.through(chatroom_id=room.id, user_id=user.id)])
+		self.assertTrue(auth_cache.is_member(room.id, user.id))
+		self.assertEqual(auth_cache.memberships.stats()["size"], 1)
+
+
+class ChatRoomListTests(ChatTestCase):
+	def setUp(self):
+		super().setUp()
+		self.user = self.create_user("lister")
+		self.other = self.create_user("talker")
+		self.client.defaults["HTTP_AUTHORIZATION"] = f"Token {self.token(self.user)}"
+
+	def create_rooms(self, count: int):
+		for index in range(ChatRoom.objects.count(), ChatRoom.objects.count() + count):
+			room = ChatRoom.objects.create(name=f"listed {index}")
+			room.add_member(self.user)
+			room.add_member(self.other)
+			seed_messages(room, [self.user, self.other], 4)
+
+	def list_rooms(self) -> list:
+		response = self.client.get("/api/v1/chat-rooms/")
+		self.assertEqual(response.status_code, 200, response.content)
+		body = response.json()
+		return body["results"] if isinstance(body, dict) else body
+
+	def test_unread_counts(self):
+		self.create_rooms(2)
+		read = ChatRoom.objects.get(name="listed 0")
+		RoomReadState.objects.create(user=self.user, room=read, last_read_message_id=read.chatmessage_set.
+		                             order_by("id").values_list("id", flat=True)[1])
+		unread = {room["name"]: room["unread_count"] for room in self.list_rooms()}
+		self.assertEqual(unread, {"listed 0": 1, "listed 1": 2})
+
+	def test_query_count_does_not_grow_with_rooms(self):
+		self.create_rooms(1)
+		with CaptureQueriesContext(connection) as one_room:
+			self.list_rooms()
+		self.create_rooms(5)
+		with self.assertNumQueries(len(one_room)):
+			self.assertEqual(len(self.list_rooms()), 6)
+
+
+class QueryBudgetTests(ChatTransactionTestCase):
+	"""
+	The chat hot paths against seeded data, each may issue at most its budget of SQL queries. Run outside a
+	test transaction, whose savepoints would be counted too
+	"""
+	def setUp(self):
+		super().setUp()
+		self.viewer = self.create_user("viewer")
+		senders = [self.create_user(f"sender{index}") for index in range(3)]
+		self.chat = ChatRoom.objects.create(name="budget")
+		self.chat.members.add(self.viewer, *senders)
+		ChatMessage.objects.bulk_create([ChatMessage(chat=self.chat, text=f"message {index}",
+		                                             sender=senders[index % len(senders)]) for index in range(400)])
+		ChatAttachment.objects.bulk_create([ChatAttachment(message=message, document=f"root/documents/{message.id}.txt")
+		                                    for message in ChatMessage.objects.filter(chat=self.chat)[::3]])
+
+	def mark_viewed(self, offset: int, page_size: int):
+		page = list(ChatMessage.objects.filter(chat=self.chat).order_by("id")[offset:offset + page_size])
+		ChatMessageAPI.notify_viewed(self.viewer, ChatMessage.view_many(page, self.viewer))
+
+	def test_first_read_receipts_in_a_room(self):
+		with self.assertNumQueries(7):
+			self.mark_viewed(0, 20)
+
+	def test_read_receipts_for_100_messages(self):
+		self.mark_viewed(0, 20)
+		with self.assertNumQueries(5):
+			self.mark_viewed(20, 100)
+
+	def list_messages(self, page: int, page_size: int):
+		response = self.client.get("/api/v1/chat-messages/", {"chat_id": self.chat.id, "page": page,
+		                                                       "page_size": page_size})
+		self.assertEqual(response.status_code, 200, response.content)
+
+	def test_message_list_pages(self):
+		self.client.defaults["HTTP_AUTHORIZATION"] = f"Token {self.token(self.viewer)}"
+		# a reader who has been in the room before, the first read creates the watermark
+		self.mark_viewed(0, 20)
+		for page, page_size in ((7, 20), (3, 100)):
+			with self.subTest(page_size=page_size), self.assertNumQueries(9):
+				self.list_messages(page, page_size)
+
+
+class CodecTests(ChatTestCase):
+	"""
+	Every installed JSON codec has to encode datetimes, decimals and message pages exactly like DRF does
+	"""
+	def test_stdlib_codec_matches_drf(self):
+		self.assertEqual(StdlibCodec.dumps_bytes(GOLDEN, DRFJSONEncoder), JSONRenderer().render(GOLDEN))
+
+	def test_codecs_match_drf(self):
+		user = self.create_user("golden")
+		chat = ChatRoom.objects.create(name="golden")
+		chat.add_member(user)
+		seed_messages(chat, [user], 50)
+		ChatAttachment.objects.bulk_create([ChatAttachment(message=message, document=f"root/documents/{message.id}.txt")
+		                                    for message in ChatMessage.objects.filter(chat=chat)[::5]])
+		self.client.defaults["HTTP_AUTHORIZATION"] = f"Token {self.token(user)}"
+		response = self.client.get("/api/v1/chat-messages/", {"chat_id": chat.id, "page_size": 50})
+		self.assertEqual(response.status_code, 200, response.content)
+		page = response.data
+		expected = {
+			"golden drf": JSONRenderer().render(GOLDEN),
+			"golden websocket": StdlibCodec.dumps_bytes(GOLDEN, DjangoJSONEncoder),
+			"message page": JSONRenderer().render(page),
+		}
+		for name, codec in CODECS.items():
+			if not AVAILABLE[name]:
+				continue
+			actual = {
+				"golden drf": codec.dumps_bytes(GOLDEN, DRFJSONEncoder),
+				"golden websocket": codec.dumps_bytes(GOLDEN, DjangoJSONEncoder),
+				"message page": codec.dumps_bytes(page, FastJSONRenderer.encoder_class),
+			}
+			for key, value in expected.items():
+				with self.subTest(codec=name, output=key):
+					self.assertEqual(actual[key], value)
+					self.assertEqual(codec.loads(value), json.loads(value))
+
+
+class StalledCommunicator(WebsocketCommunicator):
+	"""
+	A client that stops reading once stalled is set, frames sent to it block until released is set
+	"""
+	def __init__(self, application, path: str):
+		self.stalled = False
+		self.released = asyncio.Event()
+
+		async def stalling(scope, receive, send):
+			async def stalled_send(message):
+				if self.stalled and message["type"] == "websocket.send":
+					await self.released.wait()
+				await send(message)
+			return await application(scope, receive, stalled_send)
+		super().__init__(stalling, path)
+
+	async def received(self) -> list:
+		"""
+		:return: every message the application sent that was not read yet
+		"""
+		messages = []
+		# receive_output cancels the application when it times out, receive_nothing only waits
+		while not await self.receive_nothing(0.2):
+			messages.append(await self.receive_output())
+		return messages
+
+
+class SendQueueTests(ChatTransactionTestCase):
+	"""
+	Stalls the reader of a general socket while events are published, every send queue policy has to bound what
+	is buffered for it
+	"""
+	max_frames = 20
+	close_code = 4008
+
+	def test_policies_bound_a_stalled_reader(self):
+		token = self.token(self.create_user("stalled"))
+		for policy in POLICIES:
+			for mode, consumer in consumers["general"].items():
+				queue = dict(MAX_FRAMES=self.max_frames, MAX_BYTES=1024 * 1024, POLICY=policy,
+				             CLOSE_CODE=self.close_code, NONCRITICAL_EVENTS=["MESSAGES VIEWED"])
+				application = URLRouter([path("ws/<token>/general/", consumer.as_asgi())])
+				with self.subTest(policy=policy, mode=mode), override_settings(WEBSOCKET_SEND_QUEUE=queue):
+					async_to_sync(self.stall)(application, f"/ws/{token}/general/", policy)
+
+	async def stall(self, application, path: str, policy: str):
+		events = 3 * self.max_frames
+		send_queue_metrics.reset()
+		communicator = StalledCommunicator(application, path)
+		connected, _ = await communicator.connect()
+		self.assertTrue(connected)
+		await communicator.receive_from()
+		communicator.stalled = True
+
+		# every third event is critical, the others are read receipts
+		layer = get_channel_layer()
+		critical = []
+		for index in range(events):
+			event = "NEW MESSAGE" if index % 3 == 0 else "MESSAGES VIEWED"
+			if event == "NEW MESSAGE":
+				critical.append(index)
+			data = codecs.dumps(dict(event=event, data=dict(index=index)))
+			await layer.group_send("general", {"type": "notify", "data": data, "group": "general"})
+		# the consumer is left to buffer everything it was sent
+		await asyncio.sleep(0.5)
+		stats = send_queue_metrics.stats()
+
+		communicator.released.set()
+		messages = await communicator.received()
+		await communicator.disconnect()
+		delivered = [codecs.loads(message["text"])["data"]["index"] for message in messages
+		             if message["type"] == "websocket.send"]
+		close_code = next((message.get("code", 1000) for message in messages if message["type"] == "websocket.close"),
+		                  None)
+		evicted = sum(stats["evicted_frames"].values())
+
+		self.assertLessEqual(stats["peak_queue"], self.max_frames)
+		if policy == DROP_OLDEST:
+			# the frame stuck in flight, then the newest max_frames
+			self.assertEqual(delivered, [0] + list(range(events - self.max_frames, events)))
+		elif policy == DROP_NONCRITICAL:
+			self.assertLessEqual(set(critical), set(delivered))
+			self.assertEqual(len(delivered) + evicted, events)
+		else:
+			# events published after the close are not queued at all
+			self.assertEqual(close_code, self.close_code)
+			self.assertEqual(stats["closed_connections"], 1)
+
+
+class MessageSearchTests(ChatTestCase):
+	def test_results_page_forward_only(self):
+		user = self.create_user("searcher")
+		room = ChatRoom.objects.create(name="searched")
+		room.add_member(user)
+		for index in range(5):
+			ChatMessage.objects.create(chat=room, sender=user, text=f"deploy number {index}")
+		self.client.defaults["HTTP_AUTHORIZATION"] = f"Token {self.token(user)}"
+		found = []
+		params = dict(q="deploy", page_size=2)
+		while True:
+			response = self.client.get("/api/v1/chat-messages/search/", params)
+			self.assertEqual(response.status_code, 200, response.content)
+			page = response.json()
+			self.assertIsNone(page["previous"])
+			found += [message["id"] for message in page["results"]]
+			if not page["next"]:
+				break
+			params["after"] = page["next"]
+		self.assertCountEqual(found, ChatMessage.objects.filter(chat=room).values_list("id", flat=True))
+
+
+class SqliteSearchIndexTests(ChatTransactionTestCase):
+	def test_index_created_over_existing_messages(self):
+		backend = SqliteSearchBackend()
+		with connection.cursor() as cursor:
+			for trigger in ("insert", "delete", "update"):
+				cursor.execute(f"DROP TRIGGER IF EXISTS {backend.table}_{trigger}")
+			cursor.execute(f"DROP TABLE IF EXISTS {backend.table}")
+		user = self.create_user("upgraded")
+		room = ChatRoom.objects.create(name="upgraded")
+		room.add_member(user)
+		messages = [ChatMessage.objects.create(chat=room, sender=user, text=f"release note {index}")
+		            for index in range(3)]
+		backend.ensure_index()
+		messages[0].delete()
+		found = [hit[0] for hit in backend.search(user.id, ["release"])]
+		self.assertCountEqual(found, [message.id for message in messages[1:]])
+
+
+@override_settings(RECENT_MESSAGES_CACHE=dict(SIZE=5, TTL=60, CACHE="default"))
+class RecentMessageCacheTests(ChatTestCase):
+	def setUp(self):
+		super().setUp()
+		self.sender = self.create_user("poster")
+		self.sender.profile_picture = "profile_pics/poster.png"
+		self.sender.save()
+		self.reader = self.create_user("follower")
+		self.room = ChatRoom.objects.create(name="recent")
+		self.room.add_member(self.sender)
+		self.room.add_member(self.reader)
+		seed_messages(self.room, [self.sender, self.reader], 8)
+
+	def ring_ids(self) -> list:
+		return [item[1] for item in recent_messages.get(self.room.id)["messages"]]
+
+	def newest_page(self, **params) -> dict:
+		self.client.defaults["HTTP_AUTHORIZATION"] = f"Token {self.token(self.reader)}"
+		response = self.client.get("/api/v1/chat-messages/", dict(chat_id=self.room.id, pagination="cursor",
+		                                                          page_size=4, **params))
+		self.assertEqual(response.status_code, 200, response.content)
+		return response.json()
+
+	def test_counts_hits_and_misses(self):
+		hits, misses = recent_messages.hits, recent_messages.misses
+		recent_messages.get(self.room.id)
+		recent_messages.get(self.room.id)
+		self.assertEqual((recent_messages.hits - hits, recent_messages.misses - misses), (1, 1))
+
+	def test_push_keeps_the_newest_in_keyset_order(self):
+		ids = self.ring_ids()
+		self.assertEqual(ids, list(ChatMessage.objects.filter(chat=self.room).order_by("id").
+		                           values_list("id", flat=True))[-5:])
+		earlier = ChatMessage.objects.create(chat=self.room, sender=self.sender, text="earlier")
+		later = ChatMessage.objects.create(chat=self.room, sender=self.sender, text="later")
+		# committed out of order
+		recent_messages.push(later)
+		recent_messages.push(earlier)
+		self.assertEqual(self.ring_ids(), ids[2:] + [earlier.id, later.id])
+		self.assertEqual(recent_messages.get(self.room.id)["count"], 10)
+
+	def test_attachment_changes_patch_the_ring(self):
+		message = ChatMessage.objects.filter(chat=self.room).order_by("id").last()
+		attachment = ChatAttachment.objects.create(message=message, status=ChatAttachment.PENDING,
+		                                           staged_file="staging/notes.txt", original_name="notes.txt")
+		self.ring_ids()
+
+		def attachments():
+			item = recent_messages.get(self.room.id)["messages"][-1]
+			return item[3]["attachments"]
+		with self.captureOnCommitCallbacks(execute=True):
+			attachment.status = ChatAttachment.READY
+			attachment.document = "root/documents/notes.txt"
+			attachment.save()
+		self.assertEqual([(item["id"], item["status"]) for item in attachments()], [(attachment.id, "ready")])
+		with self.captureOnCommitCallbacks(execute=True):
+			attachment.delete()
+		self.assertEqual(attachments(), [])
+
+	def test_deleted_messages_leave_the_ring(self):
+		ids = self.ring_ids()
+		with self.captureOnCommitCallbacks(execute=True):
+			ChatMessage.objects.get(id=ids[-1]).delete()
+		ring = recent_messages.get(self.room.id)
+		self.assertEqual([item[1] for item in ring["messages"]], ids[:-1])
+		self.assertEqual(ring["count"], 7)
+
+	def test_cached_page_matches_the_database_page(self):
+		hits = recent_messages.hits
+		self.newest_page()
+		cached = self.newest_page()
+		self.assertEqual(recent_messages.hits - hits, 1)
+		with override_settings(RECENT_MESSAGES_CACHE=dict(SIZE=5, TTL=60, CACHE=None)):
+			stored = self.newest_page()
+		self.assertEqual(cached["results"], stored["results"])
+		self.assertEqual(cached["previous"], stored["previous"])
+		sender = next(message["sender"] for message in cached["results"] if message["sender"]["id"] == self.sender.id)
+		self.assertEqual(sender["profile_picture"], "http://testserver/media/profile_pics/poster.png")
+		self.assertEqual({message["viewed"] for message in cached["results"]
+		                  if message["sender"]["id"] == self.sender.id}, {True})
+		self.assertEqual({message["viewers_count"] for message in cached["results"]
+		                  if message["sender"]["id"] == self.sender.id}, {1})
+
+	def test_off_without_a_shared_cache(self):
+		with override_settings(RECENT_MESSAGES_CACHE=dict(SIZE=5, TTL=60, CACHE=None)):
+			hits, misses = recent_messages.hits, recent_messages.misses
+			self.newest_page()
+			self.assertEqual((recent_messages.hits, recent_messages.misses), (hits, misses))
+
+
+@skipUnless(codecs.msgpack, "msgpack is not installed")
+class MessagePackFrameTests(ChatTransactionTestCase):
+	"""
+	MessagePack can carry bin and ext values json has no form for, frames holding them are rejected
+	"""
+	def setUp(self):
+		super().setUp()
+		self.token_key = self.token(self.create_user("packer"))
+
+	async def exchange(self, application, path: str, wrap) -> dict:
+		communicator = WebsocketCommunicator(application, path, subprotocols=[codecs.MSGPACK_SUBPROTOCOL])
+		connected, _ = await communicator.connect()
+		self.assertTrue(connected)
+		await communicator.receive_output()
+		await communicator.send_to(bytes_data=codecs.msgpack.packb(wrap({"event": "x", "data": b"\x00"})))
+		await communicator.send_to(bytes_data=codecs.msgpack.packb(wrap({"event": "x", "data": "fine"})))
+		frame = codecs.msgpack_to_python(await communicator.receive_from())
+		await communicator.disconnect()
+		return frame
+
+	def test_binary_values_are_rejected(self):
+		for mode, consumer in consumers["general"].items():
+			application = URLRouter([path("ws/<token>/general/", consumer.as_asgi())])
+			with self.subTest(mode=mode):
+				frame = async_to_sync(self.exchange)(application, f"/ws/{self.token_key}/general/", lambda data: data)
+				self.assertEqual(frame, {"event": "x", "data": "fine"})
+
+	def test_binary_values_are_rejected_on_the_multiplexed_socket(self):
+		application = URLRouter([path("ws/<token>/", MultiplexConsumer.as_asgi())])
+		frame = async_to_sync(self.exchange)(application, f"/ws/{self.token_key}/",
+		                                     lambda data: {"channel": "general", "payload": data})
+		self.assertEqual(frame, {"channel": "general", "payload": {"event": "x", "data": "fine"}})
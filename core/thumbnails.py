@@ -0,0 +1,139 @@
+import hashlib
+import io
+import logging
+from datetime import timedelta
+from functools import lru_cache
+
+from django.conf import settings
+from django.core import signing
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import IntegrityError
+from django.db.models import Sum
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+DERIVATIVE_DIRECTORY = "derivatives"
+SIGNING_SALT = "core.thumbnails"
+WEBP = "webp"
+WEBP_QUALITY = 80
+JPEG_QUALITY = 85
+# last_accessed is only written when it is older than this, so cache hits don't all turn into updates
+TOUCH_INTERVAL = timedelta(hours=1)
+
+
+@lru_cache(maxsize=4096)
+def derivative_url(source: str, size: str, image_format: str = None, attachment_id: int = None) -> str:
+	"""
+	Returns the url of a derivative of a stored picture. The spec is signed into the url so
+	only derivatives handed out by the serializers can be generated
+	:param source: name of the picture in the default storage
+	:param size: key of THUMBNAIL_SIZES
+	:param image_format: webp, or None to keep jpeg/png
+	:param attachment_id: the ChatAttachment the picture belongs to, only members of its room are served it.
+	None for profile pictures
+	"""
+	token = signing.dumps([source, size, image_format, attachment_id], salt=SIGNING_SALT, compress=True)
+	return reverse("image-derivative", args=[token])
+
+
+def derivative_urls(source: str, sizes, attachment_id: int = None) -> dict or None:
+	"""
+	Returns {size: url, size_webp: url} for every size, or None when there is no picture
+	"""
+	if not source:
+		return None
+	urls = {}
+	for size in sizes:
+		urls[size] = derivative_url(source, size, None, attachment_id)
+		urls[f"{size}_{WEBP}"] = derivative_url(source, size, WEBP, attachment_id)
+	return urls
+
+
+def load_spec(token: str):
+	"""
+	:return: (source, size, image_format, attachment_id) or None when the token was not issued by derivative_url
+	"""
+	try:
+		source, size, image_format, attachment_id = signing.loads(token, salt=SIGNING_SALT)
+	except (signing.BadSignature, ValueError, TypeError):
+		return None
+	if size not in settings.THUMBNAIL_SIZES or image_format not in (None, WEBP):
+		return None
+	return source, size, image_format, attachment_id
+
+
+def render(source: str, size: str, image_format: str = None):
+	"""
+	Resizes a stored picture so its longest side fits THUMBNAIL_SIZES[size]
+	:return: (content, extension)
+	"""
+	edge = settings.THUMBNAIL_SIZES[size]
+	with default_storage.open(source, "rb") as file, Image.open(file) as image:
+		image = ImageOps.exif_transpose(image)
+		image.thumbnail((edge, edge))
+		transparent = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+		output = io.BytesIO()
+		if image_format == WEBP:
+			image.convert("RGBA" if transparent else "RGB").save(output, "WEBP", quality=WEBP_QUALITY, method=4)
+			extension = WEBP
+		elif transparent:
+			image.convert("RGBA").save(output, "PNG", optimize=True)
+			extension = "png"
+		else:
+			image.convert("RGB").save(output, "JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)
+			extension = "jpg"
+	return output.getvalue(), extension
+
+
+def get_derivative(source: str, size: str, image_format: str = None):
+	"""
+	Returns the ImageDerivative of a picture, rendering and storing it on first use
+	:return: ImageDerivative or None when the source is missing or not a picture
+	"""
+	from core.models import ImageDerivative
+	key = hashlib.sha256(f"{source}:{size}:{image_format}".encode()).hexdigest()
+	derivative = ImageDerivative.objects.filter(key=key).first()
+	if derivative and default_storage.exists(derivative.name):
+		if timezone.now() - derivative.last_accessed > TOUCH_INTERVAL:
+			ImageDerivative.objects.filter(id=derivative.id).update(last_accessed=timezone.now())
+		return derivative
+	try:
+		content, extension = render(source, size, image_format)
+	except (OSError, UnidentifiedImageError, Image.DecompressionBombError) as e:
+		logging.warning(e)
+		return None
+	# stored under the digest of its content, so identical derivatives share one file
+	digest = hashlib.sha256(content).hexdigest()
+	name = f"{DERIVATIVE_DIRECTORY}/{digest[:2]}/{digest}.{extension}"
+	if not default_storage.exists(name):
+		name = default_storage.save(name, ContentFile(content))
+	try:
+		derivative, _ = ImageDerivative.objects.update_or_create(
+			key=key, defaults=dict(source=source, name=name, size=len(content), last_accessed=timezone.now()))
+	except IntegrityError:
+		# rendered concurrently by another request
+		derivative = ImageDerivative.objects.get(key=key)
+	evict(settings.DERIVATIVE_CACHE_MAX_BYTES, keep=derivative.id)
+	return derivative
+
+
+def evict(max_bytes: int, keep: int = None) -> int:
+	"""
+	Deletes the least recently used derivatives until they use at most max_bytes
+	:param keep: id of a derivative that is never evicted, the one about to be served
+	:return: number of derivatives deleted
+	"""
+	from core.models import ImageDerivative
+	total = ImageDerivative.objects.aggregate(total=Sum("size"))["total"] or 0
+	deleted = 0
+	for derivative in ImageDerivative.objects.exclude(id=keep).order_by("last_accessed").iterator():
+		if total <= max_bytes:
+			break
+		derivative.delete()
+		if not ImageDerivative.objects.filter(name=derivative.name).exists():
+			default_storage.delete(derivative.name)
+		total -= derivative.size
+		deleted += 1
+	return deleted
@@ -1,16 +1,23 @@
 from django.urls import path
 from rest_framework.routers import SimpleRouter
 
-from core.controllers import ChatRoomAPI, ChatMessageAPI, LoginAPI, SignupAPI, ChatActionsAPI, ProfileAPI
+from core.controllers import ChatRoomAPI, ChatMessageAPI, LoginAPI, SignupAPI, ChatActionsAPI, ProfileAPI, \
+	MetricsAPI, UploadSessionAPI, AttachmentDownloadAPI, \
+	ImageDerivativeAPI, RoomExportAPI
 
 router = SimpleRouter()
 router.register("chat-rooms", ChatRoomAPI)
 router.register("chat-messages", ChatMessageAPI)
+router.register("uploads", UploadSessionAPI)
+router.register("exports", RoomExportAPI, basename="room-export")
 
 urlpatterns = [
 	path("login/", LoginAPI.as_view()),
 	path("signup/", SignupAPI.as_view()),
 	path("chat-rooms/actions/", ChatActionsAPI.as_view()),
-	path("profile/", ProfileAPI.as_view())
+	path("profile/", ProfileAPI.as_view()),
+	path("metrics/", MetricsAPI.as_view()),
+	path("attachments/<int:pk>/download/", AttachmentDownloadAPI.as_view(), name="attachment-download"),
+	path("derivatives/<str:token>/", ImageDerivativeAPI.as_view(), name="image-derivative")
 ]
 urlpatterns.extend(router.urls)
\ No newline at end of file
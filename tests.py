@@ -2,6 +2,7 @@ import json
 import os
 
 import django
+import msgpack
 
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "ChatClone.settings")
@@ -11,17 +12,26 @@ from core.models import User
 from rest_framework.authtoken.models import Token
 
 user_ids = User.objects.only("id").values_list("id", flat=True)
-socket_type = input("channels [general, private, chats/<id>]: ")
+socket_type = input("channels [general, private, chats/<id>, multiplex]: ")
 user_id = input(f"user id [{','.join(map(str,user_ids))}]: ")
 user = User.objects.get(id=int(user_id))
 token, _ = Token.objects.get_or_create(user=user)
+protocol = input("protocol [json, msgpack, json.batched, msgpack.batched]: ") or "json"
 websocket_url = f"ws://localhost:8001/ws/{token.key}/{socket_type}/"
+rooms = []
+if socket_type == "multiplex":
+    # a single socket for general, private and the rooms subscribed to once it is open
+    websocket_url = f"ws://localhost:8001/ws/{token.key}/"
+    rooms = [room for room in input("rooms to subscribe to [1,2,...]: ").split(",") if room.strip()]
 
 
 def on_message(ws, message):
     try:
-        data = json.loads(message)
-        print(data)
+        # events are binary MessagePack frames on the msgpack protocol, the greeting stays text
+        data = msgpack.unpackb(message) if isinstance(message, bytes) else json.loads(message)
+        # the batched protocols send the events of a window as one array
+        for event in data if isinstance(data, list) else [data]:
+            print(event)
         # if "payload" in data:
         #     if int(data['payload']['sender']['id']) != int(sys.argv[1]):
         #         print(sys.argv[1], data["payload"])
@@ -30,8 +40,18 @@ def on_message(ws, message):
         print(data)
 
 
-# Create a WebSocket connection
-ws = websocket.WebSocketApp(websocket_url, on_message=on_message)
+def on_open(ws):
+    for room in rooms:
+        subscribe = {"action": "subscribe", "chat": int(room)}
+        if protocol.startswith("msgpack"):
+            ws.send(msgpack.packb(subscribe), websocket.ABNF.OPCODE_BINARY)
+        else:
+            ws.send(json.dumps(subscribe))
+
+
+# Create a WebSocket connection, the msgpack protocol is asked for through Sec-WebSocket-Protocol
+subprotocols = [f"chatclone.{protocol}"] if protocol != "json" else None
+ws = websocket.WebSocketApp(websocket_url, on_message=on_message, on_open=on_open, subprotocols=subprotocols)
 
 # Start the WebSocket connection
 ws.run_forever()